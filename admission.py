@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+上游调用的接入控制
+上游限流时每个请求都会占住一个工作线程直到超时，整个服务随之停顿。这里在调用上游前：
+- 限制同时进行的上游请求数，超过时进入有界等待队列
+- 队列按优先级通道排序（对话优先于识别，识别优先于合成），队列满时挤掉优先级更低的等待者
+- 每个通道有最长等待时间，等待超时或队列已满立即拒绝（503 + Retry-After），不占用线程等待上游超时
+- 并发上限按 AIMD 自适应：请求正常时缓慢增加，遇到 429/503、超时或延迟明显升高时成倍减小；
+  各通道的正常延迟差别很大（合成远快于对话），延迟基线和平均延迟按通道分别统计
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+# 通道优先级（数字越小越优先）
+LANES = {'chat': 0, 'stt': 1, 'tts': 2}
+# 平均延迟低于该值（秒）时不按延迟判断拥塞，避免极短延迟的抖动被误判
+MIN_CONGESTION_LATENCY = 0.05
+
+
+class AdmissionRejected(Exception):
+    """上游繁忙，请求未被接入"""
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: float = 1):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class _Waiter:
+    __slots__ = ('lane', 'priority', 'seq', 'event', 'admitted', 'evicted')
+
+    def __init__(self, lane: str, priority: int, seq: int):
+        self.lane = lane
+        self.priority = priority
+        self.seq = seq
+        self.event = threading.Event()
+        self.admitted = False
+        self.evicted = False
+
+
+class Slot:
+    """一次已接入的上游调用，用于上报结果"""
+
+    __slots__ = ('_started', 'outcome', 'latency', 'retry_after')
+
+    def __init__(self):
+        self._started = time.monotonic()
+        self.outcome: Optional[str] = None
+        self.latency = 0.0
+        self.retry_after: Optional[float] = None
+
+    def observe(self, status_code: int, retry_after: Optional[str] = None):
+        """
+        上报上游的响应状态（收到响应头时调用，延迟按此时计算）
+
+        Args:
+            status_code: 上游响应状态码
+            retry_after: 上游返回的 Retry-After 头
+        """
+        self.latency = time.monotonic() - self._started
+        if status_code in (429, 503):
+            self.outcome = 'throttled'
+            try:
+                self.retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                self.retry_after = None
+        elif status_code >= 500:
+            self.outcome = 'error'
+        elif status_code >= 400:
+            # 请求本身的错误（参数、鉴权等）很快返回，不能作为延迟基线
+            self.outcome = 'rejected'
+        else:
+            self.outcome = 'ok'
+
+
+class AdmissionController:
+    """一个上游的并发上限、优先级等待队列和自适应限流"""
+
+    def __init__(self, name: str, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 32,
+                 max_queue: int = 32, queue_timeout: float = 10, lane_timeouts: Optional[Dict[str, float]] = None,
+                 latency_tolerance: float = 2.5, decrease_factor: float = 0.7,
+                 timeout_exceptions: Tuple[Type[BaseException], ...] = (TimeoutError,)):
+        """
+        Args:
+            name: 上游名称
+            initial_limit: 初始并发上限
+            min_limit: 并发上限的下限
+            max_limit: 并发上限的上限
+            max_queue: 等待队列长度，0 表示不排队
+            queue_timeout: 默认最长等待时间（秒）
+            lane_timeouts: 各通道的最长等待时间（秒）
+            latency_tolerance: 延迟超过基线的倍数时视为拥塞
+            decrease_factor: 拥塞时并发上限的缩小比例
+            timeout_exceptions: 视为上游超时的异常类型（也检查由其转换而来的异常）
+        """
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.lane_timeouts = lane_timeouts or {}
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.timeout_exceptions = timeout_exceptions
+
+        self._limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = 0
+        # 各通道的延迟基线（近期最低延迟，逐渐上浮以适应变化）和指数加权平均延迟
+        self._baseline: Dict[str, float] = {}
+        self._latency: Dict[str, float] = {}
+        self._last_decrease = 0.0
+        self._retry_after_until = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "expired": 0, "evicted": 0,
+                      "throttled": 0, "timeouts": 0, "decreases": 0}
+
+    @property
+    def limit(self) -> int:
+        """当前并发上限"""
+        return int(self._limit)
+
+    def _retry_after(self, lane: str) -> float:
+        # 调用时持有 self._lock：按队列长度和该通道的平均延迟估算，不早于上游要求的重试时间
+        latency = self._latency.get(lane, 1.0)
+        estimate = (len(self._waiters) + 1) / max(self._limit, 1) * latency
+        return max(estimate, self._retry_after_until - time.monotonic(), 1)
+
+    def _dispatch(self):
+        # 调用时持有 self._lock：按优先级和先后顺序放行等待者
+        while self._waiters and self._in_flight < int(self._limit):
+            waiter = min(self._waiters, key=lambda w: (w.priority, w.seq))
+            self._waiters.remove(waiter)
+            waiter.admitted = True
+            self._in_flight += 1
+            self.stats["admitted"] += 1
+            waiter.event.set()
+
+    def acquire(self, lane: str, timeout: Optional[float] = None):
+        """
+        获取一个上游调用名额，必要时排队等待
+
+        Args:
+            lane: 通道（chat/stt/tts）
+            timeout: 最长等待时间（秒），默认按通道配置
+
+        Raises:
+            AdmissionRejected: 队列已满或等待超时
+        """
+        priority = LANES.get(lane, len(LANES))
+        with self._lock:
+            # 有人排队时新请求不能插队
+            if not self._waiters and self._in_flight < int(self._limit):
+                self._in_flight += 1
+                self.stats["admitted"] += 1
+                return
+
+            if len(self._waiters) >= self.max_queue:
+                # 队列已满：挤掉优先级更低的等待者中最晚到的一个，没有时拒绝本请求
+                lower = [w for w in self._waiters if w.priority > priority]
+                if not lower:
+                    self.stats["shed"] += 1
+                    raise AdmissionRejected(f'上游 {self.name} 繁忙，请稍后重试', self._retry_after(lane))
+                victim = max(lower, key=lambda w: (w.priority, w.seq))
+                self._waiters.remove(victim)
+                victim.evicted = True
+                self.stats["evicted"] += 1
+                victim.event.set()
+
+            self._seq += 1
+            waiter = _Waiter(lane, priority, self._seq)
+            self._waiters.append(waiter)
+            self.stats["queued"] += 1
+
+        wait = timeout if timeout is not None else self.lane_timeouts.get(lane, self.queue_timeout)
+        waiter.event.wait(wait)
+        with self._lock:
+            if waiter.admitted:
+                return
+            if not waiter.evicted:
+                self._waiters.remove(waiter)
+                self.stats["expired"] += 1
+            retry_after = self._retry_after(lane)
+        raise AdmissionRejected(f'上游 {self.name} 繁忙，请稍后重试', retry_after)
+
+    def try_acquire(self, lane: str) -> bool:
+        """
+        不排队地获取名额：只有没人排队且有空闲名额时才成功，不会挤掉任何等待者
+
+        Args:
+            lane: 通道（chat/stt/tts）
+
+        Returns:
+            是否获取到名额
+        """
+        with self._lock:
+            if not self._waiters and self._in_flight < int(self._limit):
+                self._in_flight += 1
+                self.stats["admitted"] += 1
+                return True
+            self.stats["shed"] += 1
+            return False
+
+    def release(self, outcome: str, latency: float = 0.0, retry_after: Optional[float] = None,
+                lane: str = 'chat'):
+        """
+        归还名额并根据调用结果调整并发上限
+
+        Args:
+            outcome: ok / rejected（4xx）/ throttled / timeout / error
+            latency: 上游响应延迟（秒）
+            retry_after: 上游要求的重试等待时间（秒）
+            lane: 通道，延迟只与同一通道的基线比较
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._in_flight -= 1
+            congested = outcome in ('throttled', 'timeout')
+            if outcome == 'throttled':
+                self.stats["throttled"] += 1
+                if retry_after:
+                    self._retry_after_until = max(self._retry_after_until, now + retry_after)
+            elif outcome == 'timeout':
+                self.stats["timeouts"] += 1
+            elif outcome == 'ok' and latency > 0:
+                baseline = self._baseline.get(lane)
+                average = self._latency.get(lane)
+                baseline = self._baseline[lane] = latency if baseline is None else min(latency, baseline * 1.01)
+                average = self._latency[lane] = latency if average is None else average * 0.9 + latency * 0.1
+                congested = average > max(baseline * self.latency_tolerance, MIN_CONGESTION_LATENCY)
+
+            if congested:
+                # 每个往返时间内最多减小一次，避免同一波拥塞连续触发
+                if now - self._last_decrease >= self._latency.get(lane, 1.0):
+                    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                    self._last_decrease = now
+                    self.stats["decreases"] += 1
+            elif outcome == 'ok':
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, lane: str, timeout: Optional[float] = None, block: bool = True) -> Iterator[Slot]:
+        """
+        在名额内执行一次上游调用：
+            with controller.slot('chat') as slot:
+                response = requests.post(...)
+                slot.observe(response.status_code, response.headers.get('Retry-After'))
+
+        block 为 False 时不排队（见 try_acquire），没有空闲名额立即抛出 AdmissionRejected
+        """
+        if block:
+            self.acquire(lane, timeout)
+        elif not self.try_acquire(lane):
+            with self._lock:
+                retry_after = self._retry_after(lane)
+            raise AdmissionRejected(f'上游 {self.name} 繁忙，请稍后重试', retry_after)
+        slot = Slot()
+        try:
+            yield slot
+        except BaseException as e:
+            if slot.outcome is None:
+                slot.latency = time.monotonic() - slot._started
+                timed_out = isinstance(e, self.timeout_exceptions) or \
+                    isinstance(e.__context__, self.timeout_exceptions)
+                slot.outcome = 'timeout' if timed_out else 'error'
+            raise
+        finally:
+            self.release(slot.outcome or 'ok', slot.latency or time.monotonic() - slot._started,
+                         slot.retry_after, lane)
+
+    def info(self) -> Dict[str, Any]:
+        """接入控制状态"""
+        with self._lock:
+            lanes = {lane: 0 for lane in LANES}
+            for waiter in self._waiters:
+                lanes[waiter.lane] = lanes.get(waiter.lane, 0) + 1
+            return {
+                **self.stats,
+                'limit': int(self._limit),
+                'in_flight': self._in_flight,
+                'waiting': lanes,
+                'latency_ms': {lane: round(value * 1000) for lane, value in self._latency.items()},
+                'baseline_ms': {lane: round(value * 1000) for lane, value in self._baseline.items()},
+            }
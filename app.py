@@ -1,5 +1,9 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
+try:
+    from flask_sock import Sock
+except ImportError:  # 流式语音识别（WebSocket）为可选功能
+    Sock = None
 import requests
 import os
 import uuid
@@ -7,20 +11,94 @@ import logging
 import json
 import base64
 import io
-import tempfile
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import shutil
+import threading
+import time
+import hashlib
+import hmac
+import mimetypes
+from functools import wraps
+from urllib.parse import quote
+from werkzeug.http import is_resource_modified
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # 导入数据管理器
 from data.data_manager import data_manager
+from data.ndjson_io import EXPORT_MODES, ImportValidationError, export_conversations, import_ndjson
+from data.retention import RetentionPolicy, RetentionSweeper
+from data.avatar_variants import AvatarVariantPipeline, VARIANT_FORMATS
+from data.avatar_store import AvatarBlobStore
+from data.avatar_uploads import AvatarUploadError, AvatarUploadStream
+from data.role_catalog import RoleCatalog
+from data.role_repository import RoleRepository
+from data.voice_map import default_voice_for_character, is_valid_voice, VOICES
+from compression import Compression
+from audio_processing import AudioPreprocessor
+from stt_backends import TranscriptionError, create_stt_backend, stt_backend_options
+from voice_stream import StreamingTranscriber
+from admission import AdmissionController, AdmissionRejected
+from endpoints import EndpointPool
+from hedging import HedgeLost, HedgePolicy, hedged_call
+from upstream import SingleFlight, StreamFlight, TTLCache, cached_call, request_key
+from tts_formats import TTS_FORMATS, TTS_MODELS, TTSModelSelector, negotiate_bitrate, negotiate_format
+from concurrent.futures import ThreadPoolExecutor
+from frontend import Frontend
 
 # 加载环境变量
 load_dotenv('config.env')
 
+# 接收头像上传的接口：上传文件边读边校验，超过上限立即中断
+AVATAR_UPLOAD_ENDPOINTS = {'create_custom_character', 'update_custom_character'}
+AVATAR_MAX_UPLOAD_BYTES = int(float(os.getenv('AVATAR_MAX_UPLOAD_MB', '5')) * 1024 * 1024)
+AVATAR_MAX_PIXELS = int(os.getenv('AVATAR_MAX_PIXELS', '40000000'))
+
+class UploadRequest(Request):
+    """
+    为头像上传接口提供限制大小、识别格式并计算哈希的上传流，其余接口使用默认实现
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint not in AVATAR_UPLOAD_ENDPOINTS:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        
+        # 请求体明显超过上限时直接拒绝，不再读取（预留64KB给其他表单字段）
+        if total_content_length and total_content_length > AVATAR_MAX_UPLOAD_BYTES + 64 * 1024:
+            raise AvatarUploadError(f"头像文件不能超过 {AVATAR_MAX_UPLOAD_BYTES // (1024 * 1024)}MB", 413)
+        
+        stream = AvatarUploadStream(UPLOAD_FOLDER, AVATAR_MAX_UPLOAD_BYTES, AVATAR_MAX_PIXELS)
+        # 解析中途出错时文件不会出现在 request.files 中，需要单独记录以便清理临时文件
+        if not hasattr(self, '_avatar_streams'):
+            self._avatar_streams = []
+        self._avatar_streams.append(stream)
+        return stream
+    
+    def close(self):
+        super().close()
+        for stream in getattr(self, '_avatar_streams', ()):
+            stream.close()
+
 app = Flask(__name__)
-CORS(app)  # 允许跨域请求
+app.request_class = UploadRequest
+# 允许跨域请求（页面由本服务提供时为同源请求；跨域部署时缓存预检结果一天）
+CORS(app, max_age=86400, expose_headers=['X-TTS-Model', 'X-TTS-Format', 'X-TTS-Bitrate', 'X-TTS-Cache'])
+# WebSocket 支持（安装 flask-sock 后启用 /api/voice/stream）
+sock = Sock(app) if Sock is not None else None
+
+# 响应压缩（gzip，安装 brotli 后优先使用 br）
+compression = Compression(
+    app,
+    min_size=int(os.getenv('COMPRESSION_MIN_BYTES', '1024')),
+    level=int(os.getenv('COMPRESSION_LEVEL', '6'))
+)
+
+# 前端页面：GET / 提供 0.1版本.html，内联样式和脚本拆分为可永久缓存的带指纹资源
+frontend = Frontend(
+    app,
+    inline_css=os.getenv('FRONTEND_INLINE_CSS', 'false').lower() == 'true',
+    compression=compression
+)
 
 # 配置文件上传
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
@@ -30,6 +108,35 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 # 确保上传文件夹存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# 头像文件发送方式：留空由Python直接发送；x-sendfile（Apache/lighttpd）或
+# x-accel-redirect（Nginx）时只返回头信息，由前置代理发送文件内容
+AVATAR_SENDFILE_MODE = os.getenv('AVATAR_SENDFILE_MODE', '').lower()
+AVATAR_ACCEL_REDIRECT_PREFIX = os.getenv('AVATAR_ACCEL_REDIRECT_PREFIX', '/protected-avatars/')
+# 带内容哈希的头像URL可以被永久缓存
+AVATAR_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# 头像缩略图管线（上传时预生成，请求 ?size= 时按需生成）
+avatar_variants = AvatarVariantPipeline(
+    source_dir=UPLOAD_FOLDER,
+    variants_dir=os.path.join(UPLOAD_FOLDER, 'variants'),
+    max_workers=int(os.getenv('AVATAR_VARIANT_WORKERS', '2')),
+    # 上传时规范化原图的等待上限（秒），超时按原图存储，不拖慢创建角色的请求
+    normalize_timeout=float(os.getenv('AVATAR_NORMALIZE_TIMEOUT', '2'))
+)
+
+# 内容寻址的头像存储：相同图片只保存一份，按角色引用计数，无引用的文件由后台垃圾回收清理
+avatar_store = AvatarBlobStore(
+    blob_dir=UPLOAD_FOLDER,
+    refs_file='data/avatar_refs.json',
+    on_blob_deleted=avatar_variants.remove_variants,
+    # 存入前规范化，文件名与规范化后的内容一致，相同图片的再次上传仍能去重
+    normalize=avatar_variants.normalize_file
+)
+AVATAR_GC_INTERVAL_MINUTES = float(os.getenv('AVATAR_GC_INTERVAL_MINUTES', '60'))
+AVATAR_GC_GRACE_MINUTES = float(os.getenv('AVATAR_GC_GRACE_MINUTES', '10'))
+if AVATAR_GC_INTERVAL_MINUTES > 0:
+    avatar_store.start_gc(AVATAR_GC_INTERVAL_MINUTES * 60, AVATAR_GC_GRACE_MINUTES * 60)
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -39,9 +146,238 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', 'your-openai-api-key')
 OPENAI_API_URL = os.getenv('OPENAI_API_URL', 'https://api.openai.com/v1')
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
 
+# 上游端点池：OPENAI_ENDPOINTS 可配置多个地址/Key（地址|Key|权重，逗号分隔），未配置时只使用上面的地址和Key；
+# 对话、Whisper 和 TTS 按权重的最少进行中请求选择端点，失败时熔断并换端点重试
+upstream_pool = EndpointPool.from_config(
+    os.getenv('OPENAI_ENDPOINTS', ''),
+    OPENAI_API_URL,
+    OPENAI_API_KEY,
+    failure_threshold=int(os.getenv('UPSTREAM_FAILURE_THRESHOLD', '3')),
+    open_seconds=float(os.getenv('UPSTREAM_OPEN_SECONDS', '30')),
+    max_attempts=int(os.getenv('UPSTREAM_MAX_ATTEMPTS', '2'))
+)
+
+# 上游请求合并：请求体相同（规范化后）的并发调用只发起一次，其余请求等待并共享结果；
+# 流式合成时后到的请求共享同一个数据流
+UPSTREAM_COALESCE = os.getenv('UPSTREAM_COALESCE', 'true').lower() == 'true'
+upstream_flight = SingleFlight()
+upstream_streams = StreamFlight()
+
+def coalesced_call(path, payload, fn):
+    """
+    调用上游接口，相同请求正在进行时等待其结果
+    
+    Args:
+        path: 接口路径
+        payload: 请求体
+        fn: 实际发起请求的调用
+        
+    Returns:
+        调用结果
+    """
+    if not UPSTREAM_COALESCE:
+        return fn()
+    value, shared = upstream_flight.do(request_key(path, payload), fn)
+    if shared:
+        logger.info(f"共享进行中的上游请求结果: {path}")
+    return value
+
+# 上游接入控制：限制同时进行的上游请求数（按延迟和429自适应调整），超出时按通道优先级
+# （对话 > 识别 > 合成）排队，队列满或等待超时立即返回503和Retry-After
+upstream_admission = AdmissionController(
+    'openai',
+    initial_limit=int(os.getenv('UPSTREAM_CONCURRENCY', '8')),
+    min_limit=int(os.getenv('UPSTREAM_MIN_CONCURRENCY', '1')),
+    max_limit=int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '32')),
+    max_queue=int(os.getenv('UPSTREAM_QUEUE_SIZE', '32')),
+    lane_timeouts={
+        'chat': float(os.getenv('UPSTREAM_CHAT_QUEUE_TIMEOUT', '10')),
+        'stt': float(os.getenv('UPSTREAM_STT_QUEUE_TIMEOUT', '10')),
+        'tts': float(os.getenv('UPSTREAM_TTS_QUEUE_TIMEOUT', '5')),
+    },
+    timeout_exceptions=(requests.exceptions.Timeout,)
+)
+
+# 对话请求对冲（可选）：主请求在最近首字节时间的分位数内没有收到首字节时，向另一个端点再发一个相同请求，
+# 先收到首字节的一方胜出，另一方关闭连接；额外请求数不超过预算比例。启用后对话接口改为流式调用以观测首字节
+CHAT_HEDGE = os.getenv('CHAT_HEDGE', 'false').lower() == 'true'
+chat_hedge_policy = HedgePolicy(
+    percentile=float(os.getenv('CHAT_HEDGE_PERCENTILE', '95')) / 100,
+    initial_delay=float(os.getenv('CHAT_HEDGE_INITIAL_DELAY_MS', '2000')) / 1000,
+    min_delay=float(os.getenv('CHAT_HEDGE_MIN_DELAY_MS', '200')) / 1000,
+    max_delay=float(os.getenv('CHAT_HEDGE_MAX_DELAY_MS', '10000')) / 1000,
+    budget_ratio=float(os.getenv('CHAT_HEDGE_BUDGET_PERCENT', '5')) / 100,
+    max_inflight=int(os.getenv('CHAT_HEDGE_WORKERS', '32'))
+)
+# 只执行对冲请求（主请求在请求线程中执行），同时进行的对冲请求不超过线程数，不会在队列中积压
+chat_hedge_executor = ThreadPoolExecutor(
+    max_workers=chat_hedge_policy.max_inflight,
+    thread_name_prefix='chat-hedge'
+)
+
+def overloaded_response(e):
+    """上游繁忙时的503响应"""
+    logger.warning(f"上游繁忙，拒绝请求: {str(e)}")
+    response = jsonify({
+        'success': False,
+        'error': str(e),
+        'retry_after': e.retry_after
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# 语音识别前的音频预处理：16kHz单声道、裁掉前后静音、Opus编码（需要ffmpeg，否则只处理WAV）
+audio_preprocessor = AudioPreprocessor(
+    enabled=os.getenv('AUDIO_PREPROCESS', 'true').lower() == 'true',
+    min_bytes=int(os.getenv('AUDIO_PREPROCESS_MIN_KB', '16')) * 1024,
+    opus_bitrate=os.getenv('AUDIO_OPUS_BITRATE', '24k'),
+    ffmpeg_path=os.getenv('FFMPEG_PATH') or None
+)
+
+# 语音识别后端：openai（Whisper接口）或 local（进程内CPU推理，需要 faster-whisper）
+STT_BACKEND = os.getenv('STT_BACKEND', 'openai').lower()
+try:
+    stt_backend = create_stt_backend(
+        STT_BACKEND,
+        **stt_backend_options(STT_BACKEND),
+        **({'admission': upstream_admission, 'pool': upstream_pool} if STT_BACKEND == 'openai' else {})
+    )
+except Exception as e:
+    logger.error(f"创建语音识别后端 {STT_BACKEND} 失败，改用 openai: {str(e)}")
+    stt_backend = create_stt_backend('openai', **stt_backend_options('openai'),
+                                     admission=upstream_admission, pool=upstream_pool)
+
+# 识别结果缓存：客户端重试上传同一段录音时不再重复调用识别接口，相同录音的并发请求只调用一次
+transcription_cache = TTLCache(
+    max_entries=int(os.getenv('STT_CACHE_MAX_ENTRIES', '1024')),
+    ttl=float(os.getenv('STT_CACHE_TTL_SECONDS', '600'))
+)
+transcription_flight = SingleFlight()
+
+def transcribe_audio(audio):
+    """
+    识别预处理后的录音，按 (后端, 模型, 语言, 原始上传音频哈希) 复用结果
+    （预处理后的编码结果不一定逐字节稳定，不能作为键）；空结果不缓存
+    
+    Args:
+        audio: 音频预处理结果
+        
+    Returns:
+        (识别文本, 来源)，来源为 cache、shared 或 upstream
+    """
+    key = (stt_backend.name, stt_backend.model, stt_backend.language, audio.source_digest)
+    return cached_call(
+        transcription_cache,
+        transcription_flight,
+        key,
+        lambda: stt_backend.transcribe(audio.data, audio.filename, audio.content_type),
+        should_cache=bool
+    )
+
+# 语音合成：未指定模型时按延迟预算选择（tts-1-hd 的预计耗时在预算内才使用）
+tts_model_selector = TTSModelSelector(default_budget_ms=float(os.getenv('TTS_LATENCY_BUDGET_MS', '0')))
+
+# 合成结果缓存：按 (模型, 声音, 格式, 码率, 文本哈希) 缓存，同一条回复重复播放时不再调用合成接口
+tts_cache = TTLCache(
+    max_entries=int(os.getenv('TTS_CACHE_MAX_ENTRIES', '256')),
+    ttl=float(os.getenv('TTS_CACHE_TTL_SECONDS', '3600')),
+    max_bytes=int(float(os.getenv('TTS_CACHE_MAX_MB', '64')) * 1024 * 1024),
+    size_of=len
+)
+
+def tts_cache_key(text, voice, model, audio_format, bitrate=None):
+    """合成结果的缓存键（协商得到的格式和码率是键的一部分）"""
+    return (model, voice, audio_format, bitrate, hashlib.sha256(text.encode('utf-8')).hexdigest())
+
+def synthesize_speech(text, voice, model, audio_format='mp3', bitrate=None):
+    """
+    合成语音，优先使用缓存
+    
+    Args:
+        text: 文本
+        voice: 声音
+        model: 合成模型
+        audio_format: 输出格式
+        bitrate: 目标码率（需要 ffmpeg 转码），None 表示上游默认码率
+        
+    Returns:
+        (音频数据, 来源)，来源为 cache 或 upstream
+    """
+    key = tts_cache_key(text, voice, model, audio_format, bitrate)
+    cached = tts_cache.get(key)
+    if cached is not None:
+        return cached, 'cache'
+    
+    started = time.perf_counter()
+    audio_data = call_tts_api(text, voice, model, audio_format)
+    tts_model_selector.observe(model, len(text), (time.perf_counter() - started) * 1000)
+    if bitrate:
+        transcoded = audio_preprocessor.transcode(audio_data, audio_format, bitrate)
+        if transcoded is None:
+            # 转码失败时返回上游原始码率的音频，不写入该码率的缓存
+            return audio_data, 'upstream'
+        audio_data = transcoded
+    tts_cache.set(key, audio_data)
+    return audio_data, 'upstream'
+
+# 流式语音识别：中间结果的识别在共享线程池中进行（每个会话同时最多一个）
+VOICE_STREAM_PARTIAL_INTERVAL = float(os.getenv('VOICE_STREAM_PARTIAL_INTERVAL', '1.0'))
+VOICE_STREAM_WINDOW_SECONDS = float(os.getenv('VOICE_STREAM_WINDOW_SECONDS', '12'))
+VOICE_STREAM_MAX_SECONDS = float(os.getenv('VOICE_STREAM_MAX_SECONDS', '120'))
+VOICE_STREAM_IDLE_TIMEOUT = float(os.getenv('VOICE_STREAM_IDLE_TIMEOUT', '30'))
+voice_stream_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('VOICE_STREAM_WORKERS', '4')),
+    thread_name_prefix='voice-stream'
+)
+
+# 备份配置（间隔为0表示不启用定时备份）
+BACKUP_INTERVAL_MINUTES = float(os.getenv('BACKUP_INTERVAL_MINUTES', '0'))
+if BACKUP_INTERVAL_MINUTES > 0:
+    data_manager.start_backup_scheduler(BACKUP_INTERVAL_MINUTES * 60)
+
+# 对话保留策略配置（天数或条数为0表示不限制，清理间隔为0表示不启用后台清理）
+retention_policy = RetentionPolicy(
+    ttl_days={
+        'anonymous': float(os.getenv('RETENTION_TTL_ANONYMOUS_DAYS', '30')),
+        'registered': float(os.getenv('RETENTION_TTL_REGISTERED_DAYS', '0'))
+    },
+    max_messages=int(os.getenv('RETENTION_MAX_MESSAGES', '0')),
+    archive_idle_days=float(os.getenv('RETENTION_ARCHIVE_IDLE_DAYS', '0'))
+)
+retention_sweeper = RetentionSweeper(data_manager, retention_policy)
+RETENTION_SWEEP_INTERVAL_MINUTES = float(os.getenv('RETENTION_SWEEP_INTERVAL_MINUTES', '0'))
+if RETENTION_SWEEP_INTERVAL_MINUTES > 0:
+    retention_sweeper.start(RETENTION_SWEEP_INTERVAL_MINUTES * 60)
+
 # 注意：现在使用文件存储替代内存存储
 # conversations 和 custom_roles 变量已移除，改用 data_manager
 
+# 管理接口（批量导入导出、保留策略清理、头像补齐和回收）需要管理令牌，未配置时这些接口不可用
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')
+
+def require_admin(view):
+    """
+    管理接口鉴权：请求头 Authorization: Bearer <令牌> 或 X-Admin-Token: <令牌>
+    未配置 ADMIN_API_TOKEN 时返回404，令牌错误时返回401
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_API_TOKEN:
+            return jsonify({
+                'success': False,
+                'error': '管理接口未启用（需要配置 ADMIN_API_TOKEN）'
+            }), 404
+        auth = request.headers.get('Authorization', '')
+        token = auth[7:] if auth.startswith('Bearer ') else request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), ADMIN_API_TOKEN.encode('utf-8')):
+            return jsonify({
+                'success': False,
+                'error': '管理令牌无效'
+            }), 401
+        return view(*args, **kwargs)
+    return wrapper
+
 def allowed_file(filename):
     """检查文件扩展名是否允许"""
     if not filename or '.' not in filename:
@@ -52,55 +388,120 @@ def allowed_file(filename):
     except IndexError:
         return False
 
-def save_uploaded_avatar(file, role_name):
-    """保存上传的头像文件"""
-    if file and allowed_file(file.filename):
-        # 先从原始文件名获取扩展名，因为secure_filename可能会移除它
-        original_filename = file.filename
-        if '.' in original_filename:
-            file_ext = original_filename.rsplit('.', 1)[1].lower()
-        else:
-            # 如果没有扩展名，根据MIME类型推断
-            mime_type = file.content_type
-            if mime_type == 'image/jpeg':
-                file_ext = 'jpg'
-            elif mime_type == 'image/png':
-                file_ext = 'png'
-            elif mime_type == 'image/gif':
-                file_ext = 'gif'
-            elif mime_type == 'image/webp':
-                file_ext = 'webp'
-            else:
-                file_ext = 'jpg'  # 默认使用jpg
-        
-        # 处理角色名称，保留中文字符但确保安全
-        # 移除或替换不安全的字符，但保留中文
-        import re
-        safe_role_name = re.sub(r'[<>:"/\\|?*]', '_', role_name)
-        safe_role_name = safe_role_name.strip()
-        
-        # 如果角色名称为空或只包含特殊字符，使用默认名称
-        if not safe_role_name or safe_role_name == '_':
-            safe_role_name = '角色'
-        
-        new_filename = f"{safe_role_name}.{file_ext}"
-        
-        # 确保文件名唯一
-        file_path = os.path.join(UPLOAD_FOLDER, new_filename)
-        counter = 1
-        while os.path.exists(file_path):
-            new_filename = f"{safe_role_name}_{counter}.{file_ext}"
-            file_path = os.path.join(UPLOAD_FOLDER, new_filename)
-            counter += 1
-        
-        # 保存文件
-        file.save(file_path)
-        logger.info(f"头像文件已保存: {file_path}")
-        
-        # 返回相对路径，用于存储到数据库
-        return f"data/pic/{new_filename}"
+def save_uploaded_avatar(file, role_id):
+    """
+    保存上传的头像文件到内容寻址存储，并记录角色对该文件的引用
+    存入前规范化（转正、缩放、去除元数据），缩略图在后台线程池中生成
+    
+    Args:
+        file: 上传的文件对象
+        role_id: 引用该头像的角色ID
+    
+    Returns:
+        头像相对路径，文件格式不支持时返回None
     
-    return None
+    Raises:
+        AvatarUploadError: 上传文件为空、格式不支持或已损坏
+    """
+    if not file:
+        return None
+    
+    stream = file.stream
+    if isinstance(stream, AvatarUploadStream):
+        # 上传时已完成格式识别和哈希计算，临时文件直接重命名为存储文件
+        stream.finish()
+        image_path, created = avatar_store.put_file(stream.path, stream.blob_name, role_id)
+        if created:
+            stream.detach()
+    elif allowed_file(file.filename):
+        file_ext = file.filename.rsplit('.', 1)[1].lower()
+        image_path, created = avatar_store.put(stream, file_ext, role_id)
+    else:
+        return None
+    
+    filename = image_path.split('/')[-1]
+    if created:
+        logger.info(f"头像文件已保存: {image_path}")
+        avatar_variants.generate_async(filename)
+    else:
+        logger.info(f"头像文件已存在，复用: {image_path}")
+    
+    # 返回相对路径，用于存储到数据库
+    return image_path
+
+# 文件内容哈希缓存：路径 -> ((修改时间, 大小), 哈希)
+_file_hash_cache = {}
+
+def get_file_content_hash(file_path):
+    """
+    获取文件内容哈希（sha256前16位），文件未变化时直接使用缓存
+    """
+    stat = os.stat(file_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_hash_cache.get(file_path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()[:16]
+    _file_hash_cache[file_path] = (signature, content_hash)
+    return content_hash
+
+def build_avatar_url(image_path):
+    """
+    为本地头像生成带内容哈希的URL（内容变化则URL变化，可被永久缓存）
+    """
+    if not image_path or not image_path.startswith('data/pic/'):
+        return None
+    filename = image_path.split('/')[-1]
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+    if not os.path.isfile(file_path):
+        return None
+    return f"/api/avatar/{quote(filename)}?v={get_file_content_hash(file_path)}"
+
+def with_avatar_url(role):
+    """
+    序列化角色对象并附带 avatar_url 字段
+    """
+    data = role.to_dict()
+    data['avatar_url'] = build_avatar_url(role.image)
+    return data
+
+def send_avatar_file(file_path, mimetype=None, immutable=False):
+    """
+    发送头像文件：强ETag + Last-Modified 条件请求，可选交给前置代理发送文件内容
+    """
+    content_hash = get_file_content_hash(file_path)
+    last_modified = datetime.utcfromtimestamp(int(os.path.getmtime(file_path)))
+    mimetype = mimetype or mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    
+    if not is_resource_modified(request.environ, etag=content_hash, last_modified=last_modified):
+        response = app.response_class(status=304)
+    elif AVATAR_SENDFILE_MODE == 'x-accel-redirect':
+        relative_path = os.path.relpath(file_path, UPLOAD_FOLDER).replace(os.sep, '/')
+        response = app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = AVATAR_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(relative_path)
+    elif AVATAR_SENDFILE_MODE == 'x-sendfile':
+        response = app.response_class(mimetype=mimetype)
+        # 头信息只能是latin-1，中文文件名需要转义（mod_xsendfile 默认会还原）
+        response.headers['X-Sendfile'] = quote(os.path.abspath(file_path))
+    else:
+        response = send_file(file_path, mimetype=mimetype, conditional=False, etag=False)
+    
+    response.set_etag(content_hash)
+    response.last_modified = last_modified
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = AVATAR_IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # 未带版本号的URL每次都需要重新验证（命中时返回304）
+        response.cache_control.no_cache = True
+    return response
 
 # 角色库数据（与前端保持一致）
 ROLE_LIBRARY = [
@@ -399,8 +800,15 @@ def transcribe_voice():
         
         logger.info(f"收到语音转文本请求 - 角色: {role_name}, 文件: {audio_file.filename}")
         
-        # 调用OpenAI Whisper API进行语音转文本
-        transcription = call_whisper_api(audio_file)
+        # 预处理录音（转码、裁掉静音），很小的录音原样上传
+        audio = audio_preprocessor.process(audio_file.read(), audio_file.filename, audio_file.content_type)
+        if audio.applied:
+            logger.info(f"音频预处理: {audio.original_bytes} -> {len(audio.data)} bytes"
+                        f"（节省 {audio.saved_bytes} bytes，裁掉静音 {audio.trimmed_ms}ms）")
+        
+        # 调用配置的语音识别后端（相同录音复用已有结果）
+        transcription, source = transcribe_audio(audio)
+        logger.info(f"语音转文本成功（{source}）: {transcription[:50]}...")
         
         if transcription:
             return jsonify({
@@ -408,7 +816,9 @@ def transcribe_voice():
                 'transcription': transcription,
                 'role_id': role_id,
                 'role_name': role_name,
-                'role_description': role_description
+                'role_description': role_description,
+                'audio': audio.to_dict(),
+                'cached': source != 'upstream'
             })
         else:
             return jsonify({
@@ -416,6 +826,14 @@ def transcribe_voice():
                 'error': '语音转文本失败'
             }), 500
             
+    except AdmissionRejected as e:
+        return overloaded_response(e)
+    except TranscriptionError as e:
+        logger.error(f"语音转文本错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status_code
     except Exception as e:
         logger.error(f"语音转文本错误: {str(e)}")
         return jsonify({
@@ -423,11 +841,243 @@ def transcribe_voice():
             'error': str(e)
         }), 500
 
+def voice_stream(ws):
+    """
+    流式语音识别（WebSocket /api/voice/stream）
+    1. 客户端先发送JSON文本消息：
+       {"type": "start", "format": "pcm16", "sample_rate": 16000, "role_id": "...",
+        "conversation_id": "...", "user_id": "...", "character_name": "...", "chat": true}
+       format 为 pcm16（16位小端单声道PCM）或 webm/ogg/mp4（MediaRecorder 分片）
+    2. 说话期间持续发送二进制音频块，服务端返回 {"type": "partial", "text": "..."}
+    3. 说完发送 {"type": "stop"}，服务端返回 {"type": "final", "text": "..."}；
+       chat 不为 false 时直接把识别结果交给对话流程，返回 {"type": "reply", ...}（字段同 /api/chat）
+    发送 {"type": "cancel"} 放弃本次录音；出错时返回 {"type": "error", "error": "...", "status": 状态码}
+    """
+    send_lock = threading.Lock()
+    
+    def send(message):
+        with send_lock:
+            ws.send(json.dumps(message, ensure_ascii=False))
+    
+    try:
+        start = json.loads(ws.receive(timeout=VOICE_STREAM_IDLE_TIMEOUT) or '{}')
+        if start.get('type') != 'start':
+            send({'type': 'error', 'error': '第一条消息必须是 start', 'status': 400})
+            return
+        
+        try:
+            sample_rate = int(start.get('sample_rate', 16000))
+        except (TypeError, ValueError):
+            sample_rate = 0
+        if not 8000 <= sample_rate <= 48000:
+            send({'type': 'error', 'error': 'sample_rate 必须在 8000-48000 之间', 'status': 400})
+            return
+        
+        transcriber = StreamingTranscriber(
+            lambda audio, filename, content_type: stt_backend.transcribe(audio, filename, content_type),
+            audio_format=start.get('format', 'pcm16'),
+            sample_rate=sample_rate,
+            partial_interval=VOICE_STREAM_PARTIAL_INTERVAL,
+            window_seconds=VOICE_STREAM_WINDOW_SECONDS,
+            max_seconds=VOICE_STREAM_MAX_SECONDS,
+            separator='' if os.getenv('STT_LANGUAGE', 'zh').startswith('zh') else ' '
+        )
+        logger.info(f"流式语音识别开始 - 格式: {transcriber.audio_format}, 角色ID: {start.get('role_id', '')}")
+        
+        def emit_partial():
+            try:
+                send({'type': 'partial', 'text': transcriber.partial()})
+            except Exception as e:
+                logger.warning(f"流式语音识别中间结果失败: {str(e)}")
+        
+        pending = None
+        while True:
+            message = ws.receive(timeout=VOICE_STREAM_IDLE_TIMEOUT)
+            if message is None:
+                send({'type': 'error', 'error': '等待音频超时', 'status': 408})
+                return
+            if isinstance(message, (bytes, bytearray)):
+                if transcriber.feed(message) and (pending is None or pending.done()):
+                    pending = voice_stream_executor.submit(emit_partial)
+                continue
+            
+            control = json.loads(message)
+            if control.get('type') == 'cancel':
+                return
+            if control.get('type') == 'stop':
+                break
+        
+        # 等正在进行的中间识别结束，避免 final 之后又收到 partial
+        if pending is not None:
+            pending.result()
+        text = transcriber.finish()
+        send({'type': 'final', 'text': text, 'duration': transcriber.duration, 'partials': transcriber.partials})
+        logger.info(f"流式语音识别完成: {text[:50]}...")
+        
+        if text and start.get('chat', True):
+            result = run_chat_turn(
+                text,
+                start.get('character_name', '小助手'),
+                start.get('character_description', '你是一个友善、乐于助人的AI助手'),
+                start.get('role_id', ''),
+                start.get('conversation_id', ''),
+                start.get('user_id')
+            )
+            send({'type': 'reply', 'transcription': text, **result})
+    
+    except (TranscriptionError, AdmissionRejected) as e:
+        logger.error(f"流式语音识别错误: {str(e)}")
+        send({'type': 'error', 'error': str(e), 'status': e.status_code,
+              'retry_after': getattr(e, 'retry_after', None)})
+    except ValueError as e:
+        send({'type': 'error', 'error': str(e), 'status': 400})
+    except Exception as e:
+        # 客户端断开连接等
+        logger.error(f"流式语音识别错误: {str(e)}")
+        try:
+            send({'type': 'error', 'error': str(e), 'status': 500})
+        except Exception:
+            pass
+
+if sock is not None:
+    sock.route('/api/voice/stream')(voice_stream)
+else:
+    logger.warning("未安装 flask-sock，流式语音识别接口 /api/voice/stream 未启用")
+
+@app.route('/api/voice/turn', methods=['POST'])
+def voice_turn():
+    """
+    一次请求完成一轮语音对话：语音识别 → 角色回复 → 语音合成
+    表单参数：
+    - file: 录音文件
+    - role_id / character_name / character_description: 角色信息
+    - conversation_id / user_id: 对话信息（可选）
+    - tts: 是否合成回复语音（默认true）
+    - tts_model: 语音合成模型（默认tts-1，auto 为按 TTS_LATENCY_BUDGET_MS 选择）
+    - tts_format: 回复语音格式（mp3/opus/aac/flac/wav/pcm，默认mp3）
+    返回 NDJSON 流，每个阶段完成后立即输出一行（识别结果可以先显示）：
+    - {"type": "transcript", "transcription": "...", "audio": {...}}
+    - {"type": "reply", ...}（字段同 /api/chat）
+    - {"type": "audio", "format": "mp3", "model": "tts-1", "voice": "...", "data": "<base64>"}
+    - {"type": "done", "timings": {"preprocess_ms", "stt_ms", "chat_ms", "tts_ms", "total_ms"}}
+    出错时输出 {"type": "error", "stage": "stt|chat|tts", "error": "...", "status": 状态码} 并结束
+    （合成失败时已输出的识别结果和回复仍然有效）
+    """
+    started = time.perf_counter()
+    try:
+        audio_file = request.files.get('file')
+        if not audio_file or audio_file.filename == '':
+            return jsonify({
+                'success': False,
+                'error': '没有上传音频文件'
+            }), 400
+        
+        audio_data = audio_file.read()
+        filename, content_type = audio_file.filename, audio_file.content_type
+        form = request.form.to_dict()
+    except RequestEntityTooLarge:
+        return jsonify({
+            'success': False,
+            'error': '请求数据过大'
+        }), 413
+    
+    with_tts = form.get('tts', 'true').lower() != 'false'
+    tts_model = form.get('tts_model', 'tts-1')
+    try:
+        tts_format = negotiate_format(form.get('tts_format'))
+        if tts_model != 'auto' and tts_model not in TTS_MODELS:
+            raise ValueError(f"不支持的语音合成模型: {tts_model}")
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    logger.info(f"收到语音对话请求 - 角色ID: {form.get('role_id', '')}, 文件: {filename}")
+    
+    def line(message):
+        return json.dumps(message, ensure_ascii=False) + '\n'
+    
+    def events():
+        timings = {}
+        
+        def elapsed_since(mark):
+            return round((time.perf_counter() - mark) * 1000, 1)
+        
+        # 语音识别
+        stage = 'stt'
+        try:
+            mark = time.perf_counter()
+            audio = audio_preprocessor.process(audio_data, filename, content_type)
+            timings['preprocess_ms'] = elapsed_since(mark)
+            
+            mark = time.perf_counter()
+            transcription, source = transcribe_audio(audio)
+            timings['stt_ms'] = elapsed_since(mark)
+            if not transcription.strip():
+                yield line({'type': 'error', 'stage': stage, 'error': '没有识别到语音', 'status': 422})
+                return
+            yield line({'type': 'transcript', 'transcription': transcription, 'audio': audio.to_dict(),
+                        'cached': source != 'upstream'})
+            
+            # 角色回复
+            stage = 'chat'
+            mark = time.perf_counter()
+            result = run_chat_turn(
+                transcription,
+                form.get('character_name', '小助手'),
+                form.get('character_description', '你是一个友善、乐于助人的AI助手'),
+                form.get('role_id', ''),
+                form.get('conversation_id', ''),
+                form.get('user_id')
+            )
+            timings['chat_ms'] = elapsed_since(mark)
+            yield line({'type': 'reply', **result})
+            
+            # 语音合成
+            if with_tts:
+                stage = 'tts'
+                mark = time.perf_counter()
+                model = tts_model_selector.choose(len(result['response'])) if tts_model == 'auto' else tts_model
+                speech, _ = synthesize_speech(result['response'], result['voice'], model, tts_format)
+                timings['tts_ms'] = elapsed_since(mark)
+                yield line({
+                    'type': 'audio',
+                    'format': tts_format,
+                    'model': model,
+                    'voice': result['voice'],
+                    'data': base64.b64encode(speech).decode('ascii')
+                })
+        except Exception as e:
+            logger.error(f"语音对话错误（{stage}）: {str(e)}")
+            status = e.status_code if isinstance(e, (TranscriptionError, AdmissionRejected)) else 500
+            event = {'type': 'error', 'stage': stage, 'error': str(e), 'status': status, 'timings': timings}
+            if isinstance(e, AdmissionRejected):
+                event['retry_after'] = e.retry_after
+            yield line(event)
+            return
+        
+        timings['total_ms'] = elapsed_since(started)
+        logger.info(f"语音对话完成，耗时: {timings}")
+        yield line({'type': 'done', 'timings': timings})
+    
+    response = Response(stream_with_context(events()), mimetype='application/x-ndjson')
+    # 每个阶段的结果需要立即送达，不经过压缩缓冲（音频的base64本身也难以压缩）
+    response.headers['Cache-Control'] = 'no-store, no-transform'
+    return response
+
 @app.route('/api/voice/synthesize', methods=['POST'])
 def synthesize_voice():
     """
     文本转语音API端点
-    接收文本并转换为语音文件
+    接收文本并转换为语音，音频直接作为响应体返回（可直接播放）
+    请求参数（JSON，format/bitrate 也可放在查询字符串中）：
+    - text: 文本
+    - voice: 声音（默认alloy）
+    - model: tts-1 或 tts-1-hd；不指定（或为auto）时按 latency_budget_ms 选择
+    - latency_budget_ms: 延迟预算（毫秒），预计在预算内完成时使用 tts-1-hd
+    - format: mp3/opus/aac/flac/wav/pcm；不指定时按 Accept 头协商，默认mp3
+    - bitrate: mp3/opus/aac 的码率（如32k，需要ffmpeg）；客户端发送 Save-Data: on 时默认使用省流量码率
+    - stream: 是否边合成边返回（pcm 默认开启）
     """
     try:
         data = request.get_json()
@@ -439,7 +1089,6 @@ def synthesize_voice():
         
         text = data.get('text', '')
         voice = data.get('voice', 'alloy')  # 默认使用alloy声音
-        model = data.get('model', 'tts-1')  # 默认使用tts-1模型
         
         if not text:
             return jsonify({
@@ -447,29 +1096,80 @@ def synthesize_voice():
                 'error': '文本内容不能为空'
             }), 400
         
-        logger.info(f"收到文本转语音请求 - 文本: {text[:50]}..., 声音: {voice}")
+        save_data = request.headers.get('Save-Data', '').lower() == 'on'
+        try:
+            audio_format = negotiate_format(data.get('format') or request.args.get('format'),
+                                            request.accept_mimetypes, save_data)
+            bitrate = negotiate_bitrate(data.get('bitrate') or request.args.get('bitrate'), audio_format, save_data)
+            model = data.get('model') or 'auto'
+            if model == 'auto':
+                budget = data.get('latency_budget_ms')
+                model = tts_model_selector.choose(len(text), float(budget) if budget is not None else None)
+            elif model not in TTS_MODELS:
+                raise ValueError(f"不支持的语音合成模型: {model}")
+        except (TypeError, ValueError) as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), getattr(e, 'status_code', 400)
+        if bitrate and not audio_preprocessor.ffmpeg_path:
+            bitrate = None  # 没有 ffmpeg 时无法转码，使用上游默认码率
+        stream = bool(data.get('stream', audio_format == 'pcm')) and not bitrate
+        
+        logger.info(f"收到文本转语音请求 - 文本: {text[:50]}..., 声音: {voice}, 模型: {model}, 格式: {audio_format}")
+        
+        headers = {
+            'Content-Disposition': f'inline; filename="speech.{TTS_FORMATS[audio_format]["extension"]}"',
+            'Vary': 'Accept, Save-Data',
+            'Cache-Control': 'no-store',
+            'X-TTS-Model': model,
+            'X-TTS-Format': audio_format,
+        }
+        if bitrate:
+            headers['X-TTS-Bitrate'] = bitrate
+        mimetype = TTS_FORMATS[audio_format]['mimetype']
+        
+        key = tts_cache_key(text, voice, model, audio_format, bitrate)
+        cached = tts_cache.get(key) if stream else None
+        if stream and cached is None:
+            # 边合成边返回：客户端收到第一块即可开始播放，完整结果写入缓存
+            started = time.perf_counter()
+            upstream = open_tts_stream(text, voice, model, audio_format)
+            # 先读取第一块，上游出错时仍可返回错误响应
+            first = next(upstream, b'')
+            
+            def generate():
+                chunks = [first]
+                try:
+                    yield first
+                    for chunk in upstream:
+                        chunks.append(chunk)
+                        yield chunk
+                finally:
+                    upstream.close()
+                tts_model_selector.observe(model, len(text), (time.perf_counter() - started) * 1000)
+                tts_cache.set(key, b''.join(chunks))
+            
+            headers['X-TTS-Cache'] = 'miss'
+            return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
         
-        # 调用OpenAI TTS API进行文本转语音
-        audio_data = call_tts_api(text, voice, model)
+        if cached is not None:
+            audio_data, source = cached, 'cache'
+        else:
+            # 调用OpenAI TTS API进行文本转语音
+            audio_data, source = synthesize_speech(text, voice, model, audio_format, bitrate)
         
         if audio_data:
-            # 创建临时文件保存音频数据
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_file:
-                temp_file.write(audio_data)
-                temp_file.flush()
-                
-                return send_file(
-                    temp_file.name,
-                    as_attachment=True,
-                    download_name='ai_response.mp3',
-                    mimetype='audio/mpeg'
-                )
+            headers['X-TTS-Cache'] = 'hit' if source == 'cache' else 'miss'
+            return Response(audio_data, mimetype=mimetype, headers=headers)
         else:
             return jsonify({
                 'success': False,
                 'error': '文本转语音失败'
             }), 500
             
+    except AdmissionRejected as e:
+        return overloaded_response(e)
     except Exception as e:
         logger.error(f"文本转语音错误: {str(e)}")
         return jsonify({
@@ -477,6 +1177,71 @@ def synthesize_voice():
             'error': str(e)
         }), 500
 
+def run_chat_turn(user_message, character_name='小助手', character_description='你是一个友善、乐于助人的AI助手',
+                  role_id='', conversation_id='', user_id=None):
+    """
+    处理一轮对话：确定角色、必要时创建对话、调用模型并保存对话历史
+    供 /api/chat 和语音接口共用
+    
+    Args:
+        user_message: 用户输入的文本
+        character_name: 角色名称
+        character_description: 角色描述
+        role_id: 角色ID（提供时以角色库中的信息为准）
+        conversation_id: 对话ID（为空或不存在时创建新对话）
+        user_id: 用户ID（为空时视为匿名用户）
+        
+    Returns:
+        回复及对话信息
+    """
+    # 未提供user_id的请求视为匿名用户，其对话适用匿名用户的保留策略
+    user_class = 'registered' if user_id else 'anonymous'
+    user_id = user_id or str(uuid.uuid4())
+    
+    # 如果提供了role_id，从角色库获取详细信息
+    role_info = None
+    if role_id:
+        role_info = get_role_by_id(role_id)
+        if role_info:
+            character_name = role_info.name
+            character_description = role_info.description
+            logger.info(f"使用角色库中的角色: {character_name}")
+    elif character_name:
+        role_info = get_role_by_name(character_name)
+    
+    # 如果没有提供conversation_id，创建新的对话
+    if not conversation_id:
+        conversation_id = str(uuid.uuid4())
+        data_manager.save_conversation(conversation_id, user_id, character_name, character_description, user_class)
+    # 如果conversation_id不存在，创建新的对话
+    elif not data_manager.get_conversation(conversation_id):
+        data_manager.save_conversation(conversation_id, user_id, character_name, character_description, user_class)
+    
+    logger.info(f"处理用户消息: {user_message[:50]}... (对话ID: {conversation_id})")
+    
+    # 调用OpenAI API
+    ai_response = call_openai_api(
+        user_message, 
+        character_name, 
+        character_description, 
+        conversation_id
+    )
+    
+    # 保存对话历史
+    data_manager.add_message_to_conversation(conversation_id, 'user', user_message)
+    data_manager.add_message_to_conversation(conversation_id, 'assistant', ai_response)
+    
+    return {
+        'response': ai_response,
+        'character_name': character_name,
+        'character_description': character_description,
+        'role_id': role_id,
+        'conversation_id': conversation_id,
+        'user_id': user_id,
+        # 角色的声音配置
+        'voice': role_info.voice if role_info and role_info.voice else 'alloy'
+    }
+
 @app.route('/api/chat', methods=['POST'])
 def chat_with_ai():
     """
@@ -493,10 +1258,7 @@ def chat_with_ai():
         data = request.get_json()
         user_message = data.get('message', '')
         character_name = data.get('character_name', '小助手')
-        character_description = data.get('character_description', '你是一个友善、乐于助人的AI助手')
         role_id = data.get('role_id', '')
-        conversation_id = data.get('conversation_id', '')
-        user_id = data.get('user_id', str(uuid.uuid4()))
         
         logger.info(f"收到请求 - 消息: {user_message[:50]}..., 角色: {character_name}, 角色ID: {role_id}")
         
@@ -506,58 +1268,22 @@ def chat_with_ai():
                 'error': '消息不能为空'
             }), 400
         
-        # 如果提供了role_id，从角色库获取详细信息
-        if role_id:
-            role_info = get_role_by_id(role_id)
-            if role_info:
-                character_name = role_info['name']
-                character_description = role_info['description']
-                logger.info(f"使用角色库中的角色: {character_name}")
-        
-        # 如果没有提供conversation_id，创建新的对话
-        if not conversation_id:
-            conversation_id = str(uuid.uuid4())
-            data_manager.save_conversation(conversation_id, user_id, character_name, character_description)
-        # 如果conversation_id不存在，创建新的对话
-        elif not data_manager.get_conversation(conversation_id):
-            data_manager.save_conversation(conversation_id, user_id, character_name, character_description)
-        
-        logger.info(f"处理用户消息: {user_message[:50]}... (对话ID: {conversation_id})")
-        
-        # 调用OpenAI API
-        ai_response = call_openai_api(
-            user_message, 
-            character_name, 
-            character_description, 
-            conversation_id
+        result = run_chat_turn(
+            user_message,
+            character_name,
+            data.get('character_description', '你是一个友善、乐于助人的AI助手'),
+            role_id,
+            data.get('conversation_id', ''),
+            data.get('user_id')
         )
         
-        # 保存对话历史
-        data_manager.add_message_to_conversation(conversation_id, 'user', user_message)
-        data_manager.add_message_to_conversation(conversation_id, 'assistant', ai_response)
-        
-        # 获取角色的声音配置
-        role_voice = 'alloy'  # 默认声音
-        if role_id:
-            role_info = get_role_by_id(role_id)
-            if role_info and 'voice' in role_info:
-                role_voice = role_info['voice']
-        elif character_name:
-            role_info = get_role_by_name(character_name)
-            if role_info and 'voice' in role_info:
-                role_voice = role_info['voice']
-        
         return jsonify({
             'success': True,
-            'response': ai_response,
-            'character_name': character_name,
-            'character_description': character_description,
-            'role_id': role_id,
-            'conversation_id': conversation_id,
-            'user_id': user_id,
-            'voice': role_voice  # 添加声音信息
+            **result
         })
         
+    except AdmissionRejected as e:
+        return overloaded_response(e)
     except Exception as e:
         logger.error(f"聊天处理错误: {str(e)}")
         return jsonify({
@@ -565,93 +1291,35 @@ def chat_with_ai():
             'error': str(e)
         }), 500
 
-def call_whisper_api(audio_file):
+def _post_tts(payload, slot, stream=False):
     """
-    调用OpenAI Whisper API进行语音转文本
-    """
-    try:
-        headers = {
-            'Authorization': f'Bearer {OPENAI_API_KEY}'
-        }
-        
-        # 准备文件数据
-        files = {
-            'file': (audio_file.filename, audio_file.stream, audio_file.content_type)
-        }
-        
-        data = {
-            'model': 'whisper-1',
-            'language': 'zh'  # 设置为中文
-        }
-        
-        logger.info(f"调用OpenAI Whisper API: {OPENAI_API_URL}/audio/transcriptions")
-        
-        response = requests.post(
-            f'{OPENAI_API_URL}/audio/transcriptions',
-            headers=headers,
-            files=files,
-            data=data,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            transcription = result.get('text', '')
-            logger.info(f"语音转文本成功: {transcription[:50]}...")
-            return transcription
-        else:
-            error_msg = f'Whisper API调用失败: {response.status_code} - {response.text}'
-            logger.error(error_msg)
-            raise Exception(error_msg)
-            
-    except requests.exceptions.Timeout:
-        error_msg = 'Whisper API请求超时'
-        logger.error(error_msg)
-        raise Exception(error_msg)
-    except requests.exceptions.RequestException as e:
-        error_msg = f'Whisper API网络请求失败: {str(e)}'
-        logger.error(error_msg)
-        raise Exception(error_msg)
-    except Exception as e:
-        error_msg = f'Whisper API调用错误: {str(e)}'
-        logger.error(error_msg)
-        raise Exception(error_msg)
-
-def call_tts_api(text, voice='alloy', model='tts-1'):
-    """
-    调用OpenAI TTS API进行文本转语音
+    请求OpenAI TTS API，返回状态为200的响应
+    
+    Args:
+        payload: 请求体
+        slot: 上游接入控制的名额，用于上报响应状态
+        stream: 是否流式读取响应体
     """
     try:
-        headers = {
-            'Authorization': f'Bearer {OPENAI_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        data = {
-            'model': model,
-            'input': text,
-            'voice': voice,
-            'response_format': 'mp3'
-        }
+        logger.info("调用OpenAI TTS API: /audio/speech")
         
-        logger.info(f"调用OpenAI TTS API: {OPENAI_API_URL}/audio/speech")
-        
-        response = requests.post(
-            f'{OPENAI_API_URL}/audio/speech',
-            headers=headers,
-            json=data,
-            timeout=30
+        response = upstream_pool.request(
+            'POST', '/audio/speech',
+            json=payload,
+            timeout=30,
+            stream=stream
         )
+        slot.observe(response.status_code, response.headers.get('Retry-After'))
         
         if response.status_code == 200:
-            audio_data = response.content
-            logger.info(f"文本转语音成功，音频大小: {len(audio_data)} bytes")
-            return audio_data
+            return response
         else:
             error_msg = f'TTS API调用失败: {response.status_code} - {response.text}'
             logger.error(error_msg)
             raise Exception(error_msg)
             
+    except AdmissionRejected:
+        raise
     except requests.exceptions.Timeout:
         error_msg = 'TTS API请求超时'
         logger.error(error_msg)
@@ -665,91 +1333,82 @@ def call_tts_api(text, voice='alloy', model='tts-1'):
         logger.error(error_msg)
         raise Exception(error_msg)
 
-def get_default_voice_for_character(character_name):
-    """
-    根据角色名称推断默认声音
+def call_tts_api(text, voice='alloy', model='tts-1', response_format='mp3'):
     """
-    # 女性角色常见名称关键词
-    female_keywords = ['女', '姐', '妹', '娘', '小姐', '夫人', '公主', '女王', '母', '妈']
-    # 男性角色常见名称关键词  
-    male_keywords = ['先生', '哥', '弟', '爸', '父', '王', '将军', '博士', '队长']
+    调用OpenAI TTS API进行文本转语音（相同请求并发时只调用一次）
     
-    # 女性声音池
-    female_voices = ['nova', 'shimmer', 'alloy']
-    # 男性声音池
-    male_voices = ['onyx', 'echo', 'fable']
-    
-    character_lower = character_name.lower()
-    
-    # 检查女性关键词
-    for keyword in female_keywords:
-        if keyword in character_name:
-            return female_voices[hash(character_name) % len(female_voices)]
-    
-    # 检查男性关键词
-    for keyword in male_keywords:
-        if keyword in character_name:
-            return male_voices[hash(character_name) % len(male_voices)]
+    Args:
+        text: 文本
+        voice: 声音
+        model: 合成模型
+        response_format: 输出格式（mp3/opus/aac/flac/wav/pcm）
+        
+    Returns:
+        音频数据
+    """
+    payload = {
+        'model': model,
+        'input': text,
+        'voice': voice,
+        'response_format': response_format
+    }
+    def fetch():
+        with upstream_admission.slot('tts') as slot:
+            return _post_tts(payload, slot).content
     
-    # 根据一些具体角色名称判断
-    female_names = ['三月七', '姬子', '符玄', '银狼', '托帕', '希露瓦', '艾丝妲', '卡芙卡', '流萤', '砂金', '知更鸟', 
-                   '娜塔莎·罗曼诺夫', '旺达·马克西莫夫']
-    male_names = ['哈利·波特', '苏格拉底', '开拓者', '丹恒·饮月', '景元', '星期日', '托尼·斯塔克', 
-                 '史蒂夫·罗杰斯', '索尔·奥丁森', '克林特·巴顿', '布鲁斯·班纳', '幻视', 
-                 '彼得·帕克', '特查拉', '史蒂芬·斯特兰奇']
+    audio_data = coalesced_call('/audio/speech', payload, fetch)
+    logger.info(f"文本转语音成功，格式: {response_format}，音频大小: {len(audio_data)} bytes")
+    return audio_data
+
+def open_tts_stream(text, voice='alloy', model='tts-1', response_format='pcm'):
+    """
+    以流式方式调用OpenAI TTS API，返回音频块迭代器（在第一次读取时发起请求，调用方读完或关闭）
+    相同请求正在进行时共享它的数据流，从第一块开始重放
+    """
+    payload = {
+        'model': model,
+        'input': text,
+        'voice': voice,
+        'response_format': response_format
+    }
     
-    if character_name in female_names:
-        return female_voices[hash(character_name) % len(female_voices)]
-    elif character_name in male_names:
-        return male_voices[hash(character_name) % len(male_voices)]
+    def start():
+        # 名额一直占用到数据流读完或关闭
+        with upstream_admission.slot('tts') as slot:
+            response = _post_tts(payload, slot, stream=True)
+            try:
+                yield from response.iter_content(chunk_size=8192)
+            finally:
+                response.close()
     
-    # 默认返回中性声音
-    return 'alloy'
+    if not UPSTREAM_COALESCE:
+        return start()
+    chunks, shared = upstream_streams.open(request_key('/audio/speech', payload), start)
+    if shared:
+        logger.info("共享进行中的语音合成数据流")
+    return chunks
+
+# 早期创建的自定义角色没有保存声音，启动时按稳定哈希补全并写回（多个进程同时执行结果相同）
+_filled_voices = data_manager.fill_missing_custom_role_field(
+    'voice', lambda role: default_voice_for_character(role.get('name', ''))
+)
+if _filled_voices:
+    logger.info(f"为 {_filled_voices} 个自定义角色补全默认声音")
+
+# 角色仓库：预设角色和自定义角色的不可变对象，未配置声音的预设角色在启动时确定默认声音
+role_repository = RoleRepository(data_manager, ROLE_LIBRARY, default_voice=default_voice_for_character)
 
 def get_role_by_id(role_id):
     """
-    根据角色ID获取角色信息
+    根据角色ID获取角色信息（预设角色或自定义角色）
     """
-    # 先在预设角色库中查找
-    for role in ROLE_LIBRARY:
-        if role['id'] == role_id:
-            # 如果角色没有声音配置，添加默认声音
-            if 'voice' not in role:
-                role['voice'] = get_default_voice_for_character(role['name'])
-            return role
-    
-    # 再在自定义角色中查找
-    custom_role = data_manager.get_custom_role(role_id)
-    if custom_role:
-        # 如果自定义角色没有声音配置，添加默认声音
-        if 'voice' not in custom_role:
-            custom_role['voice'] = get_default_voice_for_character(custom_role['name'])
-        return custom_role
-    
-    return None
+    return role_repository.get(role_id)
 
 def get_role_by_name(role_name):
     """
-    根据角色名称获取角色信息
+    根据角色名称获取角色信息（重名时预设角色优先）
     """
-    # 先在预设角色库中查找
-    for role in ROLE_LIBRARY:
-        if role['name'] == role_name:
-            # 如果角色没有声音配置，添加默认声音
-            if 'voice' not in role:
-                role['voice'] = get_default_voice_for_character(role['name'])
-            return role
-    
-    # 再在自定义角色中查找
-    custom_roles_list = data_manager.get_all_custom_roles()
-    for role in custom_roles_list:
-        if role['name'] == role_name:
-            # 如果自定义角色没有声音配置，添加默认声音
-            if 'voice' not in role:
-                role['voice'] = get_default_voice_for_character(role['name'])
-            return role
-    
-    return None
+    return role_repository.get_by_name(role_name)
 
 def validate_role_data(role_data):
     """
@@ -770,6 +1429,9 @@ def validate_role_data(role_data):
     if len(role_data['personality']) > 200:
         return False, "性格描述不能超过200个字符"
     
+    if role_data.get('voice') and not is_valid_voice(role_data['voice']):
+        return False, f"声音必须是以下之一: {', '.join(VOICES)}"
+    
     return True, "验证通过"
 
 def generate_role_id(name):
@@ -785,8 +1447,7 @@ def generate_role_id(name):
     role_id = hashlib.md5(unique_string.encode()).hexdigest()[:12]
     
     # 确保ID唯一性
-    custom_roles_list = data_manager.get_all_custom_roles()
-    while any(role['id'] == role_id for role in custom_roles_list) or any(role['id'] == role_id for role in ROLE_LIBRARY):
+    while role_repository.get(role_id) is not None:
         timestamp = str(int(time.time() * 1000))  # 使用毫秒时间戳
         unique_string = f"{name}_{timestamp}"
         role_id = hashlib.md5(unique_string.encode()).hexdigest()[:12]
@@ -798,11 +1459,6 @@ def call_openai_api(user_message, character_name, character_description, convers
     调用OpenAI Chat Completions API获取AI回复
     """
     try:
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {OPENAI_API_KEY}'
-        }
-        
         # 构建系统提示词
         if character_name == '哈利·波特':
             system_prompt = """你现在是哈利·波特（Harry Potter），11岁进入霍格沃茨魔法学校的学生。  
@@ -1573,27 +2229,46 @@ def call_openai_api(user_message, character_name, character_description, convers
             "presence_penalty": 0.1
         }
         
-        logger.info(f"调用OpenAI API: {OPENAI_API_URL}/chat/completions")
+        logger.info("调用OpenAI API: /chat/completions")
         logger.info(f"角色: {character_name}")
         logger.info(f"用户消息: {user_message[:50]}...")
         
-        response = requests.post(
-            f'{OPENAI_API_URL}/chat/completions',
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            ai_response = result['choices'][0]['message']['content'].strip()
-            logger.info(f"OpenAI API调用成功，回复: {ai_response[:50]}...")
-            return ai_response
-        else:
-            error_msg = f'OpenAI API调用失败: {response.status_code} - {response.text}'
-            logger.error(error_msg)
-            raise Exception(error_msg)
+        def post_chat():
+            if CHAT_HEDGE:
+                primary_endpoints = []
+                return hedged_call(
+                    lambda attempt: stream_chat_completion(
+                        payload, attempt,
+                        avoid=primary_endpoints if attempt.index else (),
+                        attempted=None if attempt.index else primary_endpoints
+                    ),
+                    chat_hedge_policy,
+                    chat_hedge_executor
+                )
+            
+            with upstream_admission.slot('chat') as slot:
+                response = upstream_pool.request(
+                    'POST', '/chat/completions',
+                    json=payload,
+                    timeout=30
+                )
+                slot.observe(response.status_code, response.headers.get('Retry-After'))
+            
+            if response.status_code == 200:
+                result = response.json()
+                return result['choices'][0]['message']['content'].strip()
+            else:
+                error_msg = f'OpenAI API调用失败: {response.status_code} - {response.text}'
+                logger.error(error_msg)
+                raise Exception(error_msg)
+        
+        # 热门角色的开场白等完全相同的请求并发到达时只调用一次
+        ai_response = coalesced_call('/chat/completions', payload, post_chat)
+        logger.info(f"OpenAI API调用成功，回复: {ai_response[:50]}...")
+        return ai_response
             
+    except AdmissionRejected:
+        raise
     except requests.exceptions.Timeout:
         error_msg = '请求超时，请稍后重试'
         logger.error(error_msg)
@@ -1607,27 +2282,126 @@ def call_openai_api(user_message, character_name, character_description, convers
         logger.error(error_msg)
         raise Exception(error_msg)
 
+def stream_chat_completion(payload, attempt, avoid=(), attempted=None):
+    """
+    以流式方式调用Chat Completions API并拼接完整回复（对冲请求据此观测首字节时间）
+    
+    Args:
+        payload: 请求体
+        attempt: 对冲尝试的句柄（HedgeAttempt），index 大于0的对冲请求不排队、不挤占等待者，
+            没有空闲名额时直接放弃；另一方胜出时由胜出方关闭本请求的响应
+        avoid: 尽量避开的端点
+        attempted: 记录本请求所用端点的列表
+        
+    Returns:
+        回复文本
+    """
+    # 另一方已胜出时不再排队、不再调用上游
+    if attempt.cancelled:
+        raise HedgeLost()
+    with upstream_admission.slot('chat', block=attempt.index == 0) as slot:
+        if attempt.cancelled:
+            raise HedgeLost()
+        # 拿到名额后才开始计时，排队等待名额的时间不计入首字节时间、也不触发对冲
+        attempt.sent()
+        response = upstream_pool.request(
+            'POST', '/chat/completions',
+            avoid=avoid,
+            attempted=attempted,
+            json={**payload, 'stream': True},
+            timeout=30,
+            stream=True
+        )
+        slot.observe(response.status_code, response.headers.get('Retry-After'))
+        # 另一方胜出时立即关闭连接，停止生成并归还名额（已胜出时在此处直接关闭）
+        attempt.on_cancel(response.close)
+        try:
+            if attempt.cancelled:
+                raise HedgeLost()
+            if response.status_code != 200:
+                error_msg = f'OpenAI API调用失败: {response.status_code} - {response.text}'
+                logger.error(error_msg)
+                raise Exception(error_msg)
+            
+            parts = []
+            claimed = False
+            for line in response.iter_lines():
+                if not claimed:
+                    if not attempt.claim():
+                        raise HedgeLost()
+                    claimed = True
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                choices = json.loads(data).get('choices') or []
+                if choices:
+                    parts.append((choices[0].get('delta') or {}).get('content') or '')
+            if attempt.cancelled:
+                raise HedgeLost()
+            return ''.join(parts).strip()
+        except Exception:
+            if attempt.cancelled:
+                # 被胜出方关闭连接后的读取错误
+                raise HedgeLost()
+            raise
+        finally:
+            response.close()
+
+def build_role_catalog(include_custom):
+    """
+    生成角色目录数据（合并预设角色和自定义角色）
+    """
+    roles = role_repository.all(include_custom)
+    all_characters = [with_avatar_url(role) for role in roles]
+    
+    return {
+        'success': True,
+        'characters': all_characters,
+        'total': len(all_characters),
+        'preset_count': len(role_repository.presets),
+        'custom_count': len(roles) - len(role_repository.presets) if include_custom else 0
+    }
+
+# 角色目录快照：预先序列化和压缩，角色数据变化时重建
+role_catalog = RoleCatalog(build_role_catalog, lambda: role_repository.version)
+
+def get_list_arg(name):
+    """
+    读取可重复或逗号分隔的查询参数，如 ?tag=漫威&tag=复仇者联盟 或 ?tag=漫威,复仇者联盟
+    """
+    values = []
+    for raw in request.args.getlist(name):
+        values.extend(value.strip() for value in raw.split(',') if value.strip())
+    return values
+
 @app.route('/api/characters', methods=['GET'])
 def get_characters():
     """
     获取可用的角色列表
+    返回预先序列化的快照，支持 If-None-Match 条件请求和 gzip 编码
     """
     try:
         include_custom = request.args.get('include_custom', 'true').lower() == 'true'
+        snapshot = role_catalog.get(include_custom)
         
-        # 合并预设角色和自定义角色
-        all_characters = ROLE_LIBRARY.copy()
-        if include_custom:
-            custom_roles_list = data_manager.get_all_custom_roles()
-            all_characters.extend(custom_roles_list)
+        use_gzip = request.accept_encodings['gzip'] > 0
+        etag = snapshot.gzip_etag if use_gzip else snapshot.etag
         
-        return jsonify({
-            'success': True,
-            'characters': all_characters,
-            'total': len(all_characters),
-            'preset_count': len(ROLE_LIBRARY),
-            'custom_count': len(custom_roles_list) if include_custom else 0
-        })
+        if not is_resource_modified(request.environ, etag=etag):
+            response = app.response_class(status=304)
+        elif use_gzip:
+            response = app.response_class(snapshot.gzip_body, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = app.response_class(snapshot.body, mimetype='application/json')
+        
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        # 浏览器每次都需重新验证，目录未变化时只返回304
+        response.cache_control.no_cache = True
+        return response
     except Exception as e:
         logger.error(f"获取角色列表错误: {str(e)}")
         return jsonify({
@@ -1645,7 +2419,7 @@ def get_character_by_id(role_id):
         if role:
             return jsonify({
                 'success': True,
-                'character': role
+                'character': with_avatar_url(role)
             })
         else:
             return jsonify({
@@ -1659,6 +2433,52 @@ def get_character_by_id(role_id):
             'error': str(e)
         }), 500
 
+@app.route('/api/characters/facets', methods=['GET'])
+def get_character_facets():
+    """
+    角色分面浏览：一次返回分类/标签计数和筛选结果
+    查询参数：
+    - category: 分类（可重复或逗号分隔，多个分类为"或"关系）
+    - tag: 标签（可重复或逗号分隔）
+    - match: 多个标签的关系，all（默认，同时包含）或 any（包含任一）
+    - include_custom: 是否包含自定义角色（默认true）
+    - offset/limit: 结果分页（默认返回前100个）
+    """
+    try:
+        categories = [value for value in get_list_arg('category') if value != 'all']
+        tags = get_list_arg('tag')
+        match = request.args.get('match', 'all').lower()
+        if match not in ('all', 'any'):
+            return jsonify({
+                'success': False,
+                'error': 'match 参数必须是 all 或 any'
+            }), 400
+        include_custom = request.args.get('include_custom', 'true').lower() == 'true'
+        offset, limit = get_pagination_args(default_limit=100, max_limit=500)
+        
+        roles, facets = role_repository.facets.query(
+            categories=categories,
+            tags=tags,
+            match_all_tags=match == 'all',
+            include_custom=include_custom
+        )
+        
+        return jsonify({
+            'success': True,
+            'facets': facets,
+            'filters': {'category': categories, 'tag': tags, 'match': match},
+            'characters': [with_avatar_url(role) for role in roles[offset:offset + limit]],
+            'total': len(roles),
+            'offset': offset,
+            'limit': limit
+        })
+    except Exception as e:
+        logger.error(f"获取角色分面错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/api/characters/search', methods=['GET'])
 def search_characters():
     """
@@ -1670,31 +2490,17 @@ def search_characters():
         category = request.args.get('category', '')
         include_custom = request.args.get('include_custom', 'true').lower() == 'true'
         
-        # 合并预设角色和自定义角色
-        all_roles = ROLE_LIBRARY.copy()
-        if include_custom:
-            custom_roles_list = data_manager.get_all_custom_roles()
-            all_roles.extend(custom_roles_list)
-        
-        filtered_roles = all_roles
-        
-        # 按分类筛选
-        if category and category != 'all':
-            filtered_roles = [role for role in filtered_roles if role.get('category') == category]
+        # 按分类筛选（通过分面索引直接取得该分类下的角色）
+        categories = [category] if category and category != 'all' else None
+        filtered_roles, _ = role_repository.facets.query(categories=categories, include_custom=include_custom)
         
         # 按关键词搜索
         if query:
-            filtered_roles = [
-                role for role in filtered_roles
-                if (query in role['name'].lower() or
-                    query in role['description'].lower() or
-                    query in role['personality'].lower() or
-                    any(query in tag.lower() for tag in role.get('tags', [])))
-            ]
+            filtered_roles = [role for role in filtered_roles if role.matches(query)]
         
         return jsonify({
             'success': True,
-            'characters': filtered_roles,
+            'characters': [with_avatar_url(role) for role in filtered_roles],
             'total': len(filtered_roles)
         })
     except Exception as e:
@@ -1704,6 +2510,26 @@ def search_characters():
             'error': str(e)
         }), 500
 
+def get_role_form_data():
+    """
+    从 multipart 表单中读取角色数据（带头像上传时使用）
+    """
+    data = {
+        'name': request.form.get('name', '').strip(),
+        'description': request.form.get('description', '').strip(),
+        'personality': request.form.get('personality', '').strip(),
+        'category': request.form.get('category', 'custom'),
+        'tags': request.form.get('tags', '').strip(),
+        'created_by': request.form.get('created_by', 'anonymous')
+    }
+    
+    # 处理标签
+    if data['tags']:
+        data['tags'] = [tag.strip() for tag in data['tags'].split(',') if tag.strip()]
+    else:
+        data['tags'] = []
+    return data
+
 @app.route('/api/characters/custom', methods=['POST'])
 def create_custom_character():
     """
@@ -1718,20 +2544,7 @@ def create_custom_character():
         # 获取表单数据
         if avatar_file:
             # 如果有文件上传，从表单获取数据
-            data = {
-                'name': request.form.get('name', '').strip(),
-                'description': request.form.get('description', '').strip(),
-                'personality': request.form.get('personality', '').strip(),
-                'category': request.form.get('category', 'custom'),
-                'tags': request.form.get('tags', '').strip(),
-                'created_by': request.form.get('created_by', 'anonymous')
-            }
-            
-            # 处理标签
-            if data['tags']:
-                data['tags'] = [tag.strip() for tag in data['tags'].split(',') if tag.strip()]
-            else:
-                data['tags'] = []
+            data = get_role_form_data()
         else:
             # 如果没有文件上传，从JSON获取数据
             data = request.get_json()
@@ -1764,15 +2577,16 @@ def create_custom_character():
         avatar_path = ''
         if avatar_file and avatar_file.filename:
             # 保存上传的头像文件
-            avatar_path = save_uploaded_avatar(avatar_file, data['name'])
+            avatar_path = save_uploaded_avatar(avatar_file, role_id)
             if not avatar_path:
                 return jsonify({
                     'success': False,
                     'error': '头像文件格式不支持，请上传 PNG、JPG、JPEG、GIF 或 WEBP 格式的图片'
                 }), 400
         elif 'image' in data and data['image']:
-            # 使用提供的URL
+            # 使用提供的URL（指向已存储的头像时增加引用）
             avatar_path = data['image']
+            avatar_store.acquire(avatar_path, role_id)
         
         # 构建角色数据
         custom_role = {
@@ -1783,22 +2597,37 @@ def create_custom_character():
             'category': data.get('category', 'custom'),
             'tags': data.get('tags', []),
             'image': avatar_path,
+            'voice': data.get('voice') or default_voice_for_character(data['name'].strip()),
             'is_custom': True,
             'created_at': datetime.now().isoformat(),
             'created_by': data.get('created_by', 'anonymous')
         }
         
-        # 保存自定义角色
-        saved_role = data_manager.save_custom_role(custom_role)
+        # 保存自定义角色，失败时撤销头像引用
+        try:
+            saved_role = role_repository.create(custom_role)
+        except Exception:
+            avatar_store.release(avatar_path, role_id)
+            raise
         
         logger.info(f"创建自定义角色成功: {custom_role['name']} (ID: {role_id})")
         
         return jsonify({
             'success': True,
-            'character': saved_role,
+            'character': with_avatar_url(saved_role),
             'message': '角色创建成功'
         }), 201
         
+    except AvatarUploadError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status_code
+    except RequestEntityTooLarge:
+        return jsonify({
+            'success': False,
+            'error': '请求数据过大'
+        }), 413
     except Exception as e:
         logger.error(f"创建自定义角色错误: {str(e)}")
         return jsonify({
@@ -1812,19 +2641,24 @@ def update_custom_character(role_id):
     更新自定义角色
     """
     try:
-        existing_role = data_manager.get_custom_role(role_id)
+        existing_role = role_repository.get_custom(role_id)
         if not existing_role:
             return jsonify({
                 'success': False,
                 'error': '自定义角色不存在'
             }), 404
         
-        data = request.get_json()
-        if not data:
-            return jsonify({
-                'success': False,
-                'error': '请求数据格式错误'
-            }), 400
+        # 带头像上传时从表单获取数据，否则从JSON获取
+        avatar_file = request.files.get('avatar')
+        if avatar_file:
+            data = get_role_form_data()
+        else:
+            data = request.get_json()
+            if not data:
+                return jsonify({
+                    'success': False,
+                    'error': '请求数据格式错误'
+                }), 400
         
         # 验证必填字段
         is_valid, error_msg = validate_role_data(data)
@@ -1834,16 +2668,8 @@ def update_custom_character(role_id):
                 'error': error_msg
             }), 400
         
-        # 获取现有角色数据
-        existing_role = data_manager.get_custom_role(role_id)
-        if not existing_role:
-            return jsonify({
-                'success': False,
-                'error': '自定义角色不存在'
-            }), 404
-        
         # 检查角色名称是否与其他角色冲突
-        if data['name'] != existing_role['name']:
+        if data['name'] != existing_role.name:
             existing_role_by_name = get_role_by_name(data['name'])
             if existing_role_by_name:
                 return jsonify({
@@ -1860,23 +2686,54 @@ def update_custom_character(role_id):
             'tags': data.get('tags', []),
             'image': data.get('image', '')
         }
+        # 声音在创建时确定并保存，改名不会改变声音，可显式指定
+        if data.get('voice'):
+            update_data['voice'] = data['voice']
         
-        success = data_manager.update_custom_role(role_id, update_data)
-        if not success:
+        if avatar_file and avatar_file.filename:
+            update_data['image'] = save_uploaded_avatar(avatar_file, role_id)
+            if not update_data['image']:
+                return jsonify({
+                    'success': False,
+                    'error': '头像文件格式不支持，请上传 PNG、JPG、JPEG、GIF 或 WEBP 格式的图片'
+                }), 400
+        
+        # 更换头像时先引用新头像，更新成功后再释放旧头像
+        old_image = existing_role.image
+        image_changed = update_data['image'] != old_image
+        if image_changed:
+            avatar_store.acquire(update_data['image'], role_id)
+        
+        updated_role = role_repository.update(role_id, update_data)
+        if not updated_role:
+            if image_changed:
+                avatar_store.release(update_data['image'], role_id)
             return jsonify({
                 'success': False,
                 'error': '更新角色失败'
             }), 500
         
-        updated_role = data_manager.get_custom_role(role_id)
-        logger.info(f"更新自定义角色成功: {updated_role['name']} (ID: {role_id})")
+        if image_changed:
+            avatar_store.release(old_image, role_id)
+        
+        logger.info(f"更新自定义角色成功: {updated_role.name} (ID: {role_id})")
         
         return jsonify({
             'success': True,
-            'character': updated_role,
+            'character': with_avatar_url(updated_role),
             'message': '角色更新成功'
         })
         
+    except AvatarUploadError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status_code
+    except RequestEntityTooLarge:
+        return jsonify({
+            'success': False,
+            'error': '请求数据过大'
+        }), 413
     except Exception as e:
         logger.error(f"更新自定义角色错误: {str(e)}")
         return jsonify({
@@ -1891,17 +2748,17 @@ def delete_custom_character(role_id):
     """
     try:
         # 获取角色信息
-        role = data_manager.get_custom_role(role_id)
+        role = role_repository.get_custom(role_id)
         if not role:
             return jsonify({
                 'success': False,
                 'error': '自定义角色不存在'
             }), 404
         
-        role_name = role['name']
+        role_name = role.name
         
         # 删除角色数据
-        success = data_manager.delete_custom_role(role_id)
+        success = role_repository.delete(role_id)
         
         if not success:
             return jsonify({
@@ -1909,9 +2766,12 @@ def delete_custom_character(role_id):
                 'error': '删除角色失败'
             }), 500
         
-        # 删除对应的图片文件
-        image_path = role.get('image')
-        if image_path:
+        # 释放头像引用（内容寻址存储中的文件由后台垃圾回收清理），旧版按角色名命名的图片直接删除
+        image_path = role.image
+        remaining_refs = avatar_store.release(image_path, role_id)
+        if remaining_refs is not None:
+            logger.info(f"释放角色头像引用: {image_path}（剩余引用 {remaining_refs}）")
+        elif image_path:
             try:
                 # 构建完整的图片文件路径
                 if image_path.startswith('data/pic/'):
@@ -1919,8 +2779,13 @@ def delete_custom_character(role_id):
                 else:
                     full_image_path = f"data/pic/{image_path}"
                 
-                if os.path.exists(full_image_path):
+                # 预设角色或其他自定义角色仍在使用的图片不能删除
+                still_used = any(r.image == image_path for r in role_repository.all())
+                if still_used:
+                    logger.info(f"图片仍被其他角色使用，保留: {full_image_path}")
+                elif os.path.exists(full_image_path):
                     os.remove(full_image_path)
+                    avatar_variants.remove_variants(os.path.basename(full_image_path))
                     logger.info(f"删除角色图片文件: {full_image_path}")
                 else:
                     logger.warning(f"图片文件不存在: {full_image_path}")
@@ -1948,10 +2813,10 @@ def get_custom_characters():
     获取所有自定义角色
     """
     try:
-        custom_roles_list = data_manager.get_all_custom_roles()
+        custom_roles_list = role_repository.custom()
         return jsonify({
             'success': True,
-            'characters': custom_roles_list,
+            'characters': [with_avatar_url(role) for role in custom_roles_list],
             'total': len(custom_roles_list)
         })
     except Exception as e:
@@ -1980,6 +2845,138 @@ def get_conversations():
             'error': str(e)
         }), 500
 
+def get_pagination_args(default_limit=20, max_limit=100):
+    """
+    解析分页参数 offset/limit
+    """
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', default_limit, type=int), 1), max_limit)
+    return offset, limit
+
+def build_conversation_summary(conv_data, include_messages=True):
+    """
+    构建对话列表项
+    """
+    messages = conv_data.get('messages', [])
+    summary = {
+        'id': conv_data.get('id'),
+        'user_id': conv_data.get('user_id'),
+        'character_name': conv_data.get('character_name'),
+        'character_description': conv_data.get('character_description'),
+        'created_at': conv_data.get('created_at'),
+        'updated_at': conv_data.get('updated_at'),
+        'message_count': len(messages),
+        'last_message_time': messages[-1].get('timestamp') if messages else conv_data.get('created_at')
+    }
+    if include_messages:
+        summary['messages'] = messages
+    return summary
+
+@app.route('/api/conversations/export', methods=['GET'])
+@require_admin
+def export_conversations_ndjson():
+    """
+    流式导出对话（NDJSON，每行一个对话或一条消息）
+    查询参数：
+    - mode: conversation（默认）或 message
+    - user_id: 只导出该用户的对话（可选）
+    - character_name: 只导出该角色的对话（可选）
+    """
+    mode = request.args.get('mode', 'conversation')
+    if mode not in EXPORT_MODES:
+        return jsonify({
+            'success': False,
+            'error': f'不支持的导出模式: {mode}'
+        }), 400
+    
+    lines = export_conversations(
+        data_manager,
+        mode,
+        user_id=request.args.get('user_id') or None,
+        character_name=request.args.get('character_name') or None
+    )
+    filename = f"conversations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson"
+    return Response(
+        stream_with_context(lines),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+@app.route('/api/conversations/import', methods=['POST'])
+@require_admin
+def import_conversations_ndjson():
+    """
+    导入NDJSON格式的对话（请求体先写入临时文件并完整校验，有格式错误时返回400且不写入任何数据，
+    校验通过后逐行读取、按批写入）
+    查询参数：
+    - batch_size: 每批写入的记录数（默认500）
+    请求体大小受 MAX_CONTENT_LENGTH 限制，更大的文件请使用命令行 python -m data.ndjson_io import
+    """
+    try:
+        batch_size = max(1, request.args.get('batch_size', 500, type=int))
+        stats = import_ndjson(data_manager, request.stream, batch_size)
+        logger.info(f"导入对话完成: {stats['conversations']} 个对话, {stats['messages']} 条消息, {stats['error_count']} 个错误")
+        return jsonify({
+            'success': True,
+            'stats': stats
+        })
+    except ImportValidationError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'line': e.line
+        }), 400
+    except Exception as e:
+        logger.error(f"导入对话错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/conversations/search', methods=['GET'])
+def search_conversation_messages():
+    """
+    全文搜索对话消息
+    查询参数：
+    - q: 搜索关键词（必填，空格分隔的多个词需同时命中）
+    - user_id: 只搜索该用户的对话（可选）
+    - character_name: 只搜索与该角色的对话（可选）
+    - offset, limit: 分页参数（limit默认20，最大100）
+    """
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({
+                'success': False,
+                'error': '搜索关键词不能为空'
+            }), 400
+        
+        offset, limit = get_pagination_args()
+        result = data_manager.search_messages(
+            query,
+            user_id=request.args.get('user_id') or None,
+            character_name=request.args.get('character_name') or None,
+            offset=offset,
+            limit=limit
+        )
+        
+        return jsonify({
+            'success': True,
+            'query': query,
+            'results': result['results'],
+            'total': result['total'],
+            'total_is_lower_bound': result['total_is_lower_bound'],
+            'offset': offset,
+            'limit': limit,
+            'has_more': offset + len(result['results']) < result['total']
+        })
+    except Exception as e:
+        logger.error(f"搜索对话消息错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/api/conversations/<conversation_id>', methods=['GET'])
 def get_conversation(conversation_id):
     """
@@ -2031,31 +3028,36 @@ def delete_conversation(conversation_id):
 @app.route('/api/conversations/character/<character_name>', methods=['GET'])
 def get_character_conversations(character_name):
     """
-    获取特定角色的对话历史
+    获取特定角色的对话历史（按更新时间倒序，分页）
+    查询参数：
+    - offset, limit: 分页参数（limit默认20，最大100）
+    - user_id: 只返回该用户的对话（可选）
+    - include_messages: 是否包含消息列表（默认true）
     """
     try:
-        # 查找该角色的所有对话
-        character_conversations = []
-        all_conversations = data_manager.get_all_conversations()
-        for conv_data in all_conversations:
-            if conv_data.get('character_name') == character_name:
-                character_conversations.append({
-                    'id': conv_data.get('id'),
-                    'character_name': conv_data.get('character_name'),
-                    'character_description': conv_data.get('character_description'),
-                    'messages': conv_data.get('messages', []),
-                    'created_at': conv_data.get('created_at'),
-                    'last_message_time': conv_data.get('messages', [])[-1].get('timestamp') if conv_data.get('messages') else conv_data.get('created_at')
-                })
-        
-        # 按最后消息时间排序，最新的在前
-        character_conversations.sort(key=lambda x: x['last_message_time'], reverse=True)
+        offset, limit = get_pagination_args()
+        include_messages = request.args.get('include_messages', 'true').lower() == 'true'
+        
+        # 通过角色索引查询，不扫描其他角色的对话
+        result = data_manager.query_conversations(
+            character_name=character_name,
+            user_id=request.args.get('user_id') or None,
+            offset=offset,
+            limit=limit
+        )
+        character_conversations = [
+            build_conversation_summary(conv_data, include_messages)
+            for conv_data in result['conversations']
+        ]
         
         return jsonify({
             'success': True,
             'character_name': character_name,
             'conversations': character_conversations,
-            'total': len(character_conversations)
+            'total': result['total'],
+            'offset': offset,
+            'limit': limit,
+            'has_more': offset + len(character_conversations) < result['total']
         })
     except Exception as e:
         logger.error(f"获取角色对话历史错误: {str(e)}")
@@ -2064,6 +3066,88 @@ def get_character_conversations(character_name):
             'error': str(e)
         }), 500
 
+@app.route('/api/users/<user_id>/conversations', methods=['GET'])
+def get_user_conversations(user_id):
+    """
+    获取特定用户的对话列表（按更新时间倒序，分页）
+    查询参数：
+    - offset, limit: 分页参数（limit默认20，最大100）
+    - character_name: 只返回与该角色的对话（可选）
+    - include_messages: 是否包含消息列表（默认false）
+    """
+    try:
+        offset, limit = get_pagination_args()
+        include_messages = request.args.get('include_messages', 'false').lower() == 'true'
+        
+        # 通过用户索引查询，不扫描其他用户的对话
+        result = data_manager.query_conversations(
+            character_name=request.args.get('character_name') or None,
+            user_id=user_id,
+            offset=offset,
+            limit=limit
+        )
+        user_conversations = [
+            build_conversation_summary(conv_data, include_messages)
+            for conv_data in result['conversations']
+        ]
+        
+        return jsonify({
+            'success': True,
+            'user_id': user_id,
+            'conversations': user_conversations,
+            'total': result['total'],
+            'offset': offset,
+            'limit': limit,
+            'has_more': offset + len(user_conversations) < result['total']
+        })
+    except Exception as e:
+        logger.error(f"获取用户对话列表错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/admin/retention', methods=['GET'])
+@require_admin
+def get_retention_status():
+    """
+    获取对话保留策略及最近一次清理报告
+    """
+    return jsonify({
+        'success': True,
+        'policy': retention_policy.to_dict(),
+        'sweep_interval_minutes': RETENTION_SWEEP_INTERVAL_MINUTES,
+        'last_report': retention_sweeper.last_report
+    })
+
+@app.route('/api/admin/retention/sweep', methods=['POST'])
+@require_admin
+def run_retention_sweep():
+    """
+    立即执行一轮保留策略清理
+    查询参数：
+    - wait: 为true时同步执行并返回清理报告，否则在后台执行（默认false）
+    """
+    try:
+        if request.args.get('wait', 'false').lower() == 'true':
+            report = retention_sweeper.run_once()
+            return jsonify({
+                'success': True,
+                'report': report
+            })
+        
+        retention_sweeper.run_async()
+        return jsonify({
+            'success': True,
+            'message': '清理任务已在后台启动'
+        }), 202
+    except Exception as e:
+        logger.error(f"保留策略清理错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """
@@ -2076,9 +3160,24 @@ def health_check():
         'openai_model': OPENAI_MODEL,
         'openai_api_key_configured': bool(OPENAI_API_KEY and OPENAI_API_KEY != 'your-openai-api-key'),
         'active_conversations': len(data_manager.get_all_conversations()),
-        'total_roles': len(ROLE_LIBRARY) + len(data_manager.get_all_custom_roles()),
-        'preset_roles': len(ROLE_LIBRARY),
-        'custom_roles': len(data_manager.get_all_custom_roles()),
+        **role_repository.stats(),
+        'stt': {**stt_backend.stats(), 'cache': transcription_cache.info(), 'shared': transcription_flight.stats['shared']},
+        'tts': {'cache': tts_cache.info(), 'estimated_ms_per_100_chars': tts_model_selector.stats()},
+        'upstream': {
+            'admission': upstream_admission.info(),
+            'pool': upstream_pool.info(),
+            'hedge': {'enabled': CHAT_HEDGE, **chat_hedge_policy.info()},
+            'coalesce': UPSTREAM_COALESCE,
+            'calls': upstream_flight.stats['calls'],
+            'shared': upstream_flight.stats['shared'],
+            'streams': upstream_streams.stats['calls'],
+            'shared_streams': upstream_streams.stats['shared'],
+        },
+        'audio_preprocessing': {
+            'enabled': audio_preprocessor.enabled,
+            'ffmpeg': bool(audio_preprocessor.ffmpeg_path),
+            **audio_preprocessor.stats
+        },
         'features': {
             'voice_transcription': True,
             'role_management': True,
@@ -2094,42 +3193,135 @@ def health_check():
 def serve_avatar(filename):
     """
     提供头像图片文件服务
+    查询参数：
+    - v: 内容哈希版本号（与当前文件一致时响应可被永久缓存）
+    - size: 缩略图尺寸（sm/md/lg 或像素值），不传则返回原图
+    - format: 缩略图格式（webp/jpeg），不传则根据Accept头协商
     """
     try:
         file_path = os.path.join(UPLOAD_FOLDER, filename)
-        if os.path.exists(file_path):
-            return send_file(file_path)
-        else:
+        if not os.path.isfile(file_path):
             return jsonify({'error': '文件不存在'}), 404
+        
+        # 版本号与原图内容一致时才允许永久缓存，旧版本URL每次重新验证
+        version = request.args.get('v')
+        immutable = bool(version) and version == get_file_content_hash(file_path)
+        
+        size = request.args.get('size')
+        if size:
+            size_name = avatar_variants.resolve_size(size)
+            fmt = request.args.get('format')
+            if fmt not in VARIANT_FORMATS:
+                fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+            
+            variant_path = avatar_variants.get_variant(filename, size_name, fmt) if size_name else None
+            if variant_path:
+                response = send_avatar_file(variant_path, VARIANT_FORMATS[fmt][2], immutable)
+                response.vary.add('Accept')
+                return response
+            # 缩略图生成失败或超时：缩略图URL下返回的是原图，不能被永久缓存，下次请求重新验证
+            return send_avatar_file(file_path, immutable=False)
+        
+        # 未请求缩略图时返回原图
+        return send_avatar_file(file_path, immutable=immutable)
     except Exception as e:
         logger.error(f"提供头像文件错误: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/avatars/backfill', methods=['POST'])
+@require_admin
+def backfill_avatar_variants():
+    """
+    在后台为已有头像批量生成缩略图
+    查询参数：
+    - overwrite: 为true时重新生成已存在的缩略图（默认false）
+    """
+    if not avatar_variants.enabled:
+        return jsonify({
+            'success': False,
+            'error': '未安装 Pillow，无法生成缩略图'
+        }), 501
+    
+    overwrite = request.args.get('overwrite', 'false').lower() == 'true'
+    
+    def run_backfill():
+        stats = avatar_variants.backfill(overwrite=overwrite)
+        logger.info(f"头像缩略图补齐完成: {stats}")
+    
+    threading.Thread(target=run_backfill, name='avatar-backfill', daemon=True).start()
+    return jsonify({
+        'success': True,
+        'message': '缩略图补齐任务已在后台启动'
+    }), 202
+
+@app.route('/api/admin/avatars/gc', methods=['POST'])
+@require_admin
+def collect_avatar_garbage():
+    """
+    立即回收无引用的头像文件
+    查询参数：
+    - grace_minutes: 引用归零后的宽限期（分钟，默认使用 AVATAR_GC_GRACE_MINUTES）
+    """
+    try:
+        grace_minutes = float(request.args.get('grace_minutes', AVATAR_GC_GRACE_MINUTES))
+        stats = avatar_store.collect_garbage(grace_minutes * 60)
+        logger.info(f"头像垃圾回收完成: {stats}")
+        return jsonify({
+            'success': True,
+            'stats': stats
+        })
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': 'grace_minutes 参数必须是数字'
+        }), 400
+    except Exception as e:
+        logger.error(f"头像垃圾回收错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 if __name__ == '__main__':
     print("=" * 60)
     print("🚀 启动AI角色扮演平台后端服务...")
     print("=" * 60)
     print(f"🤖 OpenAI API URL: {OPENAI_API_URL}")
+    if len(upstream_pool.endpoints) > 1:
+        print(f"🔀 上游端点: {', '.join(endpoint.name for endpoint in upstream_pool.endpoints)}")
     print(f"🧠 OpenAI Model: {OPENAI_MODEL}")
     print(f"🔑 OpenAI API Key 已配置: {'✅' if OPENAI_API_KEY and OPENAI_API_KEY != 'your-openai-api-key' else '❌'}")
     print(f"👥 角色库数量: {len(ROLE_LIBRARY)}")
     print("=" * 60)
+    print("🌐 前端页面: http://localhost:5000/")
     print("📋 可用的API端点:")
     print("  • POST /api/chat - 与AI角色对话")
     print("  • POST /api/voice/transcribe - 语音转文本")
     print("  • POST /api/voice/synthesize - 文本转语音")
+    print("  • POST /api/voice/turn - 语音对话（识别、回复、合成一次完成）")
+    if sock is not None:
+        print("  • WS   /api/voice/stream - 流式语音识别（边说边识别）")
     print("  • GET  /api/characters - 获取角色列表")
     print("  • GET  /api/characters/<id> - 获取特定角色")
     print("  • GET  /api/characters/search - 搜索角色")
+    print("  • GET  /api/characters/facets - 角色分类/标签计数及筛选")
     print("  • POST /api/characters/custom - 创建自定义角色")
     print("  • GET  /api/characters/custom - 获取自定义角色列表")
     print("  • PUT  /api/characters/custom/<id> - 更新自定义角色")
     print("  • DELETE /api/characters/custom/<id> - 删除自定义角色")
     print("  • GET  /api/conversations - 获取对话列表")
+    print("  • GET  /api/conversations/search - 全文搜索对话消息")
+    print("  • GET  /api/conversations/export - 导出对话(NDJSON)")
+    print("  • POST /api/conversations/import - 导入对话(NDJSON)")
     print("  • GET  /api/conversations/<id> - 获取指定对话详情")
-    print("  • GET  /api/conversations/character/<name> - 获取特定角色对话历史")
+    print("  • GET  /api/conversations/character/<name> - 获取特定角色对话历史(分页)")
+    print("  • GET  /api/users/<user_id>/conversations - 获取特定用户对话列表(分页)")
     print("  • DELETE /api/conversations/<id> - 删除对话")
-    print("  • GET  /api/avatar/<filename> - 获取头像图片")
+    print("  • GET  /api/avatar/<filename>?size= - 获取头像图片(可选缩略图尺寸)")
+    print("  • POST /api/admin/avatars/backfill - 批量生成头像缩略图")
+    print("  • POST /api/admin/avatars/gc - 回收无引用的头像文件")
+    print("  • GET  /api/admin/retention - 查看对话保留策略和清理报告")
+    print("  • POST /api/admin/retention/sweep - 立即执行保留策略清理")
     print("  • GET  /api/health - 健康检查")
     print("=" * 60)
     print("🌐 请在浏览器中访问 http://localhost:5000/api/health 检查服务状态")
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+语音识别前的音频预处理
+浏览器录音通常是 48kHz 双声道，前后还带有静音，直接上传给 Whisper 比实际需要大好几倍。
+这里在上传前：
+- 解码并转换为 16kHz 单声道（Whisper 内部使用的采样率）
+- 按短时能量检测语音（VAD），裁掉开头和结尾的静音
+- 重新编码为 Opus（ogg 容器）；没有 ffmpeg 时输出 16kHz 单声道 WAV
+
+解码和 Opus 编码依赖 ffmpeg（可选）；没有 ffmpeg 时只能处理 PCM WAV，其他格式原样上传。
+很小的录音、处理失败或处理后没有变小时，都直接上传原始音频。
+"""
+
+import array
+import hashlib
+import io
+import logging
+import shutil
+import subprocess
+import sys
+import threading
+import wave
+import warnings
+from typing import Optional, Tuple
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import audioop
+except ImportError:  # Python 3.13 起移除，使用纯 Python 实现
+    audioop = None
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_WIDTH = 2  # 16位PCM
+
+# 合成语音转码参数：格式 -> (编码器, 其他参数...)
+TRANSCODE_ARGS = {
+    'mp3': ['libmp3lame', '-f', 'mp3'],
+    'opus': ['libopus', '-application', 'voip', '-f', 'ogg'],
+    'aac': ['aac', '-f', 'adts'],
+}
+
+
+class PreprocessResult:
+    """一次预处理的结果"""
+
+    __slots__ = ('data', 'filename', 'content_type', 'original_bytes', 'applied', 'reason',
+                 'codec', 'duration_ms', 'trimmed_ms', 'source_digest')
+
+    def __init__(self, data: bytes, filename: str, content_type: Optional[str], original_bytes: int,
+                 applied: bool = False, reason: str = '', codec: Optional[str] = None,
+                 duration_ms: int = 0, trimmed_ms: int = 0, source_digest: str = ''):
+        self.data = data
+        self.filename = filename
+        self.content_type = content_type
+        self.original_bytes = original_bytes
+        self.applied = applied
+        self.reason = reason
+        self.codec = codec
+        self.duration_ms = duration_ms
+        self.trimmed_ms = trimmed_ms
+        # 原始上传音频的 sha256（编码结果不一定逐字节稳定，识别结果按原始音频复用）
+        self.source_digest = source_digest or hashlib.sha256(data).hexdigest()
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - len(self.data)
+
+    def to_dict(self) -> dict:
+        """用于接口返回的处理摘要"""
+        return {
+            'applied': self.applied,
+            'reason': self.reason,
+            'codec': self.codec,
+            'original_bytes': self.original_bytes,
+            'sent_bytes': len(self.data),
+            'saved_bytes': self.saved_bytes,
+            'duration_ms': self.duration_ms,
+            'trimmed_ms': self.trimmed_ms,
+        }
+
+
+# ==================== PCM 处理 ====================
+
+def _to_16bit(pcm: bytes, width: int) -> bytes:
+    if width == SAMPLE_WIDTH:
+        return pcm
+    if audioop is not None:
+        return audioop.lin2lin(pcm, width, SAMPLE_WIDTH)
+    raise ValueError(f"不支持的采样位宽: {width * 8}位")
+
+
+def _to_mono(pcm: bytes, channels: int) -> bytes:
+    if channels == 1:
+        return pcm
+    if audioop is not None and channels == 2:
+        return audioop.tomono(pcm, SAMPLE_WIDTH, 0.5, 0.5)
+    samples = array.array('h', pcm)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    mono = array.array('h', (
+        sum(samples[i:i + channels]) // channels for i in range(0, len(samples) - channels + 1, channels)
+    ))
+    if sys.byteorder == 'big':
+        mono.byteswap()
+    return mono.tobytes()
+
+
+def _resample(pcm: bytes, rate: int, target_rate: int) -> bytes:
+    if rate == target_rate:
+        return pcm
+    if audioop is not None:
+        return audioop.ratecv(pcm, SAMPLE_WIDTH, 1, rate, target_rate, None)[0]
+    # 线性插值
+    samples = array.array('h', pcm)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    count = int(len(samples) * target_rate / rate)
+    step = rate / target_rate
+    last = len(samples) - 1
+    output = array.array('h', bytes(count * SAMPLE_WIDTH))
+    for i in range(count):
+        position = i * step
+        index = int(position)
+        if index >= last:
+            output[i] = samples[last]
+        else:
+            fraction = position - index
+            output[i] = int(samples[index] + (samples[index + 1] - samples[index]) * fraction)
+    if sys.byteorder == 'big':
+        output.byteswap()
+    return output.tobytes()
+
+
+def frame_rms(frame: bytes) -> int:
+    """16位PCM的均方根能量"""
+    if audioop is not None:
+        return audioop.rms(frame, SAMPLE_WIDTH)
+    samples = array.array('h', frame)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if not samples:
+        return 0
+    return int((sum(sample * sample for sample in samples) / len(samples)) ** 0.5)
+
+
+def find_speech(pcm: bytes, sample_rate: int, frame_ms: int = 30, min_rms: int = 300,
+                noise_ratio: float = 3.0, padding_ms: int = 300) -> Optional[Tuple[int, int]]:
+    """
+    按短时能量找到语音所在的区间（用于裁掉前后静音）
+
+    Args:
+        pcm: 16位单声道PCM
+        sample_rate: 采样率
+        frame_ms: 分析帧长
+        min_rms: 语音帧的最低能量（约 -40dBFS）
+        noise_ratio: 语音帧能量至少为底噪（最安静的10%帧）的倍数
+        padding_ms: 语音区间前后保留的时长，避免切掉弱起音和尾音
+
+    Returns:
+        (起始字节, 结束字节)，没有检测到语音时返回 None
+    """
+    frame_bytes = sample_rate * frame_ms // 1000 * SAMPLE_WIDTH
+    if frame_bytes <= 0 or len(pcm) < frame_bytes:
+        return None
+
+    energies = [frame_rms(pcm[offset:offset + frame_bytes])
+                for offset in range(0, len(pcm) - frame_bytes + 1, frame_bytes)]
+    noise_floor = sorted(energies)[len(energies) // 10]
+    threshold = max(min_rms, noise_floor * noise_ratio)
+
+    speech = [index for index, energy in enumerate(energies) if energy >= threshold]
+    if not speech:
+        return None
+
+    padding = padding_ms // frame_ms
+    start = max(0, speech[0] - padding) * frame_bytes
+    end = min(len(energies), speech[-1] + 1 + padding) * frame_bytes
+    if end >= len(pcm) - frame_bytes:
+        end = len(pcm)
+    return start, end
+
+
+def encode_wav(pcm: bytes, sample_rate: int) -> bytes:
+    """把16位单声道PCM封装为WAV"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(SAMPLE_WIDTH)
+        writer.setframerate(sample_rate)
+        writer.writeframes(pcm)
+    return buffer.getvalue()
+
+
+# ==================== 预处理器 ====================
+
+class AudioPreprocessor:
+    """Whisper 上传前的音频预处理"""
+
+    def __init__(self, enabled: bool = True, target_rate: int = 16000, min_bytes: int = 16 * 1024,
+                 opus_bitrate: str = '24k', ffmpeg_path: Optional[str] = None, timeout: float = 30):
+        """
+        Args:
+            enabled: 是否启用预处理
+            target_rate: 目标采样率
+            min_bytes: 小于该字节数的录音直接上传
+            opus_bitrate: Opus 编码码率
+            ffmpeg_path: ffmpeg 路径，默认在 PATH 中查找
+            timeout: 每次调用 ffmpeg 的超时时间（秒）
+        """
+        self.enabled = enabled
+        self.target_rate = target_rate
+        self.min_bytes = min_bytes
+        self.opus_bitrate = opus_bitrate
+        self.ffmpeg_path = ffmpeg_path or shutil.which('ffmpeg')
+        self.timeout = timeout
+
+        self._stats_lock = threading.Lock()
+        self.stats = {"processed": 0, "bypassed": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def _ffmpeg(self, args, data: bytes) -> bytes:
+        result = subprocess.run(
+            [self.ffmpeg_path, '-hide_banner', '-loglevel', 'error'] + args,
+            input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip() or 'ffmpeg 执行失败')
+        return result.stdout
+
+    def _decode(self, data: bytes) -> bytes:
+        """解码为目标采样率的16位单声道PCM"""
+        if self.ffmpeg_path:
+            return self._ffmpeg(['-i', 'pipe:0', '-vn', '-ac', '1', '-ar', str(self.target_rate),
+                                 '-f', 's16le', 'pipe:1'], data)
+        try:
+            with wave.open(io.BytesIO(data), 'rb') as reader:
+                if reader.getcomptype() != 'NONE':
+                    raise ValueError('不支持压缩的WAV')
+                channels, width, rate = reader.getnchannels(), reader.getsampwidth(), reader.getframerate()
+                pcm = reader.readframes(reader.getnframes())
+        except (wave.Error, EOFError) as e:
+            raise ValueError(f"无法解码音频（未安装 ffmpeg 时只支持WAV）: {e}")
+        pcm = _to_mono(_to_16bit(pcm, width), channels)
+        return _resample(pcm, rate, self.target_rate)
+
+    def _encode(self, pcm: bytes) -> Tuple[bytes, str, str, str]:
+        """编码为 Opus（ffmpeg 不支持时为WAV），返回 (数据, 编码, 扩展名, MIME类型)"""
+        if self.ffmpeg_path:
+            try:
+                encoded = self._ffmpeg(['-f', 's16le', '-ar', str(self.target_rate), '-ac', '1', '-i', 'pipe:0',
+                                        '-c:a', 'libopus', '-b:a', self.opus_bitrate, '-application', 'voip',
+                                        # 固定 Ogg 流序号等随机字段，相同输入得到相同输出
+                                        '-fflags', '+bitexact', '-flags:a', '+bitexact',
+                                        '-f', 'ogg', 'pipe:1'], pcm)
+                return encoded, 'opus', 'ogg', 'audio/ogg'
+            except RuntimeError as e:
+                logger.warning(f"Opus 编码失败，改用WAV: {str(e)}")
+        return encode_wav(pcm, self.target_rate), 'pcm_s16le', 'wav', 'audio/wav'
+
+    def transcode(self, data: bytes, audio_format: str, bitrate: str) -> Optional[bytes]:
+        """
+        以指定码率重新编码合成语音（mp3/opus/aac）
+
+        Args:
+            data: 原始音频
+            audio_format: 输出格式，与输入格式相同
+            bitrate: 目标码率（如 32k）
+
+        Returns:
+            重新编码后的音频；没有 ffmpeg、格式不支持或失败时返回 None
+        """
+        if not self.ffmpeg_path or audio_format not in TRANSCODE_ARGS:
+            return None
+        codec_args = TRANSCODE_ARGS[audio_format]
+        try:
+            return self._ffmpeg(['-i', 'pipe:0', '-vn', '-c:a', codec_args[0], '-b:a', bitrate]
+                                + codec_args[1:] + ['pipe:1'], data)
+        except (RuntimeError, OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"语音转码失败，返回原始音频: {str(e)}")
+            return None
+
+    def _record(self, result: PreprocessResult) -> PreprocessResult:
+        with self._stats_lock:
+            self.stats["processed" if result.applied else "bypassed"] += 1
+            self.stats["bytes_in"] += result.original_bytes
+            self.stats["bytes_out"] += len(result.data)
+        return result
+
+    def process(self, data: bytes, filename: str, content_type: Optional[str] = None) -> PreprocessResult:
+        """
+        预处理一段录音
+
+        Args:
+            data: 原始音频
+            filename: 原始文件名
+            content_type: 原始MIME类型
+
+        Returns:
+            预处理结果（未处理时包含原始音频和原因）
+        """
+        source_digest = hashlib.sha256(data).hexdigest()
+        original = PreprocessResult(data, filename, content_type, len(data), source_digest=source_digest)
+        if not self.enabled:
+            original.reason = 'disabled'
+            return self._record(original)
+        if len(data) < self.min_bytes:
+            original.reason = 'small'
+            return self._record(original)
+        if not self.ffmpeg_path and data[:4] != b'RIFF':
+            original.reason = 'unsupported'
+            return self._record(original)
+
+        try:
+            pcm = self._decode(data)
+            bytes_per_ms = self.target_rate * SAMPLE_WIDTH // 1000
+            duration_ms = len(pcm) // bytes_per_ms
+
+            speech = find_speech(pcm, self.target_rate)
+            if speech is not None:
+                pcm = pcm[speech[0]:speech[1]]
+            trimmed_ms = duration_ms - len(pcm) // bytes_per_ms
+
+            encoded, codec, extension, mimetype = self._encode(pcm)
+        except (ValueError, RuntimeError, OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"音频预处理失败，上传原始音频: {str(e)}")
+            original.reason = 'error'
+            return self._record(original)
+
+        if len(encoded) >= len(data):
+            original.reason = 'not_smaller'
+            return self._record(original)
+
+        stem = filename.rsplit('.', 1)[0] if filename else 'audio'
+        return self._record(PreprocessResult(
+            encoded, f"{stem}.{extension}", mimetype, len(data), applied=True, codec=codec,
+            duration_ms=duration_ms, trimmed_ms=trimmed_ms, source_digest=source_digest
+        ))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP 响应压缩
+- 根据 Accept-Encoding 协商 br（安装 brotli 时）或 gzip
+- 只压缩文本类响应，小于阈值的响应不压缩
+- 带 ETag 的响应内容固定，压缩结果按 (ETag, 编码) 缓存，重复请求不再压缩
+- 流式响应逐块增量压缩，不等待完整内容
+- 压缩后强 ETag 降级为弱 ETag（与 Nginx 一致），条件请求仍按弱比较命中
+"""
+
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖
+    brotli = None
+
+# 需要压缩的 MIME 类型
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'application/xml',
+    'image/svg+xml',
+}
+
+# 事件流需要每块立即发送，不能积攒
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+
+
+def is_compressible(mimetype: Optional[str]) -> bool:
+    """判断 MIME 类型是否值得压缩"""
+    if not mimetype:
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+class StreamCompressor:
+    """增量压缩器，每次 compress 返回可以立即发送的数据"""
+
+    def __init__(self, encoding: str, level: int = 6, brotli_quality: int = 5):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        """
+        压缩一块数据
+
+        Args:
+            data: 原始数据
+            flush: 是否立即刷出已压缩的数据（客户端可以马上解压出这部分内容）
+        """
+        if self.encoding == 'br':
+            output = self._compressor.process(data)
+            return output + self._compressor.flush() if flush else output
+        output = self._compressor.compress(data)
+        return output + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else output
+
+    def finish(self) -> bytes:
+        """结束压缩流"""
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def compress_bytes(data: bytes, encoding: str, level: int = 6, brotli_quality: int = 5) -> bytes:
+    """一次性压缩完整内容"""
+    compressor = StreamCompressor(encoding, level, brotli_quality)
+    return compressor.compress(data) + compressor.finish()
+
+
+class Compression:
+    """Flask 响应压缩扩展"""
+
+    def __init__(self, app=None, min_size: int = 1024, level: int = 6, brotli_quality: int = 5,
+                 cache_entries: int = 256, stream_flush_bytes: int = 16 * 1024):
+        """
+        Args:
+            app: Flask 应用（可稍后调用 init_app）
+            min_size: 小于该字节数的响应不压缩
+            level: gzip 压缩级别
+            brotli_quality: brotli 压缩质量
+            cache_entries: 压缩结果缓存的最大条目数
+            stream_flush_bytes: 流式响应积攒多少原始字节后刷出一次（事件流每块都刷出）
+        """
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.cache_entries = cache_entries
+        self.stream_flush_bytes = stream_flush_bytes
+
+        self._cache: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.stats = {"compressed": 0, "cache_hits": 0, "streamed": 0, "bytes_in": 0, "bytes_out": 0}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+        app.extensions['compression'] = self
+
+    @property
+    def encodings(self) -> Tuple[str, ...]:
+        """支持的编码，按优先级排列"""
+        return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def negotiate(self, accept_encodings) -> Optional[str]:
+        """
+        根据请求的 Accept-Encoding 选择编码
+
+        Args:
+            accept_encodings: request.accept_encodings
+
+        Returns:
+            'br'、'gzip' 或 None
+        """
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    # ==================== 压缩结果缓存 ====================
+
+    def get_compressed(self, key: str, data: bytes, encoding: str) -> bytes:
+        """
+        获取压缩结果，同一 (key, 编码) 只压缩一次
+        静态资源可在启动时调用预先压缩
+
+        Args:
+            key: 内容标识（如 ETag 或资源指纹）
+            data: 原始内容
+            encoding: 编码
+        """
+        cache_key = (key, encoding)
+        with self._cache_lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+                self.stats["cache_hits"] += 1
+                return cached
+
+        compressed = compress_bytes(data, encoding, self.level, self.brotli_quality)
+        with self._cache_lock:
+            self._cache[cache_key] = compressed
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return compressed
+
+    def precompress(self, key: str, data: bytes) -> Dict[str, bytes]:
+        """
+        预先压缩静态内容的所有编码版本
+
+        Returns:
+            编码到压缩结果的映射
+        """
+        return {encoding: self.get_compressed(key, data, encoding) for encoding in self.encodings}
+
+    # ==================== 响应处理 ====================
+
+    def _stream(self, chunks: Iterable[bytes], compressor: StreamCompressor, flush_every_chunk: bool) -> Iterator[bytes]:
+        pending = 0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                pending += len(chunk)
+                flush = flush_every_chunk or pending >= self.stream_flush_bytes
+                output = compressor.compress(chunk, flush=flush)
+                if flush:
+                    pending = 0
+                if output:
+                    yield output
+            yield compressor.finish()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def after_request(self, response):
+        from flask import request
+
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers
+                or not is_compressible(response.mimetype)
+                or 'no-transform' in response.headers.get('Cache-Control', '')):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate(request.accept_encodings)
+        if encoding is None or request.method == 'HEAD':
+            return response
+
+        if response.is_streamed:
+            response.direct_passthrough = False
+            response.response = self._stream(
+                response.response,
+                StreamCompressor(encoding, self.level, self.brotli_quality),
+                response.mimetype == EVENT_STREAM_MIMETYPE
+            )
+            response.headers.pop('Content-Length', None)
+            self.stats["streamed"] += 1
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            etag, weak = response.get_etag()
+            if etag:
+                # 不同接口的 ETag 可能相同，缓存键带上路径
+                compressed = self.get_compressed(f"{request.path}|{etag}", data, encoding)
+            else:
+                compressed = compress_bytes(data, encoding, self.level, self.brotli_quality)
+            if len(compressed) >= len(data):
+                return response
+            response.set_data(compressed)
+            self.stats["compressed"] += 1
+            self.stats["bytes_in"] += len(data)
+            self.stats["bytes_out"] += len(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
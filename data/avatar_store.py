@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+内容寻址的头像存储
+- 头像文件以内容的 sha256 命名（<哈希>.<扩展名>），相同图片只保存一份
+- 可选的规范化回调在存入前改写临时文件，文件名按改写后的内容计算，存入后内容不再变化
+- avatar_refs.json 记录每个文件被哪些角色引用
+- 角色删除或更换头像时只减少引用，由后台垃圾回收清理无引用的文件
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Callable, Dict, Optional, Tuple
+
+_BLOB_NAME_RE = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+
+
+def _file_sha256(file_path: str, chunk_size: int = 64 * 1024) -> str:
+    """文件内容的 sha256"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AvatarBlobStore:
+    """内容寻址的头像存储"""
+
+    def __init__(self, blob_dir: str = "data/pic", refs_file: str = "data/avatar_refs.json",
+                 on_blob_deleted: Optional[Callable[[str], None]] = None,
+                 normalize: Optional[Callable[[str], bool]] = None):
+        """
+        Args:
+            blob_dir: 头像文件目录
+            refs_file: 引用计数文件
+            on_blob_deleted: 文件被回收后的回调（参数为文件名），用于清理缩略图等派生文件
+            normalize: 存入前规范化临时文件的回调（参数为临时文件路径，返回是否改写了内容）
+        """
+        self.blob_dir = blob_dir
+        self.refs_file = refs_file
+        self.on_blob_deleted = on_blob_deleted
+        self.normalize = normalize
+
+        self._lock = threading.RLock()
+        self._gc_thread = None
+        self._gc_stop = threading.Event()
+        os.makedirs(blob_dir, exist_ok=True)
+
+    # ==================== 引用表 ====================
+
+    def _load_refs(self) -> Dict[str, Dict]:
+        try:
+            with open(self.refs_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_refs(self, refs: Dict[str, Dict]):
+        directory = os.path.dirname(os.path.abspath(self.refs_file))
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(refs, f, ensure_ascii=False, indent=2)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, self.refs_file)
+
+    def blob_name(self, image_path: Optional[str]) -> Optional[str]:
+        """
+        从角色的 image 字段中取出内容寻址的文件名，不是本存储管理的文件时返回 None
+        """
+        if not image_path:
+            return None
+        name = image_path.replace('\\', '/').split('/')[-1]
+        return name if _BLOB_NAME_RE.match(name) else None
+
+    def image_path(self, blob_name: str) -> str:
+        """角色 image 字段使用的相对路径"""
+        return f"data/pic/{blob_name}"
+
+    # ==================== 写入与引用 ====================
+
+    def put(self, stream: BinaryIO, extension: str, role_id: str,
+            chunk_size: int = 64 * 1024) -> Tuple[str, bool]:
+        """
+        流式写入图片并增加引用，内容已存在时直接复用
+
+        Args:
+            stream: 图片数据流
+            extension: 文件扩展名
+            role_id: 引用该图片的角色ID
+
+        Returns:
+            (角色 image 字段使用的相对路径, 是否新写入了文件)
+        """
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(prefix='.upload_', dir=self.blob_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(chunk_size), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            blob_name = f"{digest.hexdigest()}.{extension.lower()}"
+            return self.put_file(temp_path, blob_name, role_id)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def put_file(self, temp_path: str, blob_name: str, role_id: str) -> Tuple[str, bool]:
+        """
+        将已写好的临时文件登记为内容寻址文件并增加引用（调用方已算好哈希）
+
+        Args:
+            temp_path: 临时文件路径（若内容已存在会被保留给调用方删除）
+            blob_name: 按临时文件原始内容计算的文件名，规范化改写内容后重新计算
+            role_id: 引用该图片的角色ID
+
+        Returns:
+            (角色 image 字段使用的相对路径, 是否新写入了文件)
+        """
+        if self.normalize and self.normalize(temp_path):
+            extension = blob_name.rsplit('.', 1)[-1]
+            blob_name = f"{_file_sha256(temp_path)}.{extension}"
+        blob_path = os.path.join(self.blob_dir, blob_name)
+        with self._lock:
+            created = not os.path.exists(blob_path)
+            if created:
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, blob_path)
+            self._add_ref(blob_name, role_id)
+        return self.image_path(blob_name), created
+
+    def _add_ref(self, blob_name: str, role_id: str):
+        refs = self._load_refs()
+        entry = refs.setdefault(blob_name, {"refs": [], "created_at": time.time()})
+        if role_id not in entry["refs"]:
+            entry["refs"].append(role_id)
+        entry.pop("unreferenced_since", None)
+        self._save_refs(refs)
+
+    def acquire(self, image_path: Optional[str], role_id: str) -> bool:
+        """
+        为已存在的文件增加引用（角色改用已有头像时调用）
+
+        Returns:
+            是否为本存储管理的文件
+        """
+        blob_name = self.blob_name(image_path)
+        if not blob_name or not os.path.exists(os.path.join(self.blob_dir, blob_name)):
+            return False
+        with self._lock:
+            self._add_ref(blob_name, role_id)
+        return True
+
+    def release(self, image_path: Optional[str], role_id: str) -> Optional[int]:
+        """
+        减少引用；引用归零的文件等待垃圾回收，不立即删除
+
+        Returns:
+            剩余引用数，不是本存储管理的文件时返回 None
+        """
+        blob_name = self.blob_name(image_path)
+        if not blob_name:
+            return None
+        with self._lock:
+            refs = self._load_refs()
+            entry = refs.get(blob_name)
+            if entry is None:
+                return 0
+            if role_id in entry["refs"]:
+                entry["refs"].remove(role_id)
+            if not entry["refs"]:
+                entry.setdefault("unreferenced_since", time.time())
+            self._save_refs(refs)
+            return len(entry["refs"])
+
+    def ref_count(self, image_path: Optional[str]) -> int:
+        """当前引用数"""
+        blob_name = self.blob_name(image_path)
+        entry = self._load_refs().get(blob_name) if blob_name else None
+        return len(entry["refs"]) if entry else 0
+
+    # ==================== 垃圾回收 ====================
+
+    def collect_garbage(self, grace_seconds: float = 600) -> Dict:
+        """
+        删除引用归零超过宽限期的文件
+
+        Args:
+            grace_seconds: 宽限期（秒），避免与正在进行的上传竞争
+
+        Returns:
+            回收统计
+        """
+        stats = {"deleted": 0, "reclaimed_bytes": 0}
+        now = time.time()
+        with self._lock:
+            refs = self._load_refs()
+            for blob_name, entry in list(refs.items()):
+                if entry["refs"] or now - entry.get("unreferenced_since", now) < grace_seconds:
+                    continue
+                blob_path = os.path.join(self.blob_dir, blob_name)
+                if os.path.exists(blob_path):
+                    stats["reclaimed_bytes"] += os.path.getsize(blob_path)
+                    os.remove(blob_path)
+                del refs[blob_name]
+                stats["deleted"] += 1
+                if self.on_blob_deleted:
+                    self.on_blob_deleted(blob_name)
+            if stats["deleted"]:
+                self._save_refs(refs)
+        return stats
+
+    def start_gc(self, interval_seconds: float, grace_seconds: float = 600):
+        """
+        启动后台垃圾回收线程
+
+        Args:
+            interval_seconds: 回收间隔（秒）
+            grace_seconds: 宽限期（秒）
+        """
+        if self._gc_thread and self._gc_thread.is_alive():
+            return
+        self._gc_stop.clear()
+
+        def run():
+            while not self._gc_stop.wait(interval_seconds):
+                try:
+                    stats = self.collect_garbage(grace_seconds)
+                    if stats["deleted"]:
+                        print(f"头像垃圾回收: 删除 {stats['deleted']} 个文件，回收 {stats['reclaimed_bytes']} 字节")
+                except Exception as e:
+                    print(f"头像垃圾回收失败: {e}")
+
+        self._gc_thread = threading.Thread(target=run, name='avatar-gc', daemon=True)
+        self._gc_thread.start()
+
+    def stop_gc(self):
+        """停止后台垃圾回收线程"""
+        self._gc_stop.set()
+        if self._gc_thread:
+            self._gc_thread.join(timeout=5)
+            self._gc_thread = None
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+头像上传流
+multipart 解析器把上传文件分块写入本流，边写边完成：
+- 大小限制：超过上限立即中断解析，不再读取剩余请求体
+- 格式识别：根据文件头魔数判断真实格式，不信任客户端给出的文件名和 Content-Type
+- 尺寸校验：安装 Pillow 时增量解析图片头，拒绝像素数过大的图片（解压炸弹）
+- 内容哈希：同时计算 sha256，写完即可登记到内容寻址存储，无需再读一遍
+临时文件直接建在头像目录下，登记时原地重命名，不产生额外拷贝
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow 为可选依赖
+    Image = None
+
+# 文件头魔数 -> 扩展名（WEBP 需额外检查第8-12字节）
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+# 识别格式所需的最少字节数
+SNIFF_BYTES = 12
+# 增量解析图片头最多读取的字节数，超过仍未解析出尺寸时跳过尺寸校验
+HEADER_PROBE_BYTES = 1024 * 1024
+
+
+class AvatarUploadError(Exception):
+    """头像上传被拒绝（不继承 ValueError，避免被表单解析器静默吞掉）"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """
+    根据文件头识别图片格式
+
+    Args:
+        header: 文件开头的字节（至少 SNIFF_BYTES 个）
+
+    Returns:
+        扩展名，无法识别时返回 None
+    """
+    for signature, extension in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class AvatarUploadStream:
+    """限制大小、识别格式并计算哈希的上传文件流"""
+
+    def __init__(self, directory: str, max_bytes: int, max_pixels: int = 40_000_000):
+        """
+        Args:
+            directory: 临时文件所在目录（与头像存储同目录，便于原地重命名）
+            max_bytes: 允许的最大字节数
+            max_pixels: 允许的最大像素数
+        """
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.size = 0
+        self.extension: Optional[str] = None
+        self.dimensions = None
+
+        self._digest = hashlib.sha256()
+        self._header = b''
+        # 尚未解析出尺寸时缓存的文件头，None 表示不再解析
+        self._probe = bytearray() if Image is not None else None
+        fd, self.path = tempfile.mkstemp(prefix='.upload_', dir=directory)
+        self._file = os.fdopen(fd, 'wb+')
+
+    # ==================== 写入（由表单解析器调用） ====================
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise AvatarUploadError(f"头像文件不能超过 {self.max_bytes // (1024 * 1024)}MB", 413)
+
+        if self.extension is None:
+            self._header += data[:SNIFF_BYTES]
+            if len(self._header) >= SNIFF_BYTES:
+                self.extension = sniff_image_type(self._header)
+                if self.extension is None:
+                    raise AvatarUploadError('头像文件格式不支持，请上传 PNG、JPG、JPEG、GIF 或 WEBP 格式的图片')
+        if self._probe is not None:
+            self._probe.extend(data)
+            self._probe_dimensions()
+
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def _probe_dimensions(self, final: bool = False):
+        """
+        尝试从已收到的文件头解析尺寸，得到尺寸后即停止
+        Image.open 只读取文件头，不分配像素内存
+        """
+        try:
+            with Image.open(io.BytesIO(bytes(self._probe))) as image:
+                self.dimensions = image.size
+        except Image.DecompressionBombError:
+            raise AvatarUploadError('头像图片尺寸过大')
+        except Exception:
+            # 文件头尚未收全；收完仍无法解析说明文件已损坏
+            if final:
+                raise AvatarUploadError('头像文件已损坏，无法识别图片内容')
+            if len(self._probe) > HEADER_PROBE_BYTES:
+                self._probe = None
+            return
+
+        self._probe = None
+        if self.dimensions[0] * self.dimensions[1] > self.max_pixels:
+            raise AvatarUploadError('头像图片尺寸过大')
+
+    def finish(self):
+        """
+        上传写完后校验（文件过短时格式仍未识别）
+
+        Raises:
+            AvatarUploadError: 文件为空或格式不支持
+        """
+        if self.size == 0:
+            raise AvatarUploadError('头像文件为空')
+        if self.extension is None:
+            self.extension = sniff_image_type(self._header)
+            if self.extension is None:
+                raise AvatarUploadError('头像文件格式不支持，请上传 PNG、JPG、JPEG、GIF 或 WEBP 格式的图片')
+        if self._probe is not None:
+            self._probe_dimensions(final=True)
+        self._file.flush()
+
+    @property
+    def blob_name(self) -> str:
+        """内容寻址文件名"""
+        return f"{self._digest.hexdigest()}.{self.extension}"
+
+    # ==================== 文件对象接口 ====================
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._file.readline(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def flush(self):
+        self._file.flush()
+
+    def detach(self):
+        """临时文件已被存储重命名接管，关闭时不再删除"""
+        self.path = None
+
+    def close(self):
+        """关闭并删除未被登记到存储的临时文件"""
+        if not self._file.closed:
+            self._file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+            self.path = None
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+头像缩略图管线
+为 data/pic 下的原图生成多尺寸 WebP/JPEG 缩略图，存放在 data/pic/variants/<尺寸>/ 下
+- 上传时在后台预生成，请求时按需懒生成并缓存到磁盘
+- 生成任务在有界线程池中执行，同一缩略图的并发请求只生成一次
+- 新上传的原图在存入内容寻址存储前规范化（按EXIF转正、限制最长边、去除元数据），
+  在独立的小线程池中执行并限时，超时则按原始内容存储；文件名按存入的内容计算，存入后不再改写
+- 未安装 Pillow 时管线自动停用，直接提供原图
+
+命令行批量补齐已有头像的缩略图：
+    python -m data.avatar_variants backfill [--overwrite]
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 为可选依赖
+    Image = None
+    ImageOps = None
+
+# 尺寸名称 -> 最长边像素
+AVATAR_SIZES = {'sm': 128, 'md': 384, 'lg': 768}
+
+# 格式名称 -> (Pillow格式, 扩展名, MIME类型)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+}
+
+SOURCE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+
+class AvatarVariantPipeline:
+    """头像缩略图管线"""
+
+    def __init__(self, source_dir: str = "data/pic", variants_dir: str = "data/pic/variants",
+                 sizes: Optional[Dict[str, int]] = None, max_workers: int = 2, quality: int = 80,
+                 source_max_edge: int = 1024, normalize_workers: int = 2, normalize_timeout: float = 2.0):
+        """
+        Args:
+            source_dir: 原图目录
+            variants_dir: 缩略图目录
+            sizes: 尺寸名称到最长边像素的映射
+            max_workers: 并发生成缩略图的最大线程数
+            quality: 有损编码质量
+            source_max_edge: 规范化上传原图时的最长边像素
+            normalize_workers: 规范化上传原图的线程数（与缩略图生成分开，补齐任务不会拖慢上传）
+            normalize_timeout: 上传请求等待规范化的最长秒数
+        """
+        self.source_dir = source_dir
+        self.variants_dir = variants_dir
+        self.sizes = dict(sizes or AVATAR_SIZES)
+        self.quality = quality
+        self.source_max_edge = source_max_edge
+        self.normalize_timeout = normalize_timeout
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='avatar-variant')
+        self._normalize_executor = ThreadPoolExecutor(max_workers=normalize_workers,
+                                                      thread_name_prefix='avatar-normalize')
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """是否可用（需要 Pillow）"""
+        return Image is not None
+
+    def resolve_size(self, size: str) -> Optional[str]:
+        """
+        将 ?size= 参数解析为尺寸名称，支持名称（sm/md/lg）或像素值（就近向上取整）
+
+        Returns:
+            尺寸名称，无法解析时返回 None
+        """
+        if size in self.sizes:
+            return size
+        try:
+            pixels = int(size)
+        except (TypeError, ValueError):
+            return None
+        for name, edge in sorted(self.sizes.items(), key=lambda item: item[1]):
+            if pixels <= edge:
+                return name
+        return max(self.sizes, key=self.sizes.get)
+
+    def variant_path(self, filename: str, size: str, fmt: str) -> str:
+        """缩略图文件路径（保留原扩展名，避免同名不同格式的原图冲突）"""
+        return os.path.join(self.variants_dir, size, f"{filename}.{VARIANT_FORMATS[fmt][1]}")
+
+    def _is_fresh(self, source: str, target: str) -> bool:
+        return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source)
+
+    # ==================== 生成 ====================
+
+    def _render(self, source: str, size: str, fmt: str, target: str) -> str:
+        pil_format, _, _ = VARIANT_FORMATS[fmt]
+        edge = self.sizes[size]
+
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((edge, edge), Image.LANCZOS)
+
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                # JPEG 不支持透明通道，铺白底
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode not in ('RGB', 'RGBA', 'L'):
+                image = image.convert('RGBA')
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(target))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, pil_format, quality=self.quality, optimize=True)
+                os.replace(temp_path, target)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return target
+
+    def _submit(self, filename: str, size: str, fmt: str, overwrite: bool = False) -> Optional[Future]:
+        """提交生成任务，同一缩略图正在生成时复用已有任务"""
+        source = os.path.join(self.source_dir, filename)
+        target = self.variant_path(filename, size, fmt)
+        if not os.path.isfile(source):
+            return None
+
+        with self._inflight_lock:
+            future = self._inflight.get(target)
+            if future is not None:
+                return future
+            if not overwrite and self._is_fresh(source, target):
+                done = Future()
+                done.set_result(target)
+                return done
+
+            future = self._executor.submit(self._render, source, size, fmt, target)
+            self._inflight[target] = future
+
+        def cleanup(_):
+            with self._inflight_lock:
+                self._inflight.pop(target, None)
+
+        future.add_done_callback(cleanup)
+        return future
+
+    def _normalize(self, source: str) -> Optional[str]:
+        """
+        规范化上传的原图：按EXIF转正、缩小到最长边以内、去除元数据（含GPS位置），写入新的临时文件
+        动图保持原样；无需转正缩放、不含EXIF且重新编码后没有变小时不生成新文件
+
+        Args:
+            source: 图片文件路径（尚未存入内容寻址存储的临时文件，不会被修改）
+
+        Returns:
+            规范化后的临时文件路径（由调用方替换或删除），无需替换时返回 None
+        """
+        with Image.open(source) as original:
+            if getattr(original, 'is_animated', False):
+                return None
+            pil_format = original.format
+            transformed = 'exif' in original.info or max(original.size) > self.source_max_edge
+            image = ImageOps.exif_transpose(original)
+            image.thumbnail((self.source_max_edge, self.source_max_edge), Image.LANCZOS)
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            fd, temp_path = tempfile.mkstemp(prefix='.tmp_', dir=os.path.dirname(source) or '.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    # 只保留色彩配置，其余元数据丢弃
+                    image.save(f, pil_format, quality=90, optimize=True,
+                               icc_profile=original.info.get('icc_profile'))
+                if transformed or os.path.getsize(temp_path) < os.path.getsize(source):
+                    os.chmod(temp_path, 0o644)
+                    return temp_path
+            except Exception:
+                os.remove(temp_path)
+                raise
+            os.remove(temp_path)
+            return None
+
+    def normalize_file(self, path: str) -> bool:
+        """
+        规范化上传的原图（存入内容寻址存储前调用，调用方随后按新内容计算文件名）
+        在独立线程池中执行，最多等待 normalize_timeout 秒；超时或失败时保留原文件（按原始内容存储）
+
+        Args:
+            path: 临时文件路径
+
+        Returns:
+            文件内容是否被替换
+        """
+        if not self.enabled:
+            return False
+        future = self._normalize_executor.submit(self._normalize, path)
+        try:
+            normalized = future.result(timeout=self.normalize_timeout)
+        except FutureTimeoutError:
+            if not future.cancel():
+                # 仍在执行：结束后删除它生成的文件，不再替换（原文件可能已经存入存储）
+                future.add_done_callback(_discard_normalized)
+            print(f"规范化头像超时，按原图存储: {path}")
+            return False
+        except Exception as e:
+            # 规范化失败不影响使用，保留原图
+            print(f"规范化头像失败: {path}: {e}")
+            return False
+        if normalized is None:
+            return False
+        os.replace(normalized, path)
+        return True
+
+    def generate_async(self, filename: str):
+        """为一个原图在后台生成全部尺寸和格式的缩略图（上传后调用）"""
+        if not self.enabled:
+            return
+        for size in self.sizes:
+            for fmt in VARIANT_FORMATS:
+                self._submit(filename, size, fmt, overwrite=True)
+
+    def remove_variants(self, filename: str):
+        """删除一个原图的全部缩略图（原图被删除时调用）"""
+        for size in self.sizes:
+            for fmt in VARIANT_FORMATS:
+                path = self.variant_path(filename, size, fmt)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def get_variant(self, filename: str, size: str, fmt: str, wait_timeout: float = 5.0) -> Optional[str]:
+        """
+        获取缩略图路径，不存在时懒生成
+
+        Args:
+            filename: 原图文件名
+            size: 尺寸名称
+            fmt: 格式名称 ('webp' 或 'jpeg')
+            wait_timeout: 等待生成的最长秒数，超时返回 None 由调用方退回原图
+
+        Returns:
+            缩略图路径或 None
+        """
+        if not self.enabled or size not in self.sizes or fmt not in VARIANT_FORMATS:
+            return None
+
+        future = self._submit(filename, size, fmt)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=wait_timeout)
+        except FutureTimeoutError:
+            return None
+        except Exception as e:
+            print(f"生成头像缩略图失败: {filename} ({size}, {fmt}): {e}")
+            return None
+
+    def backfill(self, overwrite: bool = False) -> Dict:
+        """
+        为原图目录下所有头像批量补齐缩略图
+
+        Args:
+            overwrite: 是否重新生成已存在的缩略图
+
+        Returns:
+            统计信息
+        """
+        stats = {"sources": 0, "generated": 0, "failed": 0}
+        if not self.enabled:
+            return stats
+
+        futures = []
+        for filename in sorted(os.listdir(self.source_dir)):
+            extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+            if extension not in SOURCE_EXTENSIONS or not os.path.isfile(os.path.join(self.source_dir, filename)):
+                continue
+            stats["sources"] += 1
+            for size in self.sizes:
+                for fmt in VARIANT_FORMATS:
+                    future = self._submit(filename, size, fmt, overwrite=overwrite)
+                    if future is not None:
+                        futures.append(future)
+
+        for future in futures:
+            try:
+                future.result()
+                stats["generated"] += 1
+            except Exception:
+                stats["failed"] += 1
+        return stats
+
+
+def _discard_normalized(future: Future):
+    """删除超时后才完成的规范化结果"""
+    try:
+        normalized = future.result()
+    except Exception:
+        return
+    if normalized and os.path.exists(normalized):
+        os.remove(normalized)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='头像缩略图管线')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help='为已有头像批量生成缩略图')
+    backfill_parser.add_argument('--overwrite', action='store_true', help='重新生成已存在的缩略图')
+    backfill_parser.add_argument('--workers', type=int, default=4, help='并发线程数')
+    args = parser.parse_args(argv)
+
+    pipeline = AvatarVariantPipeline(max_workers=args.workers)
+    if not pipeline.enabled:
+        print("未安装 Pillow，无法生成缩略图: pip install Pillow")
+        return
+    print(pipeline.backfill(overwrite=args.overwrite))
+
+
+if __name__ == '__main__':
+    main()
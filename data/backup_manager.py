@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+备份管理模块 - 增量备份、压缩、保留策略与后台调度
+
+备份以"全量快照 + 增量"链的形式保存在 backup_dir/<数据类型>/ 下：
+- 全量快照与增量文件都是 gzip 压缩的 NDJSON，每行一条记录操作
+  {"op": "put", "id": ..., "data": ...} 或 {"op": "del", "id": ...}
+- manifest.json 记录每个备份文件的类型、父节点、记录数和 sha256 校验和
+- state.json 记录最近一次备份时每条记录的内容摘要，用于计算下一次增量
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，只做进程内互斥
+    fcntl = None
+
+from data.json_stream import JsonObjectWriter, iter_json_object_items
+
+DATA_TYPES = ('conversations', 'custom_roles')
+
+
+def _record_digest(value) -> str:
+    """计算单条记录的内容摘要"""
+    raw = json.dumps(value, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+
+def _file_sha256(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """分块计算文件的 sha256，避免整文件读入内存"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BackupManager:
+    """增量备份管理器"""
+
+    def __init__(self, data_manager, backup_dir: str = "data/backup",
+                 max_deltas: int = 24, keep_chains: int = 3,
+                 max_age_days: Optional[int] = None, compress_level: int = 6):
+        """
+        初始化备份管理器
+
+        Args:
+            data_manager: 数据管理器实例
+            backup_dir: 备份根目录
+            max_deltas: 每条备份链最多包含的增量数，超过后自动生成新的全量快照
+            keep_chains: 保留的备份链数量（每条链以一个全量快照开头）
+            max_age_days: 备份链的最长保留天数，None 表示不按时间清理
+            compress_level: gzip 压缩级别
+        """
+        self.data_manager = data_manager
+        self.backup_dir = backup_dir
+        self.max_deltas = max_deltas
+        self.keep_chains = keep_chains
+        self.max_age_days = max_age_days
+        self.compress_level = compress_level
+
+        # 同一时间只运行一个备份任务，避免并发写 manifest
+        self._backup_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+        self._scheduler_thread = None
+        self._scheduler_stop = threading.Event()
+
+    # ==================== 路径与元数据 ====================
+
+    def _type_dir(self, data_type: str, backup_dir: Optional[str] = None) -> str:
+        return os.path.join(backup_dir or self.backup_dir, data_type)
+
+    def _manifest_path(self, type_dir: str) -> str:
+        return os.path.join(type_dir, "manifest.json")
+
+    def _state_path(self, type_dir: str) -> str:
+        return os.path.join(type_dir, "state.json")
+
+    def _load_meta(self, file_path: str, default):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default
+
+    def _save_meta(self, file_path: str, data):
+        directory = os.path.dirname(file_path)
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp_', dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, file_path)
+
+    def _source_file(self, data_type: str) -> str:
+        if data_type == "conversations":
+            return self.data_manager.conversations_file
+        if data_type == "custom_roles":
+            return self.data_manager.custom_roles_file
+        raise ValueError(f"未知的数据类型: {data_type}")
+
+    # ==================== 备份 ====================
+
+    def backup(self, backup_dir: Optional[str] = None, full: bool = False) -> List[Dict]:
+        """
+        执行一次备份（对所有数据类型）
+
+        Args:
+            backup_dir: 备份根目录，默认使用初始化时的目录
+            full: 是否强制生成全量快照
+
+        Returns:
+            本次生成的备份条目列表（无变化的数据类型不会生成文件）
+        """
+        entries = []
+        root = backup_dir or self.backup_dir
+        os.makedirs(root, exist_ok=True)
+        with self._backup_lock, open(os.path.join(root, ".lock"), 'w') as lock_file:
+            # 多个 worker 进程共享同一备份目录时，只允许一个进程写入
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            for data_type in DATA_TYPES:
+                entry = self._backup_type(data_type, backup_dir, full)
+                if entry:
+                    entries.append(entry)
+        return entries
+
+    def backup_async(self, backup_dir: Optional[str] = None, full: bool = False) -> Future:
+        """在后台线程中执行备份，立即返回 Future"""
+        return self._executor.submit(self.backup, backup_dir, full)
+
+    def _snapshot_source(self, data_type: str, staging_dir: str) -> str:
+        """
+        为数据文件生成一致性快照
+
+        数据文件通过原子替换写入，因此在数据锁内创建硬链接即可得到
+        不再变化的快照，锁持有时间与数据量无关；不支持硬链接时退化为复制
+        """
+        source = self._source_file(data_type)
+        staging = os.path.join(staging_dir, f".staging_{data_type}.json")
+        if os.path.exists(staging):
+            os.remove(staging)
+
+        with self.data_manager._lock:
+            if not os.path.exists(source):
+                return ''
+            try:
+                os.link(source, staging)
+            except OSError:
+                shutil.copyfile(source, staging)
+        return staging
+
+    def _backup_type(self, data_type: str, backup_dir: Optional[str], full: bool) -> Optional[Dict]:
+        type_dir = self._type_dir(data_type, backup_dir)
+        os.makedirs(type_dir, exist_ok=True)
+
+        manifest = self._load_meta(self._manifest_path(type_dir), {"backups": []})
+        backups = manifest["backups"]
+        state = self._load_meta(self._state_path(type_dir), {})
+
+        # 决定本次是全量还是增量
+        chain_deltas = 0
+        for entry in reversed(backups):
+            if entry["kind"] == "full":
+                break
+            chain_deltas += 1
+        is_full = full or not backups or chain_deltas >= self.max_deltas
+        if is_full:
+            state = {}
+
+        staging = self._snapshot_source(data_type, type_dir)
+        if not staging:
+            return None
+
+        timestamp = datetime.now()
+        kind = "full" if is_full else "delta"
+        file_name = f"{data_type}_{timestamp.strftime('%Y%m%d_%H%M%S_%f')}_{kind}.ndjson.gz"
+        file_path = os.path.join(type_dir, file_name)
+
+        new_state = {}
+        puts = 0
+        raw_bytes = 0
+        try:
+            with gzip.open(file_path, 'wt', encoding='utf-8', compresslevel=self.compress_level) as out:
+                for record_id, value in iter_json_object_items(staging):
+                    digest = _record_digest(value)
+                    new_state[record_id] = digest
+                    if state.get(record_id) == digest:
+                        continue
+                    line = json.dumps({"op": "put", "id": record_id, "data": value}, ensure_ascii=False)
+                    out.write(line + "\n")
+                    raw_bytes += len(line.encode('utf-8')) + 1
+                    puts += 1
+
+                deleted = [record_id for record_id in state if record_id not in new_state]
+                for record_id in deleted:
+                    out.write(json.dumps({"op": "del", "id": record_id}, ensure_ascii=False) + "\n")
+        except Exception:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+        finally:
+            os.remove(staging)
+
+        if not is_full and puts == 0 and not deleted:
+            # 自上次备份以来没有变化，不产生空增量
+            os.remove(file_path)
+            return None
+
+        entry = {
+            "file": file_name,
+            "kind": kind,
+            "parent": None if is_full else backups[-1]["file"],
+            "created_at": timestamp.isoformat(),
+            "records": len(new_state),
+            "puts": puts,
+            "deletes": len(deleted),
+            "raw_bytes": raw_bytes,
+            "size": os.path.getsize(file_path),
+            "sha256": _file_sha256(file_path),
+        }
+        backups.append(entry)
+
+        self._apply_retention(type_dir, manifest)
+        self._save_meta(self._state_path(type_dir), new_state)
+        self._save_meta(self._manifest_path(type_dir), manifest)
+        return entry
+
+    # ==================== 保留策略 ====================
+
+    def _split_chains(self, backups: List[Dict]) -> List[List[Dict]]:
+        chains = []
+        for entry in backups:
+            if entry["kind"] == "full" or not chains:
+                chains.append([])
+            chains[-1].append(entry)
+        return chains
+
+    def _apply_retention(self, type_dir: str, manifest: Dict):
+        """按链数量和时间清理旧备份，始终保留最新的一条链"""
+        chains = self._split_chains(manifest["backups"])
+        keep = chains[-max(self.keep_chains, 1):]
+
+        if self.max_age_days is not None:
+            cutoff = datetime.now() - timedelta(days=self.max_age_days)
+            keep = [chain for chain in keep[:-1]
+                    if datetime.fromisoformat(chain[-1]["created_at"]) >= cutoff] + keep[-1:]
+
+        kept_files = {entry["file"] for chain in keep for entry in chain}
+        for entry in manifest["backups"]:
+            if entry["file"] not in kept_files:
+                path = os.path.join(type_dir, entry["file"])
+                if os.path.exists(path):
+                    os.remove(path)
+
+        manifest["backups"] = [entry for chain in keep for entry in chain]
+
+    # ==================== 查询 ====================
+
+    def list_backups(self, data_type: str, backup_dir: Optional[str] = None) -> List[Dict]:
+        """
+        列出某类数据的所有备份条目
+
+        Args:
+            data_type: 数据类型 ('conversations' 或 'custom_roles')
+            backup_dir: 备份根目录
+
+        Returns:
+            备份条目列表，按时间从旧到新
+        """
+        type_dir = self._type_dir(data_type, backup_dir)
+        return self._load_meta(self._manifest_path(type_dir), {"backups": []})["backups"]
+
+    # ==================== 恢复 ====================
+
+    def _resolve_chain(self, backup_file: str, data_type: str) -> List[str]:
+        """根据目标备份文件找到从全量快照到该文件的完整链，并校验每个文件"""
+        type_dir = os.path.dirname(os.path.abspath(backup_file))
+        manifest = self._load_meta(self._manifest_path(type_dir), {"backups": []})
+        by_file = {entry["file"]: entry for entry in manifest["backups"]}
+
+        chain = []
+        current = by_file.get(os.path.basename(backup_file))
+        if current is None:
+            raise ValueError(f"备份文件不在清单中: {backup_file}")
+        while current is not None:
+            chain.append(current)
+            current = by_file.get(current["parent"]) if current["parent"] else None
+        chain.reverse()
+
+        if chain[0]["kind"] != "full":
+            raise ValueError("备份链缺少全量快照")
+        if not os.path.basename(chain[0]["file"]).startswith(data_type):
+            raise ValueError(f"备份文件与数据类型不匹配: {data_type}")
+
+        paths = []
+        for entry in chain:
+            path = os.path.join(type_dir, entry["file"])
+            if _file_sha256(path) != entry["sha256"]:
+                raise ValueError(f"备份文件校验失败: {entry['file']}")
+            paths.append(path)
+        return paths
+
+    def _iter_ops(self, path: str):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def restore(self, backup_file: str, data_type: str) -> int:
+        """
+        流式恢复备份
+
+        增量链分两遍处理：第一遍确定每条记录最终版本所在的文件，
+        第二遍只写出最终版本，内存占用与记录数相关而与数据量无关
+
+        Args:
+            backup_file: 备份文件路径（链中的任意文件，或旧版 .json 全量备份）
+            data_type: 数据类型 ('conversations' 或 'custom_roles')
+
+        Returns:
+            恢复的记录数
+        """
+        target = self._source_file(data_type)
+        writer = JsonObjectWriter(target)
+        try:
+            if backup_file.endswith('.ndjson.gz'):
+                paths = self._resolve_chain(backup_file, data_type)
+
+                final_location = {}
+                for index, path in enumerate(paths):
+                    for op in self._iter_ops(path):
+                        final_location[op["id"]] = index if op["op"] == "put" else None
+
+                for index, path in enumerate(paths):
+                    for op in self._iter_ops(path):
+                        if op["op"] == "put" and final_location.get(op["id"]) == index:
+                            writer.write(op["id"], op["data"])
+                            # 同一文件中同一记录只写一次
+                            final_location[op["id"]] = -1
+            else:
+                # 兼容旧版整文件 JSON 备份
+                for record_id, value in iter_json_object_items(backup_file):
+                    writer.write(record_id, value)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+
+        self.data_manager._replace_data_file(writer.temp_path, target)
+        return writer.count
+
+    # ==================== 后台调度 ====================
+
+    def start_scheduler(self, interval_seconds: float):
+        """
+        启动后台定时备份线程
+
+        Args:
+            interval_seconds: 备份间隔（秒）
+        """
+        if self._scheduler_thread and self._scheduler_thread.is_alive():
+            return
+        self._scheduler_stop.clear()
+
+        def run():
+            while not self._scheduler_stop.wait(interval_seconds):
+                try:
+                    self.backup()
+                except Exception as e:
+                    print(f"定时备份失败: {e}")
+
+        self._scheduler_thread = threading.Thread(target=run, name='backup-scheduler', daemon=True)
+        self._scheduler_thread.start()
+
+    def stop_scheduler(self):
+        """停止后台定时备份线程"""
+        self._scheduler_stop.set()
+        if self._scheduler_thread:
+            self._scheduler_thread.join(timeout=5)
+            self._scheduler_thread = None
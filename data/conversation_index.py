@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+对话二级索引
+按 character_name 和 user_id 维护按 updated_at 排序的对话ID列表，
+查询时只访问命中键下的对话，不扫描无关对话
+"""
+
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+
+# 参与索引的字段
+INDEXED_FIELDS = ('character_name', 'user_id')
+
+
+class ConversationIndex:
+    """对话二级索引"""
+
+    def __init__(self):
+        # 字段 -> 键 -> [(updated_at, conversation_id), ...]（升序）
+        self._indexes: Dict[str, Dict[str, List[Tuple[str, str]]]] = {
+            field: {} for field in INDEXED_FIELDS
+        }
+        # conversation_id -> (updated_at, {字段: 键})，用于更新和删除时定位旧条目
+        self._entries: Dict[str, Tuple[str, Dict[str, str]]] = {}
+
+    def rebuild(self, conversations: Dict[str, Dict]):
+        """
+        根据全部对话重建索引
+
+        Args:
+            conversations: 对话ID到对话数据的映射
+        """
+        self.__init__()
+        for conversation in conversations.values():
+            self.upsert(conversation)
+
+    def upsert(self, conversation: Dict):
+        """
+        新增或更新一个对话的索引条目
+
+        Args:
+            conversation: 对话数据
+        """
+        conversation_id = conversation['id']
+        self.remove(conversation_id)
+
+        updated_at = conversation.get('updated_at') or conversation.get('created_at') or ''
+        keys = {field: conversation.get(field) or '' for field in INDEXED_FIELDS}
+        for field, key in keys.items():
+            insort(self._indexes[field].setdefault(key, []), (updated_at, conversation_id))
+        self._entries[conversation_id] = (updated_at, keys)
+
+    def remove(self, conversation_id: str):
+        """
+        删除一个对话的索引条目
+
+        Args:
+            conversation_id: 对话ID
+        """
+        entry = self._entries.pop(conversation_id, None)
+        if entry is None:
+            return
+
+        updated_at, keys = entry
+        for field, key in keys.items():
+            postings = self._indexes[field].get(key)
+            if not postings:
+                continue
+            position = bisect_left(postings, (updated_at, conversation_id))
+            if position < len(postings) and postings[position] == (updated_at, conversation_id):
+                del postings[position]
+            if not postings:
+                del self._indexes[field][key]
+
+    def count(self, field: str, key: str) -> int:
+        """返回某个键下的对话数"""
+        return len(self._indexes[field].get(key, ()))
+
+    def query(self, character_name: Optional[str] = None, user_id: Optional[str] = None,
+              offset: int = 0, limit: int = 20) -> Tuple[List[str], int]:
+        """
+        按角色和/或用户查询对话ID，按 updated_at 倒序分页
+
+        同时指定两个条件时，遍历较短的那个索引列表并按另一个字段过滤
+
+        Args:
+            character_name: 角色名称（可选）
+            user_id: 用户ID（可选）
+            offset: 起始偏移
+            limit: 最多返回的数量
+
+        Returns:
+            (对话ID列表, 命中总数)
+        """
+        conditions = {
+            field: key for field, key in (('character_name', character_name), ('user_id', user_id))
+            if key is not None
+        }
+        if not conditions:
+            raise ValueError("至少需要一个查询条件")
+
+        field = min(conditions, key=lambda name: self.count(name, conditions[name]))
+        postings = self._indexes[field].get(conditions[field], [])
+
+        if len(conditions) == 1:
+            total = len(postings)
+            end = max(total - offset, 0)
+            start = max(end - limit, 0)
+            return [conversation_id for _, conversation_id in reversed(postings[start:end])], total
+
+        other_field = 'user_id' if field == 'character_name' else 'character_name'
+        other_key = conditions[other_field]
+        matched = [
+            conversation_id for _, conversation_id in reversed(postings)
+            if self._entries[conversation_id][1][other_field] == other_key
+        ]
+        return matched[offset:offset + limit], len(matched)
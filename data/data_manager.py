@@ -6,9 +6,17 @@
 
 import json
 import os
+import tempfile
+import threading
 import uuid
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Callable, Dict, Iterable, List, Optional, Any, Tuple
+
+from data.backup_manager import BackupManager
+from data.conversation_index import ConversationIndex
+from data.search_index import MessageSearchIndex
+from data.json_stream import JsonObjectWriter, iter_json_object_items, preserve_file_mode
+from data.ndjson_io import validate_import_record
 
 class DataManager:
     """数据管理器 - 使用JSON文件存储数据"""
@@ -24,11 +32,27 @@ class DataManager:
         self.conversations_file = os.path.join(data_dir, "conversations.json")
         self.custom_roles_file = os.path.join(data_dir, "custom_roles.json")
         
+        # 读-改-写操作需要串行化，后台备份线程也依赖该锁获取一致性快照
+        self._lock = threading.RLock()
+        
+        # 对话数据内存缓存，按文件签名失效（其他进程写入或文件被替换时自动重新加载）
+        self._conversations_cache: Optional[Dict] = None
+        self._conversations_signature = None
+        # 按角色和用户的二级索引，随缓存一起重建，随写操作增量更新
+        self.conversation_index = ConversationIndex()
+        # 消息全文索引，缓存重新加载后标记为过期，下次搜索时增量对齐
+        self.search_index = MessageSearchIndex()
+        # 自定义角色修改计数，供角色目录快照判断是否需要重建
+        self._custom_roles_changes = 0
+        
         # 确保数据目录存在
         os.makedirs(data_dir, exist_ok=True)
         
         # 初始化数据文件
         self._init_data_files()
+        
+        # 增量备份管理器
+        self.backup_manager = BackupManager(self, os.path.join(data_dir, "backup"))
     
     def _init_data_files(self):
         """初始化数据文件"""
@@ -49,14 +73,60 @@ class DataManager:
             return {}
     
     def _save_json(self, file_path: str, data: Dict):
-        """保存JSON文件"""
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        """保存JSON文件（先写临时文件再原子替换，读者不会看到写了一半的文件）"""
+        directory = os.path.dirname(os.path.abspath(file_path))
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            preserve_file_mode(temp_path, file_path)
+            # 替换前取签名，避免替换后被其他进程再次改写造成误判
+            signature = self._file_signature(temp_path)
+            os.replace(temp_path, file_path)
+            return signature
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    
+    def _file_signature(self, file_path: str):
+        """文件签名（inode、修改时间、大小），用于判断缓存是否过期"""
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    
+    def _load_conversations(self) -> Dict:
+        """获取对话数据（带缓存），文件被外部修改或替换时重新加载并重建索引"""
+        with self._lock:
+            signature = self._file_signature(self.conversations_file)
+            if self._conversations_cache is None or signature != self._conversations_signature:
+                self._conversations_cache = self._load_json(self.conversations_file)
+                self._conversations_signature = signature
+                self.conversation_index.rebuild(self._conversations_cache)
+                self.search_index.stale = True
+            return self._conversations_cache
+    
+    def _save_conversations(self, conversations: Dict):
+        """保存对话数据并刷新缓存签名，写入失败时丢弃缓存"""
+        try:
+            self._conversations_signature = self._save_json(self.conversations_file, conversations)
+        except Exception:
+            self._conversations_cache = None
+            raise
+    
+    def _replace_data_file(self, temp_path: str, file_path: str):
+        """用已写好的临时文件原子替换数据文件"""
+        with self._lock:
+            preserve_file_mode(temp_path, file_path)
+            os.replace(temp_path, file_path)
     
     # ==================== 对话管理 ====================
     
     def save_conversation(self, conversation_id: str, user_id: str, 
-                         character_name: str, character_description: str) -> Dict:
+                         character_name: str, character_description: str,
+                         user_class: str = "registered") -> Dict:
         """
         保存对话信息
         
@@ -65,26 +135,30 @@ class DataManager:
             user_id: 用户ID
             character_name: 角色名称
             character_description: 角色描述
+            user_class: 用户类别 ('anonymous' 或 'registered')，决定保留策略
             
         Returns:
             对话信息字典
         """
-        conversations = self._load_json(self.conversations_file)
-        
-        conversation_data = {
-            "id": conversation_id,
-            "user_id": user_id,
-            "character_name": character_name,
-            "character_description": character_description,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat(),
-            "messages": []
-        }
-        
-        conversations[conversation_id] = conversation_data
-        self._save_json(self.conversations_file, conversations)
-        
-        return conversation_data
+        with self._lock:
+            conversations = self._load_conversations()
+        
+            conversation_data = {
+                "id": conversation_id,
+                "user_id": user_id,
+                "character_name": character_name,
+                "character_description": character_description,
+                "user_class": user_class,
+                "created_at": datetime.now().isoformat(),
+                "updated_at": datetime.now().isoformat(),
+                "messages": []
+            }
+        
+            conversations[conversation_id] = conversation_data
+            self._save_conversations(conversations)
+            self.conversation_index.upsert(conversation_data)
+        
+            return conversation_data
     
     def get_conversation(self, conversation_id: str) -> Optional[Dict]:
         """
@@ -96,7 +170,7 @@ class DataManager:
         Returns:
             对话信息字典或None
         """
-        conversations = self._load_json(self.conversations_file)
+        conversations = self._load_conversations()
         return conversations.get(conversation_id)
     
     def get_all_conversations(self) -> List[Dict]:
@@ -106,9 +180,87 @@ class DataManager:
         Returns:
             对话列表
         """
-        conversations = self._load_json(self.conversations_file)
+        conversations = self._load_conversations()
         return list(conversations.values())
     
+    def query_conversations(self, character_name: Optional[str] = None,
+                            user_id: Optional[str] = None,
+                            offset: int = 0, limit: int = 20) -> Dict:
+        """
+        通过二级索引按角色和/或用户查询对话，按更新时间倒序分页
+        
+        Args:
+            character_name: 角色名称（可选）
+            user_id: 用户ID（可选）
+            offset: 起始偏移
+            limit: 每页数量
+            
+        Returns:
+            {"conversations": 当前页对话列表, "total": 命中总数}
+        """
+        with self._lock:
+            conversations = self._load_conversations()
+            conversation_ids, total = self.conversation_index.query(
+                character_name=character_name, user_id=user_id, offset=offset, limit=limit
+            )
+            return {
+                "conversations": [conversations[conversation_id] for conversation_id in conversation_ids],
+                "total": total
+            }
+    
+    def search_messages(self, query: str, user_id: Optional[str] = None,
+                        character_name: Optional[str] = None,
+                        offset: int = 0, limit: int = 20) -> Dict:
+        """
+        全文搜索对话消息
+        
+        Args:
+            query: 查询语句，空白分隔的多个词需同时命中
+            user_id: 只搜索该用户的对话（可选）
+            character_name: 只搜索与该角色的对话（可选）
+            offset: 起始偏移
+            limit: 每页数量
+            
+        Returns:
+            {"results": 命中消息列表, "total": 命中数, "total_is_lower_bound": 命中数是否为下限}
+        """
+        with self._lock:
+            conversations = self._load_conversations()
+            if self.search_index.stale:
+                self.search_index.sync(conversations)
+            
+            allowed = None
+            if user_id is not None or character_name is not None:
+                allowed, _ = self.conversation_index.query(
+                    character_name=character_name, user_id=user_id, limit=len(conversations)
+                )
+            
+            def get_message(conversation_id: str, message_index: int) -> Optional[Dict]:
+                messages = conversations.get(conversation_id, {}).get("messages", [])
+                return messages[message_index] if message_index < len(messages) else None
+            
+            found = self.search_index.search(query, get_message, allowed, offset, limit)
+            
+            results = []
+            for conversation_id, message_index, snippet in found["hits"]:
+                conversation = conversations[conversation_id]
+                message = conversation["messages"][message_index]
+                results.append({
+                    "conversation_id": conversation_id,
+                    "user_id": conversation.get("user_id"),
+                    "character_name": conversation.get("character_name"),
+                    "message_index": message_index,
+                    "role": message.get("role"),
+                    "timestamp": message.get("timestamp"),
+                    "snippet": snippet
+                })
+            
+            return {
+                "results": results,
+                "total": found["total"],
+                "total_is_lower_bound": found["total_is_lower_bound"]
+            }
+    
     def add_message_to_conversation(self, conversation_id: str, role: str, content: str) -> bool:
         """
         向对话添加消息
@@ -121,22 +273,28 @@ class DataManager:
         Returns:
             是否成功添加
         """
-        conversations = self._load_json(self.conversations_file)
-        
-        if conversation_id not in conversations:
-            return False
+        with self._lock:
+            conversations = self._load_conversations()
         
-        message = {
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        conversations[conversation_id]["messages"].append(message)
-        conversations[conversation_id]["updated_at"] = datetime.now().isoformat()
+            if conversation_id not in conversations:
+                return False
         
-        self._save_json(self.conversations_file, conversations)
-        return True
+            message = {
+                "role": role,
+                "content": content,
+                "timestamp": datetime.now().isoformat()
+            }
+        
+            conversations[conversation_id]["messages"].append(message)
+            conversations[conversation_id]["updated_at"] = datetime.now().isoformat()
+        
+            self._save_conversations(conversations)
+            self.conversation_index.upsert(conversations[conversation_id])
+            if not self.search_index.stale:
+                self.search_index.add_message(
+                    conversation_id, len(conversations[conversation_id]["messages"]) - 1, content
+                )
+            return True
     
     def delete_conversation(self, conversation_id: str) -> bool:
         """
@@ -148,14 +306,201 @@ class DataManager:
         Returns:
             是否成功删除
         """
-        conversations = self._load_json(self.conversations_file)
+        with self._lock:
+            conversations = self._load_conversations()
         
-        if conversation_id in conversations:
-            del conversations[conversation_id]
-            self._save_json(self.conversations_file, conversations)
-            return True
+            if conversation_id in conversations:
+                del conversations[conversation_id]
+                self._save_conversations(conversations)
+                self.conversation_index.remove(conversation_id)
+                self.search_index.remove_conversation(conversation_id)
+                return True
+        
+            return False
+    
+    def delete_conversations(self, conversation_ids: List[str]) -> int:
+        """
+        批量删除对话（只写回一次数据文件）
+        
+        Args:
+            conversation_ids: 对话ID列表
+            
+        Returns:
+            实际删除的数量
+        """
+        with self._lock:
+            conversations = self._load_conversations()
+            removed = self._remove_loaded(conversations, conversation_ids)
+            if removed:
+                self._save_conversations(conversations)
+            return removed
+    
+    def _remove_loaded(self, conversations: Dict, conversation_ids: List[str]) -> int:
+        """从已加载的对话数据中删除对话并更新索引（调用时持有 self._lock，由调用方写回）"""
+        removed = [cid for cid in conversation_ids if conversations.pop(cid, None) is not None]
+        for conversation_id in removed:
+            self.conversation_index.remove(conversation_id)
+            self.search_index.remove_conversation(conversation_id)
+        return len(removed)
+    
+    def trim_conversations(self, conversation_ids: List[str], max_messages: int) -> tuple:
+        """
+        批量截断对话消息，只保留最近的 max_messages 条（只写回一次数据文件）
         
-        return False
+        Args:
+            conversation_ids: 对话ID列表
+            max_messages: 保留的最大消息数
+            
+        Returns:
+            (被截断的对话数, 删除的消息数)
+        """
+        with self._lock:
+            conversations = self._load_conversations()
+            trimmed, removed_messages = self._trim_loaded(conversations, conversation_ids, max_messages)
+            if trimmed:
+                self._save_conversations(conversations)
+            return trimmed, removed_messages
+    
+    def _trim_loaded(self, conversations: Dict, conversation_ids: List[str], max_messages: int) -> tuple:
+        """截断已加载的对话数据中的消息（调用时持有 self._lock，由调用方写回）"""
+        trimmed = 0
+        removed_messages = 0
+        for conversation_id in conversation_ids:
+            conversation = conversations.get(conversation_id)
+            messages = conversation.get("messages", []) if conversation else []
+            if len(messages) <= max_messages:
+                continue
+            removed_messages += len(messages) - max_messages
+            conversation["messages"] = messages[-max_messages:]
+            trimmed += 1
+            # 消息下标整体变化，由全文索引在下次搜索时重新索引该对话
+            self.search_index.remove_conversation(conversation_id)
+            self.search_index.stale = True
+        return trimmed, removed_messages
+    
+    def apply_retention(self, delete_ids: List[str], archive_ids: List[str], trim_ids: List[str],
+                        max_messages: int, archive: Callable[[List[Dict]], int]) -> Dict:
+        """
+        一次性执行保留策略的删除、归档和截断，只写回一次数据文件
+        
+        Args:
+            delete_ids: 待删除的对话ID
+            archive_ids: 待归档（写入归档后删除）的对话ID
+            trim_ids: 待截断消息的对话ID
+            max_messages: 截断后保留的最大消息数
+            archive: 写入归档的回调，参数为对话列表，返回写入的字节数
+            
+        Returns:
+            各项处理数量
+        """
+        with self._lock:
+            conversations = self._load_conversations()
+            archived = [conversations[cid] for cid in archive_ids if cid in conversations]
+            archived_bytes = archive(archived) if archived else 0
+            result = {
+                "deleted": self._remove_loaded(conversations, delete_ids),
+                "archived": self._remove_loaded(conversations, [c["id"] for c in archived]),
+                "archived_bytes": archived_bytes,
+            }
+            result["trimmed"], result["trimmed_messages"] = self._trim_loaded(conversations, trim_ids, max_messages)
+            if result["deleted"] or result["archived"] or result["trimmed"]:
+                self._save_conversations(conversations)
+            return result
+    
+    def import_conversations(self, records: Iterable[Dict], batch_size: int = 500,
+                             batch_bytes: int = 4 * 1024 * 1024) -> Dict:
+        """
+        批量导入对话
+        
+        对话记录整体替换同ID的已有对话（不含 messages 时消息清空），
+        消息记录追加到对应对话（同一批中先于对话记录到达的消息也保留）；
+        记录按批合并写入，每批的记录数和数据量都有固定上限，内存不随导入量或数据文件大小增长。
+        每批都流式重写一次数据文件，代价是总写入量约为 批数 × 文件大小
+        
+        Args:
+            records: 记录迭代器，见 data.ndjson_io.iter_import_records（应先用 validate_import_records 校验）
+            batch_size: 每批写入的最大记录数
+            batch_bytes: 每批缓存记录的最大字节数（按JSON长度估算）
+            
+        Returns:
+            导入统计信息
+        
+        Raises:
+            ImportValidationError: 记录格式错误（之前的批次已经写入，调用方应先完整校验）
+        """
+        stats = {"conversations": 0, "messages": 0, "batches": 0, "error_count": 0, "errors": []}
+        pending: Dict[str, Dict] = {}
+        buffered = 0
+        pending_bytes = 0
+        
+        for record in records:
+            validate_import_record(record)
+            record_type = record.pop("type")
+            record.pop("line", None)
+            
+            if record_type == "conversation":
+                record.setdefault("messages", [])
+                entry = pending.setdefault(record["id"], {"conversation": None, "messages": []})
+                entry["conversation"] = record
+                stats["conversations"] += 1
+            else:
+                conversation_id = record.pop("conversation_id")
+                record.setdefault("timestamp", datetime.now().isoformat())
+                entry = pending.setdefault(conversation_id, {"conversation": None, "messages": []})
+                entry["messages"].append(record)
+                stats["messages"] += 1
+            
+            buffered += 1
+            pending_bytes += len(json.dumps(record, ensure_ascii=False))
+            if buffered >= batch_size or pending_bytes >= batch_bytes:
+                self._merge_conversation_batch(pending, stats)
+                pending, buffered, pending_bytes = {}, 0, 0
+        
+        if pending:
+            self._merge_conversation_batch(pending, stats)
+        return stats
+    
+    def _merge_conversation_batch(self, batch: Dict[str, Dict], stats: Dict):
+        """将一批导入记录与数据文件流式合并，一次原子替换写回"""
+        with self._lock:
+            writer = JsonObjectWriter(self.conversations_file)
+            try:
+                for conversation_id, conversation in iter_json_object_items(self.conversations_file):
+                    entry = batch.pop(conversation_id, None)
+                    if entry:
+                        conversation = self._apply_import_entry(conversation, entry)
+                    writer.write(conversation_id, conversation)
+                
+                for conversation_id, entry in batch.items():
+                    if entry["conversation"] is None:
+                        self._record_import_error(stats, {
+                            "conversation_id": conversation_id,
+                            "error": f"对话不存在，跳过 {len(entry['messages'])} 条消息"
+                        })
+                        stats["messages"] -= len(entry["messages"])
+                        continue
+                    writer.write(conversation_id, self._apply_import_entry(None, entry))
+                writer.close()
+            except Exception:
+                writer.abort()
+                raise
+            self._replace_data_file(writer.temp_path, self.conversations_file)
+        stats["batches"] += 1
+    
+    def _record_import_error(self, stats: Dict, error: Dict, limit: int = 100):
+        """记录导入错误，只保留前 limit 条明细"""
+        stats["error_count"] += 1
+        if len(stats["errors"]) < limit:
+            stats["errors"].append(error)
+    
+    def _apply_import_entry(self, conversation: Optional[Dict], entry: Dict) -> Dict:
+        if entry["conversation"] is not None:
+            conversation = entry["conversation"]
+        if entry["messages"]:
+            conversation.setdefault("messages", []).extend(entry["messages"])
+            conversation["updated_at"] = max(conversation.get("updated_at", ""),
+                                             entry["messages"][-1]["timestamp"])
+        return conversation
     
     # ==================== 自定义角色管理 ====================
     
@@ -169,21 +514,23 @@ class DataManager:
         Returns:
             保存的角色数据
         """
-        custom_roles = self._load_json(self.custom_roles_file)
+        with self._lock:
+            custom_roles = self._load_json(self.custom_roles_file)
         
-        # 确保有ID
-        if "id" not in role_data:
-            role_data["id"] = str(uuid.uuid4())
+            # 确保有ID
+            if "id" not in role_data:
+                role_data["id"] = str(uuid.uuid4())
         
-        # 添加时间戳
-        role_data["created_at"] = datetime.now().isoformat()
-        role_data["updated_at"] = datetime.now().isoformat()
-        role_data["is_custom"] = True
+            # 添加时间戳
+            role_data["created_at"] = datetime.now().isoformat()
+            role_data["updated_at"] = datetime.now().isoformat()
+            role_data["is_custom"] = True
         
-        custom_roles[role_data["id"]] = role_data
-        self._save_json(self.custom_roles_file, custom_roles)
+            custom_roles[role_data["id"]] = role_data
+            self._save_json(self.custom_roles_file, custom_roles)
+            self._custom_roles_changes += 1
         
-        return role_data
+            return role_data
     
     def get_custom_role(self, role_id: str) -> Optional[Dict]:
         """
@@ -219,22 +566,47 @@ class DataManager:
         Returns:
             是否成功更新
         """
-        custom_roles = self._load_json(self.custom_roles_file)
+        with self._lock:
+            custom_roles = self._load_json(self.custom_roles_file)
         
-        if role_id not in custom_roles:
-            return False
+            if role_id not in custom_roles:
+                return False
         
-        # 保留原有数据，只更新提供的字段
-        existing_role = custom_roles[role_id]
-        for key, value in role_data.items():
-            if key != "id":  # 不允许修改ID
-                existing_role[key] = value
+            # 保留原有数据，只更新提供的字段
+            existing_role = custom_roles[role_id]
+            for key, value in role_data.items():
+                if key != "id":  # 不允许修改ID
+                    existing_role[key] = value
         
-        existing_role["updated_at"] = datetime.now().isoformat()
+            existing_role["updated_at"] = datetime.now().isoformat()
         
-        self._save_json(self.custom_roles_file, custom_roles)
-        return True
+            self._save_json(self.custom_roles_file, custom_roles)
+            self._custom_roles_changes += 1
+            return True
     
+    def fill_missing_custom_role_field(self, field: str, compute) -> int:
+        """
+        为缺少某字段的自定义角色补全该字段（不修改 updated_at，全部补全后只写一次文件）
+
+        Args:
+            field: 字段名
+            compute: 根据角色数据计算字段值的回调
+
+        Returns:
+            补全的角色数量
+        """
+        with self._lock:
+            custom_roles = self._load_json(self.custom_roles_file)
+            filled = 0
+            for role in custom_roles.values():
+                if not role.get(field):
+                    role[field] = compute(role)
+                    filled += 1
+            if filled:
+                self._save_json(self.custom_roles_file, custom_roles)
+                self._custom_roles_changes += 1
+            return filled
+
     def delete_custom_role(self, role_id: str) -> bool:
         """
         删除自定义角色
@@ -245,14 +617,25 @@ class DataManager:
         Returns:
             是否成功删除
         """
-        custom_roles = self._load_json(self.custom_roles_file)
+        with self._lock:
+            custom_roles = self._load_json(self.custom_roles_file)
         
-        if role_id in custom_roles:
-            del custom_roles[role_id]
-            self._save_json(self.custom_roles_file, custom_roles)
-            return True
+            if role_id in custom_roles:
+                del custom_roles[role_id]
+                self._save_json(self.custom_roles_file, custom_roles)
+                self._custom_roles_changes += 1
+                return True
+        
+            return False
+    
+    def custom_roles_version(self) -> Tuple:
+        """
+        自定义角色数据版本号：本进程内的修改计数加上数据文件签名（覆盖恢复备份和其他进程的写入）
         
-        return False
+        Returns:
+            可比较的版本号
+        """
+        return (self._custom_roles_changes, self._file_signature(self.custom_roles_file))
     
     def search_custom_roles(self, keyword: str) -> List[Dict]:
         """
@@ -285,7 +668,7 @@ class DataManager:
         Returns:
             统计信息字典
         """
-        conversations = self._load_json(self.conversations_file)
+        conversations = self._load_conversations()
         custom_roles = self._load_json(self.custom_roles_file)
         
         total_messages = 0
@@ -300,52 +683,68 @@ class DataManager:
             "last_updated": datetime.now().isoformat()
         }
     
-    def backup_data(self, backup_dir: str = "data/backup") -> str:
+    def backup_data(self, backup_dir: str = "data/backup", full: bool = False,
+                    background: bool = False) -> str:
         """
-        备份数据
+        备份数据（增量 + gzip 压缩 + 自动轮转）
+        
+        首次备份或增量链过长时生成全量快照，其余情况只写入自上次备份以来
+        新增、修改和删除的记录；数据锁只在创建快照硬链接时短暂持有
         
         Args:
             backup_dir: 备份目录
+            full: 是否强制生成全量快照
+            background: 是否在后台线程中执行，不阻塞调用方
             
         Returns:
-            备份文件路径
+            备份目录路径
         """
-        os.makedirs(backup_dir, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # 备份对话数据
-        conversations = self._load_json(self.conversations_file)
-        backup_file = os.path.join(backup_dir, f"conversations_backup_{timestamp}.json")
-        self._save_json(backup_file, conversations)
+        if background:
+            self.backup_manager.backup_async(backup_dir, full)
+        else:
+            self.backup_manager.backup(backup_dir, full)
+        return backup_dir
+    
+    def list_backups(self, data_type: str, backup_dir: str = "data/backup") -> List[Dict]:
+        """
+        列出备份
         
-        # 备份自定义角色数据
-        custom_roles = self._load_json(self.custom_roles_file)
-        backup_file = os.path.join(backup_dir, f"custom_roles_backup_{timestamp}.json")
-        self._save_json(backup_file, custom_roles)
+        Args:
+            data_type: 数据类型 ('conversations' 或 'custom_roles')
+            backup_dir: 备份目录
+            
+        Returns:
+            备份条目列表，按时间从旧到新
+        """
+        return self.backup_manager.list_backups(data_type, backup_dir)
+    
+    def start_backup_scheduler(self, interval_seconds: float):
+        """
+        启动后台定时备份
         
-        return backup_dir
+        Args:
+            interval_seconds: 备份间隔（秒）
+        """
+        self.backup_manager.start_scheduler(interval_seconds)
     
     def restore_data(self, backup_file: str, data_type: str) -> bool:
         """
         恢复数据
         
+        流式读取备份并写入临时文件，校验通过后才原子替换数据文件
+        
         Args:
-            backup_file: 备份文件路径
+            backup_file: 备份文件路径（增量链中的任意 .ndjson.gz 文件，或旧版 .json 备份）
             data_type: 数据类型 ('conversations' 或 'custom_roles')
             
         Returns:
             是否成功恢复
         """
+        if data_type not in ("conversations", "custom_roles"):
+            return False
+        
         try:
-            backup_data = self._load_json(backup_file)
-            
-            if data_type == "conversations":
-                self._save_json(self.conversations_file, backup_data)
-            elif data_type == "custom_roles":
-                self._save_json(self.custom_roles_file, backup_data)
-            else:
-                return False
-            
+            self.backup_manager.restore(backup_file, data_type)
             return True
         except Exception as e:
             print(f"恢复数据失败: {e}")
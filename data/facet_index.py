@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+角色分面索引
+按分类和标签维护角色ID集合及计数，角色浏览页一次请求即可得到：
+- 各分类、各标签的角色数（分类计数不受分类筛选影响，便于切换分类；标签计数基于当前结果）
+- 分类与标签组合筛选后的角色列表
+未加筛选时直接返回预先维护的计数，角色增删改时增量更新
+索引中保存的是角色仓库中的 Role 对象（见 role_repository.py）
+"""
+
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+FACET_FIELDS = ('category', 'tag')
+
+
+class FacetIndex:
+    """角色分面索引"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        # 角色ID -> 角色对象（保持目录顺序：预设角色在前，自定义角色按加入顺序）
+        self._roles: Dict[str, Any] = {}
+        self._custom_ids: Set[str] = set()
+        # 字段 -> 值 -> 角色ID集合
+        self._postings: Dict[str, Dict[str, Set[str]]] = {field: {} for field in FACET_FIELDS}
+        # 未筛选时的计数，分别统计全部角色和仅预设角色
+        self._counts: Dict[bool, Dict[str, Counter]] = {
+            include_custom: {field: Counter() for field in FACET_FIELDS} for include_custom in (True, False)
+        }
+        # 构建索引时对应的自定义角色数据版本
+        self.version = None
+
+    @staticmethod
+    def _facet_values(role) -> Dict[str, Set[str]]:
+        return {
+            'category': {role.category or 'custom'},
+            'tag': {tag for tag in role.tags if tag},
+        }
+
+    def rebuild(self, roles: Iterable[Any], version=None):
+        """
+        根据全部角色重建索引
+
+        Args:
+            roles: 角色列表（预设角色和自定义角色）
+            version: 自定义角色数据版本
+        """
+        with self._lock:
+            self._reset()
+            for role in roles:
+                self.upsert(role)
+            self.version = version
+
+    def upsert(self, role):
+        """
+        新增或更新一个角色
+
+        Args:
+            role: 角色对象
+        """
+        role_id = role.id
+        with self._lock:
+            if role_id in self._roles:
+                self._unindex(role_id)
+            self._roles[role_id] = role
+
+            is_custom = bool(role.is_custom)
+            if is_custom:
+                self._custom_ids.add(role_id)
+            for field, values in self._facet_values(role).items():
+                for value in values:
+                    self._postings[field].setdefault(value, set()).add(role_id)
+                    self._counts[True][field][value] += 1
+                    if not is_custom:
+                        self._counts[False][field][value] += 1
+
+    def remove(self, role_id: str):
+        """
+        删除一个角色
+
+        Args:
+            role_id: 角色ID
+        """
+        with self._lock:
+            if role_id in self._roles:
+                self._unindex(role_id)
+                del self._roles[role_id]
+
+    def _unindex(self, role_id: str):
+        role = self._roles[role_id]
+        is_custom = role_id in self._custom_ids
+        self._custom_ids.discard(role_id)
+        for field, values in self._facet_values(role).items():
+            for value in values:
+                postings = self._postings[field].get(value)
+                if postings is not None:
+                    postings.discard(role_id)
+                    if not postings:
+                        del self._postings[field][value]
+                for include_custom in ((True,) if is_custom else (True, False)):
+                    counts = self._counts[include_custom][field]
+                    counts[value] -= 1
+                    if counts[value] <= 0:
+                        del counts[value]
+
+    def get(self, role_id: str) -> Optional[Any]:
+        """按ID获取角色"""
+        return self._roles.get(role_id)
+
+    # ==================== 查询 ====================
+
+    def _union(self, field: str, values: Iterable[str]) -> Set[str]:
+        result = set()
+        for value in values:
+            result |= self._postings[field].get(value, set())
+        return result
+
+    def _intersection(self, field: str, values: Iterable[str]) -> Set[str]:
+        result = None
+        for value in sorted(values, key=lambda v: len(self._postings[field].get(v, ()))):
+            postings = self._postings[field].get(value, set())
+            result = set(postings) if result is None else result & postings
+            if not result:
+                break
+        return result if result is not None else set()
+
+    def _count(self, role_ids: Iterable[str], field: str) -> Counter:
+        counts = Counter()
+        for role_id in role_ids:
+            counts.update(self._facet_values(self._roles[role_id])[field])
+        return counts
+
+    def query(self, categories: Optional[List[str]] = None, tags: Optional[List[str]] = None,
+              match_all_tags: bool = True, include_custom: bool = True) -> Tuple[List[Any], Dict[str, List[Dict]]]:
+        """
+        按分类和标签筛选角色并统计分面计数
+
+        Args:
+            categories: 分类列表（"或"关系），为空表示不限
+            tags: 标签列表，为空表示不限
+            match_all_tags: 标签为"与"关系（默认）还是"或"关系
+            include_custom: 是否包含自定义角色
+
+        Returns:
+            (按目录顺序排列的角色列表, {'categories': [...], 'tags': [...]})，
+            计数项形如 {'value': '星穹铁道', 'count': 15}，按数量降序
+        """
+        with self._lock:
+            if not categories and not tags:
+                counts = self._counts[include_custom]
+                roles = [role for role_id, role in self._roles.items()
+                         if include_custom or role_id not in self._custom_ids]
+                return roles, self._format(counts['category'], counts['tag'])
+
+            universe = None if include_custom else set(self._roles) - self._custom_ids
+            tag_matched = None
+            if tags:
+                tag_matched = (self._intersection if match_all_tags else self._union)('tag', tags)
+                if universe is not None:
+                    tag_matched &= universe
+            category_matched = self._union('category', categories) if categories else None
+
+            # 分类计数只应用标签筛选，切换分类时可以看到每个分类下的结果数
+            category_base = tag_matched if tag_matched is not None else (
+                universe if universe is not None else set(self._roles))
+            matched = category_base if category_matched is None else category_base & category_matched
+
+            roles = [role for role_id, role in self._roles.items() if role_id in matched]
+            return roles, self._format(self._count(category_base, 'category'), self._count(matched, 'tag'))
+
+    @staticmethod
+    def _format(category_counts: Counter, tag_counts: Counter) -> Dict[str, List[Dict]]:
+        return {
+            'categories': [{'value': value, 'count': count} for value, count in category_counts.most_common()],
+            'tags': [{'value': value, 'count': count} for value, count in tag_counts.most_common()],
+        }
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+JSON流式读写工具
+逐条解析/写出顶层JSON对象，内存占用只与单条记录大小相关，与文件总大小无关
+"""
+
+import json
+import os
+import tempfile
+from typing import Any, Iterator, Tuple
+
+_WHITESPACE = ' \t\n\r'
+
+
+def preserve_file_mode(temp_path: str, file_path: str):
+    """mkstemp 创建的文件权限为 0600，替换前沿用目标文件原有的权限"""
+    try:
+        mode = os.stat(file_path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    os.chmod(temp_path, mode)
+
+
+def iter_json_object_items(file_path: str, chunk_size: int = 64 * 1024) -> Iterator[Tuple[str, Any]]:
+    """
+    流式遍历顶层为对象的JSON文件，逐个产出 (key, value)
+
+    Args:
+        file_path: JSON文件路径
+        chunk_size: 每次读取的字符数
+
+    Yields:
+        (键, 值) 元组
+
+    Raises:
+        ValueError: 文件内容不是合法的JSON对象
+    """
+    decoder = json.JSONDecoder()
+
+    with open(file_path, 'r', encoding='utf-8') as f:
+        buf = ''
+        pos = 0
+        eof = False
+
+        def read_more(size: int) -> bool:
+            nonlocal buf, pos, eof
+            if eof:
+                return False
+            chunk = f.read(size)
+            if not chunk:
+                eof = True
+                return False
+            # 丢弃已消费的前缀，避免缓冲区无限增长
+            buf = buf[pos:] + chunk
+            pos = 0
+            return True
+
+        def skip_ws():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in _WHITESPACE:
+                    pos += 1
+                if pos < len(buf) or not read_more(chunk_size):
+                    return
+
+        def expect(chars: str) -> str:
+            skip_ws()
+            if pos >= len(buf) or buf[pos] not in chars:
+                found = buf[pos] if pos < len(buf) else 'EOF'
+                raise ValueError(f"JSON格式错误: 期望 {chars!r}，实际为 {found!r}")
+            return buf[pos]
+
+        def decode_value() -> Any:
+            nonlocal pos
+            skip_ws()
+            size = chunk_size
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # 值恰好结束在缓冲区末尾时（如数字）可能被截断，需要再读一段确认
+                    if end < len(buf) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise ValueError(f"JSON格式错误: {file_path} 内容不完整")
+                # 大记录跨越多个分块时，按倍数扩大读取量以减少重复解析
+                read_more(size)
+                size *= 2
+
+        expect('{')
+        pos += 1
+        skip_ws()
+        if pos < len(buf) and buf[pos] == '}':
+            return
+
+        while True:
+            expect('"')
+            key = decode_value()
+            expect(':')
+            pos += 1
+            value = decode_value()
+            yield key, value
+
+            sep = expect(',}')
+            pos += 1
+            if sep == '}':
+                return
+
+
+class JsonObjectWriter:
+    """
+    流式写出顶层JSON对象
+
+    先写入同目录下的临时文件，commit() 时原子替换目标文件，
+    中途出错则丢弃临时文件，目标文件保持不变
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        directory = os.path.dirname(os.path.abspath(file_path))
+        fd, self.temp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=directory)
+        self._file = os.fdopen(fd, 'w', encoding='utf-8')
+        self._file.write('{')
+        self._first = True
+        self.count = 0
+
+    def write(self, key: str, value: Any):
+        """
+        写入一条记录
+
+        Raises:
+            TypeError: 键不是字符串（写出的内容将不再是合法的JSON）
+        """
+        if not isinstance(key, str):
+            raise TypeError(f"JSON对象的键必须是字符串，实际为 {type(key).__name__}")
+        self._file.write('\n  ' if self._first else ',\n  ')
+        self._file.write(json.dumps(key, ensure_ascii=False))
+        self._file.write(': ')
+        self._file.write(json.dumps(value, ensure_ascii=False))
+        self._first = False
+        self.count += 1
+
+    def close(self):
+        """结束写入并关闭临时文件，此时尚未替换目标文件"""
+        if not self._file.closed:
+            self._file.write('\n}' if not self._first else '}')
+            self._file.close()
+
+    def commit(self):
+        """关闭临时文件并原子替换目标文件"""
+        self.close()
+        preserve_file_mode(self.temp_path, self.file_path)
+        os.replace(self.temp_path, self.file_path)
+
+    def abort(self):
+        """放弃写入，删除临时文件"""
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
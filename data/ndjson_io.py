@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+对话数据的 NDJSON 导入导出
+
+每行一个 JSON 对象，支持两种粒度：
+- conversation: 一行一个完整对话 {"type": "conversation", ..., "messages": [...]}
+- message: 先输出对话头 {"type": "conversation", ...}（不含消息），
+  再逐行输出 {"type": "message", "conversation_id": ..., "role": ..., "content": ..., "timestamp": ...}
+
+导入前先完整校验一遍（请求体先写入临时文件），遇到第一条格式错误的记录即中止，不会只导入一部分
+
+命令行用法：
+    python -m data.ndjson_io export -o conversations.ndjson [--mode message]
+    python -m data.ndjson_io import conversations.ndjson [--batch-size 500]
+"""
+
+import argparse
+import io
+import json
+import shutil
+import sys
+import tempfile
+from typing import Any, Dict, IO, Iterable, Iterator, Optional
+
+from data.json_stream import iter_json_object_items
+
+EXPORT_MODES = ('conversation', 'message')
+
+
+class ImportValidationError(ValueError):
+    """导入记录格式错误"""
+
+    def __init__(self, line: Optional[int], message: str):
+        super().__init__(f"第 {line} 行: {message}" if line else message)
+        self.line = line
+
+
+def export_conversations(data_manager, mode: str = 'conversation',
+                         user_id: Optional[str] = None,
+                         character_name: Optional[str] = None) -> Iterator[str]:
+    """
+    流式导出对话，逐行产出 NDJSON 文本
+
+    数据文件通过原子替换写入，打开后的文件句柄始终指向一致的旧版本，
+    因此导出期间的写入不会影响导出结果
+
+    Args:
+        data_manager: 数据管理器实例
+        mode: 导出粒度 ('conversation' 或 'message')
+        user_id: 只导出该用户的对话（可选）
+        character_name: 只导出该角色的对话（可选）
+
+    Yields:
+        以换行结尾的 JSON 行
+    """
+    if mode not in EXPORT_MODES:
+        raise ValueError(f"不支持的导出模式: {mode}")
+
+    for conversation_id, conversation in iter_json_object_items(data_manager.conversations_file):
+        if user_id and conversation.get('user_id') != user_id:
+            continue
+        if character_name and conversation.get('character_name') != character_name:
+            continue
+
+        if mode == 'conversation':
+            yield json.dumps({'type': 'conversation', **conversation}, ensure_ascii=False) + '\n'
+            continue
+
+        messages = conversation.get('messages', [])
+        header = {key: value for key, value in conversation.items() if key != 'messages'}
+        yield json.dumps({'type': 'conversation', **header}, ensure_ascii=False) + '\n'
+        for message in messages:
+            yield json.dumps({'type': 'message', 'conversation_id': conversation_id, **message},
+                             ensure_ascii=False) + '\n'
+
+
+def iter_import_records(lines: Iterable) -> Iterator[Dict]:
+    """
+    解析 NDJSON 行，跳过空行；无法解析的行产出 {'type': 'error'}
+
+    Args:
+        lines: 文本或字节行的可迭代对象
+
+    Yields:
+        记录字典
+    """
+    for line_number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield {'type': 'error', 'line': line_number, 'error': str(e)}
+            continue
+        if not isinstance(record, dict):
+            yield {'type': 'error', 'line': line_number, 'error': '每行必须是JSON对象'}
+            continue
+        # 没有 type 字段的完整对话（如直接导出的对话对象）按对话处理
+        record.setdefault('type', 'message' if 'conversation_id' in record else 'conversation')
+        record['line'] = line_number
+        yield record
+
+
+def _is_valid_id(value: Any) -> bool:
+    """对话ID必须是非空字符串（写入数据文件时作为JSON对象的键）"""
+    return isinstance(value, str) and bool(value)
+
+
+def validate_import_record(record: Dict):
+    """
+    校验一条导入记录的结构
+
+    Args:
+        record: iter_import_records 产出的记录
+
+    Raises:
+        ImportValidationError: 记录无法导入
+    """
+    line = record.get('line')
+    record_type = record.get('type')
+    if record_type == 'error':
+        raise ImportValidationError(line, record.get('error', '无法解析的记录'))
+    if record_type == 'conversation':
+        if not _is_valid_id(record.get('id')):
+            raise ImportValidationError(line, '对话ID必须是非空字符串')
+        messages = record.get('messages', [])
+        if not isinstance(messages, list) or not all(isinstance(message, dict) for message in messages):
+            raise ImportValidationError(line, 'messages 必须是由对象组成的数组')
+        if not isinstance(record.get('updated_at', ''), str):
+            raise ImportValidationError(line, 'updated_at 必须是字符串')
+    elif record_type == 'message':
+        if not _is_valid_id(record.get('conversation_id')):
+            raise ImportValidationError(line, '对话ID必须是非空字符串')
+        if not isinstance(record.get('timestamp', ''), str):
+            raise ImportValidationError(line, 'timestamp 必须是字符串')
+    else:
+        raise ImportValidationError(line, f"不支持的记录类型: {record_type}")
+
+
+def validate_import_records(records: Iterable[Dict]) -> int:
+    """
+    校验全部导入记录（不写入数据）
+
+    Returns:
+        记录数
+
+    Raises:
+        ImportValidationError: 第一条无法导入的记录
+    """
+    count = 0
+    for record in records:
+        validate_import_record(record)
+        count += 1
+    return count
+
+
+def spool_import_source(source: IO) -> IO:
+    """
+    把导入数据（请求体或标准输入）写入临时文件，以便先校验再导入
+
+    Args:
+        source: 二进制或文本输入流
+
+    Returns:
+        已回到开头的二进制临时文件（调用方负责关闭）
+    """
+    spool = tempfile.TemporaryFile('w+b')
+    try:
+        if isinstance(source, io.TextIOBase):
+            for line in source:
+                spool.write(line.encode('utf-8'))
+        else:
+            shutil.copyfileobj(source, spool)
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool
+
+
+def import_ndjson(data_manager, source: IO, batch_size: int = 500) -> Dict:
+    """
+    校验并导入 NDJSON 数据：先完整校验一遍，全部合法后再按批写入
+
+    Args:
+        data_manager: 数据管理器实例
+        source: 输入流
+        batch_size: 每批写入的记录数
+
+    Returns:
+        导入统计信息
+
+    Raises:
+        ImportValidationError: 数据中有无法导入的记录（此时没有写入任何数据）
+    """
+    with spool_import_source(source) as spool:
+        validate_import_records(iter_import_records(spool))
+        spool.seek(0)
+        return data_manager.import_conversations(iter_import_records(spool), batch_size)
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='对话数据 NDJSON 导入导出')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='导出对话')
+    export_parser.add_argument('-o', '--output', default='-', help='输出文件，默认标准输出')
+    export_parser.add_argument('--mode', choices=EXPORT_MODES, default='conversation', help='导出粒度')
+    export_parser.add_argument('--user-id', help='只导出该用户的对话')
+    export_parser.add_argument('--character-name', help='只导出该角色的对话')
+
+    import_parser = subparsers.add_parser('import', help='导入对话')
+    import_parser.add_argument('input', nargs='?', default='-', help='输入文件，默认标准输入')
+    import_parser.add_argument('--batch-size', type=int, default=500, help='每批写入的记录数')
+
+    args = parser.parse_args(argv)
+
+    from data.data_manager import data_manager
+
+    if args.command == 'export':
+        out: IO = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+        try:
+            for line in export_conversations(data_manager, args.mode, args.user_id, args.character_name):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    else:
+        source: IO = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+        try:
+            stats = import_ndjson(data_manager, source, args.batch_size)
+        except ImportValidationError as e:
+            print(f"导入失败，没有写入任何数据: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+        print(json.dumps(stats, ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+对话保留策略引擎
+- 按用户类别（anonymous / registered）配置空闲过期时间（TTL），过期对话直接删除
+- 空闲超过归档期限的对话移入 gzip 压缩的 NDJSON 归档文件
+- 限制单个对话保留的最大消息数，超出部分从最早的消息开始截断
+后台清理器分块扫描（每块只短暂持有数据锁），删除、归档和截断在一轮中合并执行、只写回一次数据文件，
+并报告回收的字节数
+"""
+
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+USER_CLASSES = ('anonymous', 'registered')
+
+
+class RetentionPolicy:
+    """保留策略配置（天数或条数为0表示不限制）"""
+
+    def __init__(self, ttl_days: Optional[Dict[str, float]] = None,
+                 max_messages: int = 0, archive_idle_days: float = 0):
+        """
+        Args:
+            ttl_days: 各用户类别的空闲过期天数，如 {'anonymous': 7, 'registered': 0}
+            max_messages: 单个对话保留的最大消息数
+            archive_idle_days: 空闲多少天后归档
+        """
+        self.ttl_days = {user_class: 0 for user_class in USER_CLASSES}
+        self.ttl_days.update(ttl_days or {})
+        self.max_messages = max_messages
+        self.archive_idle_days = archive_idle_days
+
+    def to_dict(self) -> Dict:
+        return {
+            "ttl_days": dict(self.ttl_days),
+            "max_messages": self.max_messages,
+            "archive_idle_days": self.archive_idle_days
+        }
+
+
+def classify_user(conversation: Dict) -> str:
+    """
+    判断对话所属的用户类别
+
+    新对话在创建时记录 user_class；旧数据没有该字段时，只有没有 user_id 的对话视为匿名，
+    其余一律按注册用户处理（宁可多保留，也不能按匿名期限删掉注册用户的对话）
+
+    Args:
+        conversation: 对话数据
+
+    Returns:
+        用户类别
+    """
+    user_class = conversation.get("user_class")
+    if user_class in USER_CLASSES:
+        return user_class
+    return "registered" if conversation.get("user_id") else "anonymous"
+
+
+class RetentionSweeper:
+    """后台保留策略清理器"""
+
+    def __init__(self, data_manager, policy: RetentionPolicy,
+                 archive_dir: str = "data/archive", batch_size: int = 200,
+                 pause_seconds: float = 0.05):
+        """
+        Args:
+            data_manager: 数据管理器实例
+            policy: 保留策略
+            archive_dir: 归档目录
+            batch_size: 扫描时每块处理的对话数（块与块之间让出数据锁）
+            pause_seconds: 扫描块与块之间让出数据锁的时间
+        """
+        self.data_manager = data_manager
+        self.policy = policy
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds
+
+        self.last_report: Optional[Dict] = None
+        self._run_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    # ==================== 判定 ====================
+
+    def _plan(self, now: datetime) -> Dict[str, List[str]]:
+        """分块扫描对话元数据，得到待删除、待归档、待截断的对话ID"""
+        plan = {"delete": [], "archive": [], "trim": []}
+        dm = self.data_manager
+
+        with dm._lock:
+            conversation_ids = list(dm._load_conversations())
+
+        for start in range(0, len(conversation_ids), self.batch_size):
+            with dm._lock:
+                conversations = dm._load_conversations()
+                for conversation_id in conversation_ids[start:start + self.batch_size]:
+                    conversation = conversations.get(conversation_id)
+                    if conversation is None:
+                        continue
+                    action = self._decide(conversation, now)
+                    if action:
+                        plan[action].append(conversation_id)
+            # 块与块之间释放锁，让请求线程有机会执行
+            time.sleep(self.pause_seconds)
+        return plan
+
+    def _decide(self, conversation: Dict, now: datetime) -> Optional[str]:
+        last_active = conversation.get("updated_at") or conversation.get("created_at")
+        try:
+            idle = now - datetime.fromisoformat(last_active)
+        except (TypeError, ValueError):
+            idle = timedelta(0)
+
+        user_class = classify_user(conversation)
+        ttl = self.policy.ttl_days.get(user_class, 0)
+        if ttl and idle > timedelta(days=ttl):
+            return "delete"
+        if self.policy.archive_idle_days and idle > timedelta(days=self.policy.archive_idle_days):
+            return "archive"
+        if self.policy.max_messages and len(conversation.get("messages", [])) > self.policy.max_messages:
+            return "trim"
+        return None
+
+    # ==================== 执行 ====================
+
+    def _archive(self, conversations: List[Dict], now: datetime) -> int:
+        """追加写入归档文件，返回写入的未压缩字节数"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archive_file = os.path.join(self.archive_dir, f"conversations_{now.strftime('%Y%m')}.ndjson.gz")
+        written = 0
+        # 追加模式会生成新的 gzip 成员，标准工具可以直接解压整个文件
+        with gzip.open(archive_file, 'at', encoding='utf-8') as f:
+            for conversation in conversations:
+                line = json.dumps({"type": "conversation", **conversation}, ensure_ascii=False) + "\n"
+                f.write(line)
+                written += len(line.encode('utf-8'))
+        return written
+
+    def run_once(self) -> Dict:
+        """
+        执行一轮清理
+
+        Returns:
+            清理报告
+        """
+        with self._run_lock:
+            dm = self.data_manager
+            started = time.time()
+            now = datetime.now()
+            size_before = os.path.getsize(dm.conversations_file)
+
+            plan = self._plan(now)
+            report = {
+                "started_at": now.isoformat(),
+                "policy": self.policy.to_dict(),
+                "deleted": 0,
+                "archived": 0,
+                "trimmed": 0,
+                "trimmed_messages": 0,
+                "archived_bytes": 0,
+                "batches": 0
+            }
+
+            # 一轮只重写一次数据文件（分批执行时每批都要重写整个文件，总耗时随批数成倍增长）
+            result = dm.apply_retention(plan["delete"], plan["archive"], plan["trim"],
+                                        self.policy.max_messages, lambda archived: self._archive(archived, now))
+            report.update(result)
+            report["batches"] = 1 if any(plan.values()) else 0
+
+            size_after = os.path.getsize(dm.conversations_file)
+            report["reclaimed_bytes"] = max(size_before - size_after, 0)
+            report["file_size_bytes"] = size_after
+            report["duration_seconds"] = round(time.time() - started, 3)
+            self.last_report = report
+            return report
+
+    # ==================== 后台调度 ====================
+
+    def start(self, interval_seconds: float):
+        """
+        启动后台定时清理线程
+
+        Args:
+            interval_seconds: 清理间隔（秒）
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval_seconds):
+                try:
+                    report = self.run_once()
+                    print(f"保留策略清理完成: 删除 {report['deleted']}，归档 {report['archived']}，"
+                          f"截断 {report['trimmed']}，回收 {report['reclaimed_bytes']} 字节")
+                except Exception as e:
+                    print(f"保留策略清理失败: {e}")
+
+        self._thread = threading.Thread(target=run, name='retention-sweeper', daemon=True)
+        self._thread.start()
+
+    def run_async(self) -> threading.Thread:
+        """在后台线程中立即执行一轮清理"""
+        thread = threading.Thread(target=self.run_once, name='retention-sweep-once', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """停止后台清理线程"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
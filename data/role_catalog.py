@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+角色目录快照
+角色列表很少变化却是页面加载时请求最多的接口，这里缓存序列化好的 JSON 字节
+（以及 gzip 压缩版本）和对应的 ETag，每个请求只需比较版本号
+- 每个变体（是否包含自定义角色）单独缓存
+- 版本号由调用方提供（自定义角色增删改计数 + 数据文件签名），变化后下次请求时重建
+- 头像文件被替换等其他影响目录内容的事件可调用 invalidate() 强制重建
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class CatalogSnapshot:
+    """一个变体的序列化结果"""
+
+    __slots__ = ('body', 'gzip_body', 'etag', 'gzip_etag')
+
+    def __init__(self, payload: Dict[str, Any], compress_level: int = 6):
+        self.body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.gzip_body = gzip.compress(self.body, compresslevel=compress_level, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:16]
+        # 不同内容编码是不同的表示，强ETag需要区分
+        self.gzip_etag = f"{self.etag}-gz"
+
+
+class RoleCatalog:
+    """角色目录快照缓存"""
+
+    def __init__(self, build: Callable[[bool], Dict[str, Any]],
+                 version: Callable[[], Hashable], compress_level: int = 6):
+        """
+        Args:
+            build: 生成目录数据的回调，参数为是否包含自定义角色
+            version: 返回当前数据版本号的回调，版本号变化时重建快照
+            compress_level: gzip 压缩级别
+        """
+        self._build = build
+        self._version = version
+        self._compress_level = compress_level
+        self._generation = 0
+        self._snapshots: Dict[bool, Tuple[Hashable, CatalogSnapshot]] = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """使全部快照失效"""
+        with self._lock:
+            self._generation += 1
+
+    def get(self, include_custom: bool) -> CatalogSnapshot:
+        """
+        获取目录快照，版本变化时重建
+
+        Args:
+            include_custom: 是否包含自定义角色
+
+        Returns:
+            目录快照
+        """
+        key = (self._generation, self._version())
+        cached = self._snapshots.get(include_custom)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        with self._lock:
+            # 其他线程可能已经重建
+            key = (self._generation, self._version())
+            cached = self._snapshots.get(include_custom)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            snapshot = CatalogSnapshot(self._build(include_custom), self._compress_level)
+            self._snapshots[include_custom] = (key, snapshot)
+            return snapshot
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+角色仓库
+- Role 为不可变的紧凑角色对象（__slots__），分类、标签、声音等重复出现的字符串做驻留（intern）
+- RoleRepository 持有预设角色和自定义角色对象：自定义角色文件只在数据版本变化时解析一次，
+  本进程内的增删改增量更新对象、名称索引和分面索引
+- 读取路径直接返回共享的角色对象，只在需要输出 JSON 时调用 to_dict() 序列化
+"""
+
+import sys
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .facet_index import FacetIndex
+
+# 序列化时的字段顺序
+ROLE_FIELDS = ('id', 'name', 'description', 'image', 'category', 'tags', 'personality',
+               'voice', 'is_custom', 'created_at', 'updated_at', 'created_by')
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Role:
+    """不可变的角色对象"""
+
+    __slots__ = ROLE_FIELDS + ('extra',)
+
+    def __init__(self, **fields):
+        for name in ROLE_FIELDS:
+            object.__setattr__(self, name, fields.get(name))
+        object.__setattr__(self, 'extra', fields.get('extra'))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Role 对象不可修改")
+
+    def __repr__(self):
+        return f"Role(id={self.id!r}, name={self.name!r})"
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], default_voice: Optional[Callable[[str], str]] = None) -> 'Role':
+        """
+        从字典创建角色对象
+
+        Args:
+            data: 角色数据
+            default_voice: 角色未配置声音时用于推断默认声音的回调（参数为角色名）
+        """
+        name = data.get('name') or ''
+        voice = data.get('voice') or (default_voice(name) if default_voice else None)
+        tags = data.get('tags') or ()
+        if isinstance(tags, str):
+            tags = [tag.strip() for tag in tags.split(',')]
+        extra = tuple((key, value) for key, value in data.items() if key not in ROLE_FIELDS)
+
+        return cls(
+            id=data['id'],
+            name=name,
+            description=data.get('description') or '',
+            image=data.get('image') or '',
+            category=_intern(data.get('category') or 'custom'),
+            tags=tuple(sys.intern(tag) for tag in tags if tag),
+            personality=data.get('personality') or '',
+            voice=_intern(voice),
+            is_custom=bool(data.get('is_custom')),
+            created_at=data.get('created_at'),
+            updated_at=data.get('updated_at'),
+            created_by=_intern(data.get('created_by')),
+            extra=extra or None,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """序列化为字典（未设置的可选字段不输出）"""
+        data = {}
+        for name in ROLE_FIELDS:
+            value = getattr(self, name)
+            if name == 'tags':
+                data['tags'] = list(value)
+            elif name == 'is_custom':
+                if value:
+                    data['is_custom'] = True
+            elif value is not None:
+                data[name] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def matches(self, keyword: str) -> bool:
+        """名称、描述、性格或标签是否包含关键词（关键词需为小写）"""
+        return (keyword in self.name.lower() or
+                keyword in self.description.lower() or
+                keyword in self.personality.lower() or
+                any(keyword in tag.lower() for tag in self.tags))
+
+
+class RoleRepository:
+    """角色仓库"""
+
+    def __init__(self, data_manager, presets: Iterable[Dict[str, Any]],
+                 default_voice: Optional[Callable[[str], str]] = None):
+        """
+        Args:
+            data_manager: 数据管理器实例（自定义角色的持久化）
+            presets: 预设角色数据
+            default_voice: 角色未配置声音时用于推断默认声音的回调
+        """
+        self.data_manager = data_manager
+        self.default_voice = default_voice
+        self.presets: Tuple[Role, ...] = tuple(Role.from_dict(role, default_voice) for role in presets)
+
+        self._lock = threading.RLock()
+        self._custom: Dict[str, Role] = {}
+        self._custom_version = None
+        # 任何变化都会递增，供目录快照等缓存判断是否需要重建
+        self._generation = 0
+        self._by_id: Dict[str, Role] = {}
+        self._by_name: Dict[str, Role] = {}
+        self._all: Tuple[Role, ...] = ()
+        self.facet_index = FacetIndex()
+
+    # ==================== 内部维护 ====================
+
+    def _refresh(self):
+        """自定义角色数据文件变化时（首次加载、恢复备份、其他进程写入）重新解析"""
+        version = self.data_manager.custom_roles_version()
+        if version == self._custom_version:
+            return
+        with self._lock:
+            version = self.data_manager.custom_roles_version()
+            if version == self._custom_version:
+                return
+            self._custom = {
+                role['id']: Role.from_dict(role, self.default_voice)
+                for role in self.data_manager.get_all_custom_roles()
+            }
+            self._rebuild_views()
+            self.facet_index.rebuild(self._all)
+            self._custom_version = version
+
+    def _rebuild_views(self):
+        self._all = self.presets + tuple(self._custom.values())
+        self._by_id = {role.id: role for role in self._all}
+        # 重名时预设角色优先
+        self._by_name = {role.name: role for role in reversed(self._all)}
+        self._generation += 1
+
+    @property
+    def version(self) -> int:
+        """角色数据版本号"""
+        self._refresh()
+        return self._generation
+
+    # ==================== 查询 ====================
+
+    def get(self, role_id: str) -> Optional[Role]:
+        """按ID获取角色（预设或自定义）"""
+        self._refresh()
+        return self._by_id.get(role_id)
+
+    def get_by_name(self, name: str) -> Optional[Role]:
+        """按名称获取角色（预设角色优先）"""
+        self._refresh()
+        return self._by_name.get(name)
+
+    def get_custom(self, role_id: str) -> Optional[Role]:
+        """按ID获取自定义角色"""
+        self._refresh()
+        return self._custom.get(role_id)
+
+    def all(self, include_custom: bool = True) -> Tuple[Role, ...]:
+        """全部角色，预设角色在前"""
+        self._refresh()
+        return self._all if include_custom else self.presets
+
+    def custom(self) -> Tuple[Role, ...]:
+        """全部自定义角色"""
+        self._refresh()
+        return self._all[len(self.presets):]
+
+    @property
+    def facets(self) -> FacetIndex:
+        """与当前数据一致的分面索引"""
+        self._refresh()
+        return self.facet_index
+
+    # ==================== 自定义角色增删改 ====================
+
+    def _apply(self, role_id: str, role: Optional[Role]):
+        """增量更新本地对象和索引，并记录写入后的数据版本"""
+        if role is None:
+            self._custom.pop(role_id, None)
+            self.facet_index.remove(role_id)
+        else:
+            self._custom[role_id] = role
+            self.facet_index.upsert(role)
+        self._rebuild_views()
+        self._custom_version = self.data_manager.custom_roles_version()
+
+    def create(self, role_data: Dict[str, Any]) -> Role:
+        """
+        保存新的自定义角色
+
+        Args:
+            role_data: 角色数据
+
+        Returns:
+            保存后的角色对象
+        """
+        with self._lock:
+            self._refresh()
+            saved = self.data_manager.save_custom_role(role_data)
+            role = Role.from_dict(saved, self.default_voice)
+            self._apply(role.id, role)
+            return role
+
+    def update(self, role_id: str, role_data: Dict[str, Any]) -> Optional[Role]:
+        """
+        更新自定义角色
+
+        Args:
+            role_id: 角色ID
+            role_data: 更新的字段
+
+        Returns:
+            更新后的角色对象，角色不存在时返回 None
+        """
+        with self._lock:
+            self._refresh()
+            if not self.data_manager.update_custom_role(role_id, role_data):
+                return None
+            role = Role.from_dict(self.data_manager.get_custom_role(role_id), self.default_voice)
+            self._apply(role_id, role)
+            return role
+
+    def delete(self, role_id: str) -> bool:
+        """
+        删除自定义角色
+
+        Args:
+            role_id: 角色ID
+
+        Returns:
+            是否成功删除
+        """
+        with self._lock:
+            self._refresh()
+            if not self.data_manager.delete_custom_role(role_id):
+                return False
+            self._apply(role_id, None)
+            return True
+
+    def stats(self) -> Dict[str, int]:
+        """角色数量统计"""
+        self._refresh()
+        return {
+            'total_roles': len(self._all),
+            'preset_roles': len(self.presets),
+            'custom_roles': len(self._custom),
+        }
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+消息全文索引
+- 中日韩文字按二元组（bigram）切分，其他文字按单词切分并转小写
+- 倒排表只保存消息编号，命中后回到对话数据中逐条校验并生成高亮片段
+- 支持按对话增量追加；对话被删除或消息被截断时通过代号（generation）使旧条目失效
+"""
+
+import html
+import re
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+# 中日韩统一表意文字、假名、谚文
+_CJK = (r'぀-ヿ㐀-䶿一-鿿가-힯豈-﫿')
+_TOKEN_RE = re.compile(rf'[{_CJK}]+|[^\W_]+', re.UNICODE)
+_CJK_RE = re.compile(rf'[{_CJK}]')
+
+
+def tokenize(text: str) -> Set[str]:
+    """
+    将文本切分为索引词
+
+    Args:
+        text: 原始文本
+
+    Returns:
+        去重后的索引词集合
+    """
+    tokens = set()
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                tokens.add(run)
+            else:
+                tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.add(run)
+    return tokens
+
+
+class MessageSearchIndex:
+    """消息级倒排索引"""
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        # 索引词 -> 消息编号数组（编号递增，天然有序）
+        self._postings: Dict[str, array] = {}
+        # 单个中文字 -> 包含它的索引词，用于单字查询
+        self._char_tokens: Dict[str, Set[str]] = {}
+        # 消息编号 -> 所属对话、消息下标、对话代号
+        self._doc_conversation: List[str] = []
+        self._doc_message: array = array('l')
+        self._doc_generation: array = array('l')
+        # 对话ID -> (代号, 已索引消息数)
+        self._conversations: Dict[str, Tuple[int, int]] = {}
+        self._next_generation = 0
+        self._dead_docs = 0
+        self.stale = True
+
+    # ==================== 索引维护 ====================
+
+    def add_message(self, conversation_id: str, message_index: int, content: str):
+        """
+        追加索引一条消息（消息须按下标顺序追加）
+
+        Args:
+            conversation_id: 对话ID
+            message_index: 消息在对话中的下标
+            content: 消息内容
+        """
+        generation, count = self._conversations.get(conversation_id, (None, 0))
+        if generation is None:
+            generation = self._next_generation
+            self._next_generation += 1
+        if message_index != count:
+            # 下标不连续说明对话被外部改写，整体失效后由 sync 重新索引
+            self.remove_conversation(conversation_id)
+            self.stale = True
+            return
+
+        doc_id = len(self._doc_conversation)
+        self._doc_conversation.append(conversation_id)
+        self._doc_message.append(message_index)
+        self._doc_generation.append(generation)
+        self._conversations[conversation_id] = (generation, count + 1)
+
+        for token in tokenize(content or ''):
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = array('l')
+                for char in token:
+                    if _CJK_RE.match(char):
+                        self._char_tokens.setdefault(char, set()).add(token)
+            postings.append(doc_id)
+
+    def remove_conversation(self, conversation_id: str):
+        """
+        使一个对话的全部索引条目失效
+
+        Args:
+            conversation_id: 对话ID
+        """
+        entry = self._conversations.pop(conversation_id, None)
+        if entry:
+            self._dead_docs += entry[1]
+
+    def sync(self, conversations: Dict[str, Dict]):
+        """
+        与对话数据对齐：只为新追加的消息建索引，被删除或被截断的对话重新索引
+
+        Args:
+            conversations: 对话ID到对话数据的映射
+        """
+        for conversation_id in list(self._conversations):
+            if conversation_id not in conversations:
+                self.remove_conversation(conversation_id)
+
+        for conversation_id, conversation in conversations.items():
+            messages = conversation.get('messages', [])
+            _, indexed = self._conversations.get(conversation_id, (None, 0))
+            if len(messages) < indexed:
+                self.remove_conversation(conversation_id)
+                indexed = 0
+            for message_index in range(indexed, len(messages)):
+                self.add_message(conversation_id, message_index, messages[message_index].get('content', ''))
+
+        # 失效条目过多时整体重建，回收倒排表空间
+        if self._dead_docs > max(len(self._doc_conversation) // 2, 1000):
+            self._reset()
+            self.sync(conversations)
+        self.stale = False
+
+    def _is_alive(self, doc_id: int) -> bool:
+        entry = self._conversations.get(self._doc_conversation[doc_id])
+        return (entry is not None and entry[0] == self._doc_generation[doc_id]
+                and self._doc_message[doc_id] < entry[1])
+
+    # ==================== 查询 ====================
+
+    def _term_candidates(self, term: str) -> Optional[Set[int]]:
+        """单个查询词的候选消息集合"""
+        tokens = tokenize(term)
+        if not tokens:
+            return None
+
+        candidates = None
+        for token in sorted(tokens, key=lambda t: len(self._postings.get(t, ()))):
+            if len(token) == 1 and _CJK_RE.match(token):
+                # 单字查询：合并所有包含该字的二元组倒排表
+                docs = set(self._postings.get(token, ()))
+                for bigram in self._char_tokens.get(token, ()):
+                    docs.update(self._postings[bigram])
+            else:
+                docs = self._postings.get(token, ())
+            candidates = set(docs) if candidates is None else candidates.intersection(docs)
+            if not candidates:
+                return set()
+        return candidates
+
+    def search(self, query: str, get_message: Callable[[str, int], Optional[Dict]],
+               allowed_conversations: Optional[Iterable[str]] = None,
+               offset: int = 0, limit: int = 20, max_count: int = 1000) -> Dict:
+        """
+        搜索消息，结果按时间倒序（最新的消息在前）
+
+        Args:
+            query: 查询语句，空白分隔的多个词为"与"关系
+            get_message: 回调，根据 (对话ID, 消息下标) 返回消息字典
+            allowed_conversations: 只在这些对话中搜索（可选，用于按用户/角色限定范围）
+            offset: 起始偏移
+            limit: 每页数量
+            max_count: 最多统计的命中数，超过后 total 为下限
+
+        Returns:
+            {"hits": [(对话ID, 消息下标, 高亮片段), ...], "total": 命中数, "total_is_lower_bound": bool}
+        """
+        terms = [term.lower() for term in query.split() if term.strip()]
+        candidates = None
+        for term in terms:
+            docs = self._term_candidates(term)
+            if docs is None:
+                continue
+            candidates = docs if candidates is None else candidates & docs
+            if not candidates:
+                break
+        if not candidates:
+            return {"hits": [], "total": 0, "total_is_lower_bound": False}
+
+        allowed = set(allowed_conversations) if allowed_conversations is not None else None
+        hits = []
+        total = 0
+        for doc_id in sorted(candidates, reverse=True):
+            if not self._is_alive(doc_id):
+                continue
+            conversation_id = self._doc_conversation[doc_id]
+            if allowed is not None and conversation_id not in allowed:
+                continue
+            message_index = self._doc_message[doc_id]
+            message = get_message(conversation_id, message_index)
+            content = (message or {}).get('content', '')
+            lowered = content.lower()
+            # 二元组命中只是候选，需要校验原文确实包含每个查询词
+            if not all(term in lowered for term in terms):
+                continue
+
+            if offset <= total < offset + limit:
+                hits.append((conversation_id, message_index, highlight(content, terms)))
+            total += 1
+            if total >= max(max_count, offset + limit):
+                return {"hits": hits, "total": total, "total_is_lower_bound": True}
+
+        return {"hits": hits, "total": total, "total_is_lower_bound": False}
+
+    def stats(self) -> Dict:
+        """索引统计信息"""
+        return {
+            "terms": len(self._postings),
+            "documents": len(self._doc_conversation) - self._dead_docs,
+            "dead_documents": self._dead_docs,
+            "conversations": len(self._conversations)
+        }
+
+
+def highlight(content: str, terms: List[str], context: int = 40) -> str:
+    """
+    生成带 <mark> 高亮的片段（内容已做 HTML 转义）
+
+    Args:
+        content: 消息原文
+        terms: 小写的查询词列表
+        context: 命中位置前后保留的字符数
+
+    Returns:
+        HTML 片段
+    """
+    lowered = content.lower()
+    positions = [lowered.find(term) for term in terms if term]
+    first = min((p for p in positions if p >= 0), default=0)
+    start = max(first - context, 0)
+    end = min(first + context * 2, len(content))
+    window = content[start:end]
+
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)),
+                         re.IGNORECASE)
+    parts = []
+    last = 0
+    for match in pattern.finditer(window):
+        parts.append(html.escape(window[last:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group(0))}</mark>")
+        last = match.end()
+    parts.append(html.escape(window[last:]))
+
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(content) else '')
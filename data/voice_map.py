@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+角色默认声音分配
+- 使用稳定哈希（SHA-1）在声音池中选择，同一角色名在任何进程、任何机器上得到相同的声音，
+  多个 worker 之间结果一致，TTS 缓存也能按声音命中
+- 已知角色名的声音在导入时预先计算，关键词规则只对新角色名执行一次（结果缓存）
+- 自定义角色创建时把推断结果写入角色数据，之后不再依赖推断规则
+"""
+
+import hashlib
+from functools import lru_cache
+from typing import Dict, Sequence
+
+# 支持的声音
+VOICES = ('alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer')
+DEFAULT_VOICE = 'alloy'
+
+# 女性声音池
+FEMALE_VOICES = ('nova', 'shimmer', 'alloy')
+# 男性声音池
+MALE_VOICES = ('onyx', 'echo', 'fable')
+
+# 女性角色常见名称关键词
+FEMALE_KEYWORDS = ('女', '姐', '妹', '娘', '小姐', '夫人', '公主', '女王', '母', '妈')
+# 男性角色常见名称关键词
+MALE_KEYWORDS = ('先生', '哥', '弟', '爸', '父', '王', '将军', '博士', '队长')
+
+# 已知角色名称
+FEMALE_NAMES = ('三月七', '姬子', '符玄', '银狼', '托帕', '希露瓦', '艾丝妲', '卡芙卡', '流萤', '砂金', '知更鸟',
+                '娜塔莎·罗曼诺夫', '旺达·马克西莫夫')
+MALE_NAMES = ('哈利·波特', '苏格拉底', '开拓者', '丹恒·饮月', '景元', '星期日', '托尼·斯塔克',
+              '史蒂夫·罗杰斯', '索尔·奥丁森', '克林特·巴顿', '布鲁斯·班纳', '幻视',
+              '彼得·帕克', '特查拉', '史蒂芬·斯特兰奇')
+
+
+def stable_hash(text: str) -> int:
+    """与进程无关的字符串哈希（内置 hash() 每个进程随机加盐）"""
+    return int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'big')
+
+
+def pick_voice(name: str, pool: Sequence[str]) -> str:
+    """按角色名在声音池中稳定地选择一个声音"""
+    return pool[stable_hash(name) % len(pool)]
+
+
+# 已知角色名称的声音（导入时预先计算）
+NAME_VOICES: Dict[str, str] = {}
+for _name in FEMALE_NAMES:
+    NAME_VOICES[_name] = pick_voice(_name, FEMALE_VOICES)
+for _name in MALE_NAMES:
+    NAME_VOICES.setdefault(_name, pick_voice(_name, MALE_VOICES))
+
+
+@lru_cache(maxsize=4096)
+def default_voice_for_character(character_name: str) -> str:
+    """
+    根据角色名称推断默认声音（名称关键词优先，其次是已知角色名称，否则为中性声音）
+
+    Args:
+        character_name: 角色名称
+
+    Returns:
+        声音名称
+    """
+    character_name = character_name or ''
+    if any(keyword in character_name for keyword in FEMALE_KEYWORDS):
+        return pick_voice(character_name, FEMALE_VOICES)
+    if any(keyword in character_name for keyword in MALE_KEYWORDS):
+        return pick_voice(character_name, MALE_VOICES)
+    return NAME_VOICES.get(character_name, DEFAULT_VOICE)
+
+
+def is_valid_voice(voice) -> bool:
+    """是否为支持的声音"""
+    return voice in VOICES
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+上游端点池
+同一个 OpenAI 兼容接口可以配置多个地址/Key（不同区域、不同账号），对话、Whisper 和 TTS 请求统一经过端点池：
+- 选择端点：按权重的最少进行中请求（进行中请求数 / 权重 最小者，相同时选平均延迟低的）
+- 健康跟踪：连续失败（5xx、超时、连接失败）达到阈值时熔断，冷却后放行一个探测请求（半开），
+  成功则恢复，失败则加倍冷却时间；429 按上游的 Retry-After 暂停该端点；
+  401 或错误码表明 Key 无效的 403（Key 失效或填错）立即熔断，不再给该端点分配请求；
+  其他 403（模型无权限、地区不支持等）按客户端错误原样返回，不熔断也不转移
+- 故障转移：Key 无效/429/5xx/超时/连接失败时换一个端点重试（流式请求只在收到响应头之前转移）
+- 进行中请求数：流式响应在响应体读完或关闭时才结束计数，健康状态和延迟在收到响应头时更新
+
+配置格式（OPENAI_ENDPOINTS，逗号分隔，权重可省略）：
+    https://api.openai.com/v1|sk-xxx|2,https://proxy.example.com/v1|sk-yyy|1
+"""
+
+import logging
+import random
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+
+from admission import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+# 需要换端点重试的上游状态码（Key 无效的情况由 _is_auth_failure 另行判断）
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504, 529})
+# 403 响应中表明 Key 本身无效的错误码（OpenAI 的 403 也用于模型无权限、地区不支持等，与端点无关）
+INVALID_KEY_CODES = frozenset({'invalid_api_key', 'account_deactivated'})
+
+
+class EndpointUnavailable(AdmissionRejected):
+    """所有端点都处于熔断状态"""
+
+
+class Endpoint:
+    """一个上游端点（地址 + Key）及其健康状态"""
+
+    def __init__(self, url: str, api_key: str, weight: float = 1.0, name: Optional[str] = None):
+        """
+        Args:
+            url: API地址（如 https://api.openai.com/v1）
+            api_key: API Key
+            weight: 权重，越大分到的请求越多
+            name: 名称（用于日志和状态，不包含Key）
+        """
+        self.url = url.rstrip('/')
+        self.api_key = api_key
+        self.weight = max(float(weight), 0.01)
+        self.name = name or urlparse(self.url).netloc or self.url
+        # 复用连接，避免每次请求都重新建立 TLS 连接
+        self.session = requests.Session()
+
+        self.outstanding = 0
+        self.latency: Optional[float] = None
+        # 熔断状态：closed（正常）/ open（熔断中）/ half_open（冷却结束，放行一个探测请求）
+        self.state = 'closed'
+        self.failures = 0
+        self.open_until = 0.0
+        self.open_seconds = 0.0
+        self.probing = False
+        self.stats = {"requests": 0, "failures": 0, "throttled": 0, "opened": 0}
+
+    def to_dict(self) -> Dict[str, Any]:
+        """端点状态"""
+        return {
+            'name': self.name,
+            'weight': self.weight,
+            'state': self.state,
+            'outstanding': self.outstanding,
+            'consecutive_failures': self.failures,
+            'latency_ms': round(self.latency * 1000) if self.latency else None,
+            'reopen_in': max(0, round(self.open_until - time.monotonic(), 1)) if self.state == 'open' else None,
+            **self.stats,
+        }
+
+
+class EndpointPool:
+    """上游端点池"""
+
+    def __init__(self, endpoints: List[Endpoint], failure_threshold: int = 3, open_seconds: float = 30,
+                 max_open_seconds: float = 300, max_attempts: int = 2):
+        """
+        Args:
+            endpoints: 端点列表
+            failure_threshold: 连续失败多少次后熔断
+            open_seconds: 首次熔断的冷却时间（秒）
+            max_open_seconds: 冷却时间上限（秒）
+            max_attempts: 每个请求最多尝试的端点数
+        """
+        if not endpoints:
+            raise ValueError('至少需要一个上游端点')
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        self.stats = {"failovers": 0, "unavailable": 0}
+
+    @classmethod
+    def from_config(cls, spec: str, default_url: str, default_key: str, **options) -> 'EndpointPool':
+        """
+        根据配置创建端点池
+
+        Args:
+            spec: OPENAI_ENDPOINTS 配置，为空时只使用默认端点
+            default_url: 默认API地址
+            default_key: 默认API Key
+            options: 传给构造函数的其他参数
+        """
+        endpoints = []
+        for entry in (spec or '').split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            parts = [part.strip() for part in entry.split('|')]
+            url = parts[0] or default_url
+            api_key = parts[1] if len(parts) > 1 and parts[1] else default_key
+            weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1.0
+            endpoints.append(Endpoint(url, api_key, weight, name=f"{len(endpoints) + 1}:{urlparse(url).netloc}"))
+        if not endpoints:
+            endpoints.append(Endpoint(default_url, default_key))
+        return cls(endpoints, **options)
+
+    # ==================== 选择端点 ====================
+
+    def _available(self, endpoint: Endpoint, now: float) -> bool:
+        # 调用时持有 self._lock
+        if endpoint.state == 'open':
+            if now < endpoint.open_until:
+                return False
+            endpoint.state = 'half_open'
+        if endpoint.state == 'half_open':
+            return not endpoint.probing
+        return True
+
+    def acquire(self, exclude=()) -> Endpoint:
+        """
+        选择一个端点并计入进行中请求
+
+        Args:
+            exclude: 本次请求已尝试过的端点
+
+        Raises:
+            EndpointUnavailable: 没有可用端点
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints
+                          if endpoint not in exclude and self._available(endpoint, now)]
+            if not candidates:
+                reopen = [endpoint.open_until for endpoint in self.endpoints if endpoint.state == 'open']
+                retry_after = min(reopen) - now if reopen else 1
+                raise EndpointUnavailable('没有可用的上游端点，请稍后重试', retry_after)
+
+            def score(endpoint):
+                return ((endpoint.outstanding + 1) / endpoint.weight, endpoint.latency or 0, random.random())
+
+            endpoint = min(candidates, key=score)
+            if endpoint.state == 'half_open':
+                endpoint.probing = True
+            endpoint.outstanding += 1
+            endpoint.stats["requests"] += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, ok: bool, latency: float = 0.0, retry_after: Optional[float] = None,
+                open_now: bool = False, finished: bool = True):
+        """
+        请求结束（或流式响应收到响应头），更新端点的健康状态
+
+        Args:
+            endpoint: 端点
+            ok: 是否成功（Key 无效以外的 4xx 客户端错误也算成功，端点本身是健康的）
+            latency: 收到响应头的耗时（秒）
+            retry_after: 上游 429 时要求的等待时间（秒）
+            open_now: 不等连续失败达到阈值，立即熔断（如 Key 被拒绝）
+            finished: 是否同时结束进行中请求计数（流式响应为 False，响应体结束后由 finish 结束）
+        """
+        now = time.monotonic()
+        with self._lock:
+            if finished:
+                endpoint.outstanding -= 1
+            endpoint.probing = False
+            if ok:
+                endpoint.failures = 0
+                if endpoint.state != 'closed':
+                    logger.info(f"上游端点 {endpoint.name} 已恢复")
+                endpoint.state = 'closed'
+                endpoint.open_seconds = 0.0
+                if latency > 0:
+                    endpoint.latency = latency if endpoint.latency is None else endpoint.latency * 0.8 + latency * 0.2
+                return
+
+            endpoint.failures += 1
+            endpoint.stats["failures"] += 1
+            if retry_after:
+                # 限流：按上游要求暂停该端点
+                endpoint.stats["throttled"] += 1
+                self._open(endpoint, now, retry_after)
+            elif open_now or endpoint.state == 'half_open' or endpoint.failures >= self.failure_threshold:
+                backoff = min(self.max_open_seconds, max(self.base_open_seconds, endpoint.open_seconds * 2))
+                endpoint.open_seconds = backoff
+                self._open(endpoint, now, backoff)
+
+    def finish(self, endpoint: Endpoint):
+        """结束一个流式响应的进行中请求计数（健康状态已在收到响应头时更新）"""
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    def _finish_on_close(self, endpoint: Endpoint, response: requests.Response):
+        """
+        流式响应的响应体读完、被关闭或被回收时结束进行中请求计数（只计一次）
+        """
+        done = threading.Lock()
+
+        def finish():
+            if done.acquire(blocking=False):
+                self.finish(endpoint)
+
+        close = response.close
+
+        def close_and_finish():
+            try:
+                close()
+            finally:
+                finish()
+
+        response.close = close_and_finish
+        # 响应体读完时 urllib3 会归还连接
+        release_conn = getattr(response.raw, 'release_conn', None)
+        if release_conn is not None:
+            def release_and_finish():
+                try:
+                    release_conn()
+                finally:
+                    finish()
+
+            response.raw.release_conn = release_and_finish
+        # 调用方既没读完也没关闭时，响应对象被回收后结束计数
+        weakref.finalize(response, finish)
+
+    def _open(self, endpoint: Endpoint, now: float, seconds: float):
+        # 调用时持有 self._lock
+        if endpoint.state != 'open':
+            endpoint.stats["opened"] += 1
+            logger.warning(f"上游端点 {endpoint.name} 熔断 {seconds:.0f} 秒")
+        endpoint.state = 'open'
+        endpoint.open_until = max(endpoint.open_until, now + seconds)
+
+    # ==================== 发送请求 ====================
+
+    def request(self, method: str, path: str, avoid=(), attempted: Optional[List[Endpoint]] = None,
+                **kwargs) -> requests.Response:
+        """
+        发送请求，失败时换端点重试
+
+        Args:
+            method: HTTP方法
+            path: 接口路径（如 /chat/completions）
+            avoid: 尽量避开的端点（如对冲请求避开主请求的端点），没有其他可用端点时仍可使用
+            attempted: 传入列表时，每次尝试前把所选端点追加到其中
+            kwargs: 传给 requests 的参数（headers 中会加入对应端点的 Authorization）
+
+        Returns:
+            最后一次尝试的响应（可能是不可重试的错误响应，由调用方处理）
+
+        Raises:
+            requests.exceptions.RequestException: 所有尝试都没有收到响应
+            EndpointUnavailable: 没有可用端点
+        """
+        tried: List[Endpoint] = []
+        headers = kwargs.pop('headers', None) or {}
+        last_response, last_error = None, None
+        while True:
+            try:
+                try:
+                    endpoint = self.acquire(tried + list(avoid))
+                except EndpointUnavailable:
+                    if not avoid:
+                        raise
+                    endpoint = self.acquire(tried)
+            except EndpointUnavailable:
+                if tried:
+                    # 没有其他可用端点，返回最后一次的结果
+                    return self._last(last_response, last_error)
+                with self._lock:
+                    self.stats["unavailable"] += 1
+                raise
+            if tried:
+                with self._lock:
+                    self.stats["failovers"] += 1
+            tried.append(endpoint)
+            if attempted is not None:
+                attempted.append(endpoint)
+            started = time.monotonic()
+            if last_response is not None:
+                last_response.close()
+            last_response, last_error = None, None
+            try:
+                response = endpoint.session.request(
+                    method, f'{endpoint.url}{path}',
+                    headers={**headers, 'Authorization': f'Bearer {endpoint.api_key}'},
+                    **kwargs
+                )
+            except requests.exceptions.RequestException as e:
+                self.release(endpoint, False)
+                logger.warning(f"上游端点 {endpoint.name} 请求失败: {str(e)}")
+                last_error = e
+            except BaseException:
+                # 参数错误等与端点健康无关的异常
+                self.release(endpoint, True)
+                raise
+            else:
+                latency = time.monotonic() - started
+                auth_failure = _is_auth_failure(response)
+                if not auth_failure and response.status_code not in RETRYABLE_STATUS:
+                    # 判断 Key 是否无效时可能已读完响应体
+                    streaming = bool(kwargs.get('stream')) and not response._content_consumed
+                    self.release(endpoint, True, latency, finished=not streaming)
+                    if streaming:
+                        self._finish_on_close(endpoint, response)
+                    return response
+                self.release(endpoint, False, latency, _retry_after(response) if response.status_code == 429 else None,
+                             open_now=auth_failure)
+                logger.warning(f"上游端点 {endpoint.name} 返回 {response.status_code}")
+                last_response = response
+
+            if len(tried) >= min(self.max_attempts, len(self.endpoints)):
+                return self._last(last_response, last_error)
+
+    @staticmethod
+    def _last(response: Optional[requests.Response], error: Optional[Exception]) -> requests.Response:
+        if response is not None:
+            return response
+        raise error
+
+    def close(self):
+        """关闭各端点的连接"""
+        for endpoint in self.endpoints:
+            endpoint.session.close()
+
+    def info(self) -> Dict[str, Any]:
+        """端点池状态"""
+        with self._lock:
+            return {**self.stats, 'endpoints': [endpoint.to_dict() for endpoint in self.endpoints]}
+
+
+def _is_auth_failure(response: requests.Response) -> bool:
+    """响应是否表明端点的 Key 无效：401，或错误码为 Key 无效的 403"""
+    if response.status_code == 401:
+        return True
+    if response.status_code != 403:
+        return False
+    try:
+        error = response.json().get('error')
+    except (ValueError, AttributeError):
+        return False
+    return isinstance(error, dict) and error.get('code') in INVALID_KEY_CODES
+
+
+def _retry_after(response: requests.Response) -> float:
+    """429 响应要求的等待时间（秒），没有时按1秒"""
+    try:
+        return max(1.0, float(response.headers.get('Retry-After', 1)))
+    except ValueError:
+        return 1.0
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+前端页面服务
+由后端同源提供 0.1版本.html，页面请求 API 时不再需要跨域预检
+- 内联的 <style>/<script> 拆分为带内容指纹的独立文件（/assets/<名称>.<指纹>.css|js），
+  可被浏览器永久缓存，页面本身每次重新验证（未变化时返回304）
+- 可选择把 CSS 保留在页面中（首屏少一次往返），只拆分脚本
+- 页面和资源在构建时预先压缩，请求时按 Accept-Encoding 直接返回
+- 源文件修改后下次请求时自动重新构建
+
+也可以把拆分结果写到目录中，交给 Nginx 等静态服务器：
+    python frontend.py build dist/
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from werkzeug.http import is_resource_modified
+
+DEFAULT_SOURCE = '0.1版本.html'
+
+# 内联样式和内联脚本（带 src 属性或非 JavaScript 类型的脚本保持原样）
+_STYLE_RE = re.compile(r'<style(?P<attrs>[^>]*)>(?P<body>.*?)</style>', re.S | re.I)
+_SCRIPT_RE = re.compile(r'<script(?P<attrs>[^>]*)>(?P<body>.*?)</script>', re.S | re.I)
+_SCRIPT_TYPE_RE = re.compile(r'\btype\s*=\s*["\']?(?P<type>[^"\'\s>]+)', re.I)
+
+ASSET_MIMETYPES = {'css': 'text/css', 'js': 'application/javascript'}
+
+# 带指纹的资源可以永久缓存
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def _fingerprint(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def split_assets(html: str, url_prefix: str = '/assets', inline_css: bool = False) -> Tuple[str, Dict[str, bytes]]:
+    """
+    把内联样式和脚本拆分为带指纹的资源文件
+
+    Args:
+        html: 页面源码
+        url_prefix: 资源URL前缀
+        inline_css: 是否把样式保留在页面中
+
+    Returns:
+        (改写后的页面, {资源文件名: 内容})
+    """
+    assets: Dict[str, bytes] = {}
+
+    def add_asset(stem: str, extension: str, body: str) -> str:
+        data = body.encode('utf-8')
+        name = f"{stem}.{_fingerprint(data)}.{extension}"
+        assets[name] = data
+        return f"{url_prefix.rstrip('/')}/{name}"
+
+    def replace_style(match):
+        if inline_css or match.group('attrs').strip():
+            return match.group(0)
+        return f'<link rel="stylesheet" href="{add_asset("app", "css", match.group("body"))}">'
+
+    def replace_script(match):
+        attrs = match.group('attrs')
+        if re.search(r'\bsrc\s*=', attrs, re.I):
+            return match.group(0)
+        script_type = _SCRIPT_TYPE_RE.search(attrs)
+        if script_type and script_type.group('type').lower() not in ('text/javascript', 'module'):
+            return match.group(0)
+        # 保持原位置且不加 defer，执行顺序与内联时一致
+        return f'<script{attrs} src="{add_asset("app", "js", match.group("body"))}"></script>'
+
+    html = _STYLE_RE.sub(replace_style, html)
+    html = _SCRIPT_RE.sub(replace_script, html)
+    return html, assets
+
+
+class FrontendBundle:
+    """一次构建的结果：页面和资源的原始内容及各编码的预压缩版本"""
+
+    def __init__(self, html: str, assets: Dict[str, bytes], compression=None):
+        self.files: Dict[str, Dict[Optional[str], bytes]] = {}
+        self.etags: Dict[str, str] = {}
+        for name, data in [('index.html', html.encode('utf-8'))] + sorted(assets.items()):
+            etag = _fingerprint(data)
+            encoded = {None: data}
+            if compression is not None:
+                encoded.update(compression.precompress(f"frontend:{name}:{etag}", data))
+            self.files[name] = encoded
+            self.etags[name] = etag
+
+    @property
+    def asset_names(self) -> List[str]:
+        return [name for name in self.files if name != 'index.html']
+
+
+class Frontend:
+    """Flask 前端页面服务扩展"""
+
+    def __init__(self, app=None, source: str = DEFAULT_SOURCE, url_prefix: str = '/assets',
+                 inline_css: bool = False, compression=None):
+        """
+        Args:
+            app: Flask 应用（可稍后调用 init_app）
+            source: 前端页面源文件
+            url_prefix: 拆分出的资源URL前缀
+            inline_css: 是否把样式保留在页面中
+            compression: 响应压缩扩展（用于预压缩和编码协商，可选）
+        """
+        self.source = source
+        self.url_prefix = url_prefix
+        self.inline_css = inline_css
+        self.compression = compression
+
+        self._bundle: Optional[FrontendBundle] = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.add_url_rule('/', 'frontend_index', self.serve_index)
+        app.add_url_rule(f"{self.url_prefix.rstrip('/')}/<path:filename>", 'frontend_asset', self.serve_asset)
+
+    def bundle(self) -> FrontendBundle:
+        """获取构建结果，源文件变化时重新构建"""
+        stat = os.stat(self.source)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if self._bundle is not None and signature == self._signature:
+            return self._bundle
+
+        with self._lock:
+            if self._bundle is None or signature != self._signature:
+                with open(self.source, 'r', encoding='utf-8') as f:
+                    html, assets = split_assets(f.read(), self.url_prefix, self.inline_css)
+                # 旧页面可能仍引用上一版资源，保留旧资源直到下次构建
+                bundle = FrontendBundle(html, assets, self.compression)
+                if self._bundle is not None:
+                    for name in self._bundle.asset_names:
+                        if name not in bundle.files:
+                            bundle.files[name] = self._bundle.files[name]
+                            bundle.etags[name] = self._bundle.etags[name]
+                self._bundle, self._signature = bundle, signature
+            return self._bundle
+
+    def _send(self, name: str, mimetype: str, immutable: bool):
+        from flask import current_app, request
+
+        bundle = self.bundle()
+        encoded = bundle.files.get(name)
+        if encoded is None:
+            return current_app.response_class('Not Found', status=404, mimetype='text/plain')
+
+        encoding = self.compression.negotiate(request.accept_encodings) if self.compression else None
+        if encoding not in encoded:
+            encoding = None
+        # 不同内容编码是不同的表示，强ETag需要区分
+        etag = bundle.etags[name] + (f"-{encoding}" if encoding else '')
+
+        if not is_resource_modified(request.environ, etag=etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(encoded[encoding], mimetype=mimetype)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        if immutable:
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+    def serve_index(self):
+        """前端页面（每次重新验证，资源指纹随内容变化）"""
+        return self._send('index.html', 'text/html', immutable=False)
+
+    def serve_asset(self, filename: str):
+        """带指纹的样式和脚本"""
+        extension = filename.rsplit('.', 1)[-1]
+        return self._send(filename, ASSET_MIMETYPES.get(extension, 'application/octet-stream'), immutable=True)
+
+
+def build(source: str, output_dir: str, url_prefix: str = '/assets', inline_css: bool = False) -> List[str]:
+    """
+    把拆分结果写到目录中（index.html 和 assets/ 下的资源）
+
+    Returns:
+        写入的文件列表
+    """
+    with open(source, 'r', encoding='utf-8') as f:
+        html, assets = split_assets(f.read(), url_prefix, inline_css)
+
+    asset_dir = os.path.join(output_dir, url_prefix.strip('/'))
+    os.makedirs(asset_dir, exist_ok=True)
+    written = [os.path.join(output_dir, 'index.html')]
+    with open(written[0], 'w', encoding='utf-8') as f:
+        f.write(html)
+    for name, data in assets.items():
+        path = os.path.join(asset_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        written.append(path)
+    return written
+
+
+def main(argv=None):
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='前端页面构建')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='拆分内联样式和脚本并写入目录')
+    build_parser.add_argument('output_dir', help='输出目录')
+    build_parser.add_argument('--source', default=DEFAULT_SOURCE, help='前端页面源文件')
+    build_parser.add_argument('--inline-css', action='store_true', help='样式保留在页面中')
+    args = parser.parse_args(argv)
+
+    for path in build(args.source, args.output_dir, inline_css=args.inline_css):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+对冲请求（hedged requests）
+大部分上游请求很快返回，少数会慢到接近超时，拖高尾延迟。对冲的做法是：
+- 主请求在调用方线程中执行，拿到上游名额、真正发出后开始计时（排队等待名额的时间不算），
+  在延迟阈值内没有收到首字节时，再发一个相同的请求（尽量发往另一个端点）
+- 先收到首字节的一方胜出，胜出方立即关闭另一方的连接（流式生成随之停止，名额随之归还），不再继续计费
+- 延迟阈值取最近请求首字节时间（从主请求发出算起）的分位数（如 p95），只有最慢的那部分请求会被对冲
+- 对冲预算：每个请求积累 budget_ratio 个令牌，每次对冲消耗一个，额外的上游调用不超过该比例；
+  同时进行的对冲请求不超过 max_inflight（不超过线程池大小，对冲请求不会在线程池中排队）
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional
+
+
+class HedgePolicy:
+    """对冲延迟阈值和预算"""
+
+    def __init__(self, percentile: float = 0.95, initial_delay: float = 2.0, min_delay: float = 0.2,
+                 max_delay: float = 10.0, budget_ratio: float = 0.05, budget_burst: float = 5,
+                 window: int = 200, min_samples: int = 20, max_inflight: int = 32):
+        """
+        Args:
+            percentile: 延迟阈值取首字节时间的分位数（0-1）
+            initial_delay: 样本不足时的延迟阈值（秒）
+            min_delay: 延迟阈值下限（秒）
+            max_delay: 延迟阈值上限（秒）
+            budget_ratio: 每个请求积累的对冲令牌（即额外调用比例上限）
+            budget_burst: 令牌上限（允许短时间内集中对冲的次数）
+            window: 统计首字节时间的最近请求数
+            min_samples: 开始使用分位数所需的最少样本数
+            max_inflight: 同时进行的对冲请求上限
+        """
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.min_samples = min_samples
+        self.max_inflight = max_inflight
+
+        self._samples = deque(maxlen=window)
+        self._tokens = budget_burst
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "over_budget": 0, "saturated": 0}
+
+    def delay(self) -> float:
+        """当前的对冲延迟阈值（秒）"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                delay = self.initial_delay
+            else:
+                ordered = sorted(self._samples)
+                delay = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+        return min(self.max_delay, max(self.min_delay, delay))
+
+    def observe(self, first_byte: float, hedge: bool = False):
+        """
+        记录一次调用的首字节时间
+
+        Args:
+            first_byte: 从主请求发出（拿到名额之后）到（任一方）收到首字节的时间（秒）；对冲胜出时也从主请求算起，
+                否则只记录对冲本身的耗时会让分位数越来越低、对冲越来越早
+            hedge: 胜出的是否为对冲请求
+        """
+        with self._lock:
+            self._samples.append(first_byte)
+            if hedge:
+                self.stats["hedge_wins"] += 1
+
+    def begin(self):
+        """新请求开始，积累对冲令牌"""
+        with self._lock:
+            self.stats["requests"] += 1
+            self._tokens = min(self.budget_burst, self._tokens + self.budget_ratio)
+
+    def try_spend(self) -> bool:
+        """尝试消耗一个对冲令牌并计入进行中的对冲请求（成功时结束后须调用 done）"""
+        with self._lock:
+            if self._inflight >= self.max_inflight:
+                self.stats["saturated"] += 1
+                return False
+            if self._tokens < 1:
+                self.stats["over_budget"] += 1
+                return False
+            self._tokens -= 1
+            self._inflight += 1
+            self.stats["hedged"] += 1
+            return True
+
+    def done(self):
+        """一个对冲请求结束"""
+        with self._lock:
+            self._inflight -= 1
+
+    def info(self) -> Dict[str, Any]:
+        """对冲状态"""
+        delay = self.delay()
+        with self._lock:
+            return {**self.stats, 'delay_ms': round(delay * 1000), 'tokens': round(self._tokens, 2),
+                    'samples': len(self._samples), 'inflight': self._inflight}
+
+
+class HedgeLost(Exception):
+    """另一个请求已先收到首字节，本请求放弃"""
+
+
+class HedgeAttempt:
+    """
+    一次尝试的句柄：
+    - sent()：拿到上游名额、即将发出请求时调用，主请求从此刻开始计时（之前的排队时间不算）
+    - claim()：收到首字节时调用，返回 False 说明另一方已胜出，应抛出 HedgeLost
+    - on_cancel(fn)：登记关闭连接的回调，另一方胜出时由胜出方的线程调用（已胜出时立即调用）
+    - cancelled：另一方已胜出；发出请求之前检查，为 True 时直接抛出 HedgeLost，不再调用上游
+    """
+
+    def __init__(self, index: int, claim: Callable[['HedgeAttempt'], bool],
+                 sent: Optional[Callable[['HedgeAttempt'], None]] = None):
+        self.index = index
+        self._claim = claim
+        self._sent = sent
+        self._lock = threading.Lock()
+        self._cancel: Optional[Callable[[], None]] = None
+        self.cancelled = False
+
+    def sent(self):
+        """即将发出上游请求（已拿到名额）"""
+        if self._sent is not None:
+            self._sent(self)
+
+    def claim(self) -> bool:
+        """收到首字节，尝试成为胜出方"""
+        return self._claim(self)
+
+    def on_cancel(self, fn: Callable[[], None]):
+        """登记被取消时调用的回调（如关闭上游响应）"""
+        with self._lock:
+            if not self.cancelled:
+                self._cancel = fn
+                return
+        fn()
+
+    def cancel(self):
+        """另一方已胜出，关闭本尝试的连接"""
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            fn, self._cancel = self._cancel, None
+        if fn is not None:
+            try:
+                fn()
+            except Exception:
+                pass
+
+
+class _Race:
+    __slots__ = ('lock', 'finished', 'winner', 'started', 'failed', 'result', 'error', 'attempts', 'sent_at',
+                 'timer')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.winner: Optional[int] = None
+        self.started = 0
+        self.failed = 0
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.attempts: List[HedgeAttempt] = []
+        self.sent_at: Optional[float] = None
+        self.timer: Optional[threading.Timer] = None
+
+
+def hedged_call(attempt: Callable[[HedgeAttempt], Any], policy: HedgePolicy, executor: Executor) -> Any:
+    """
+    执行一次可对冲的调用
+
+    主请求在调用方线程中执行；主请求调用 sent() 后开始计时，超过延迟阈值仍没有胜出者时
+    在线程池中发起对冲请求
+
+    Args:
+        attempt: 发起一次尝试的回调，参数为 HedgeAttempt。序号（index）0 为主请求、1 为对冲请求；
+            拿到上游名额、发出请求前检查 cancelled 并调用 sent()（主请求不调用 sent() 时不会对冲）；
+            收到首字节时调用 claim()，返回 False 说明另一方已胜出，应关闭连接并抛出 HedgeLost；
+            拿到上游响应后用 on_cancel() 登记关闭它的回调，另一方胜出时立即关闭
+        policy: 对冲策略
+        executor: 执行对冲请求的线程池（线程数不少于 policy.max_inflight）
+
+    Returns:
+        胜出一方的结果（双方都失败时抛出最后一个异常）
+    """
+    race = _Race()
+    policy.begin()
+
+    def claim(handle: HedgeAttempt) -> bool:
+        with race.lock:
+            if race.winner is None:
+                race.winner = handle.index
+            if race.winner != handle.index:
+                return False
+            losers = [other for other in race.attempts if other is not handle]
+            sent_at = race.sent_at
+        if sent_at is not None:
+            # 首字节时间从主请求发出算起，对冲胜出时也不只算对冲本身的耗时
+            policy.observe(time.monotonic() - sent_at, hedge=handle.index > 0)
+        for other in losers:
+            other.cancel()
+        return True
+
+    def sent(handle: HedgeAttempt):
+        if handle.index != 0:
+            return
+        with race.lock:
+            if race.sent_at is not None or race.finished.is_set():
+                return
+            race.sent_at = time.monotonic()
+            race.timer = threading.Timer(policy.delay(), hedge)
+            race.timer.daemon = True
+            race.timer.start()
+
+    def hedge():
+        with race.lock:
+            if race.winner is not None or race.finished.is_set():
+                return
+        if not policy.try_spend():
+            return
+        if not start(1):
+            policy.done()
+
+    def run(handle: HedgeAttempt):
+        index = handle.index
+        try:
+            result = attempt(handle)
+        except HedgeLost:
+            return
+        except BaseException as e:
+            with race.lock:
+                if race.winner is not None and race.winner != index:
+                    # 被胜出方关闭连接后的读取错误
+                    return
+                if race.winner == index:
+                    # 胜出后读取中途失败
+                    race.error = e
+                    race.finished.set()
+                    return
+                race.failed += 1
+                race.error = e
+                if race.winner is None and race.failed == race.started:
+                    race.finished.set()
+            return
+        finally:
+            if index > 0:
+                policy.done()
+        with race.lock:
+            # 没有调用 claim 就结束的尝试（如空响应），在没有胜出者时也算胜出
+            if race.winner is None:
+                race.winner = index
+            if race.winner != index:
+                return
+            race.result = result
+            race.finished.set()
+            losers = [other for other in race.attempts if other is not handle]
+        for other in losers:
+            other.cancel()
+
+    def start(index: int) -> bool:
+        handle = HedgeAttempt(index, claim, sent)
+        with race.lock:
+            if race.finished.is_set() or race.winner is not None:
+                return False
+            race.started += 1
+            race.attempts.append(handle)
+        if index == 0:
+            run(handle)
+        else:
+            executor.submit(run, handle)
+        return True
+
+    try:
+        start(0)
+        # 主请求失败时等待进行中的对冲请求
+        race.finished.wait()
+    finally:
+        with race.lock:
+            timer = race.timer
+        if timer is not None:
+            timer.cancel()
+    if race.result is None and race.error is not None:
+        raise race.error
+    return race.result
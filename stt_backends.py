@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""
+语音识别（STT）后端
+通过配置选择：
+- openai: 调用 OpenAI 兼容的 /audio/transcriptions 接口（默认）
+- local: 进程内 CPU 推理（faster-whisper，可选依赖），省去公网往返和上游排队
+  - 启动时加载并预热模型池，每个模型由一个工作线程独占（并发上限 = 模型数）
+  - 待处理请求队列有上限，队列满时立即返回繁忙
+  - 同时到达的短录音（30秒以内）合并为一批解码
+
+也可以用同一批录音比较各后端的吞吐和延迟：
+    python stt_backends.py bench clip1.wav clip2.wav --backends openai,local --concurrency 4
+"""
+
+import abc
+import argparse
+import io
+import logging
+import os
+import queue
+import statistics
+import threading
+import time
+import wave
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from endpoints import Endpoint, EndpointPool
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+    from faster_whisper import WhisperModel, decode_audio
+except ImportError:  # 本地识别为可选依赖
+    np = None
+    WhisperModel = None
+    decode_audio = None
+
+SAMPLE_RATE = 16000
+# Whisper 一次处理的最长音频（秒），更短的录音可以合并成批
+WINDOW_SECONDS = 30
+# 工作线程没有暂存任务的标记（None 是退出信号，不能复用）
+_NO_JOB = object()
+
+
+class TranscriptionError(Exception):
+    """语音识别失败，status_code 为建议返回的HTTP状态码"""
+
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class STTBackend(abc.ABC):
+    """语音识别后端接口"""
+
+    name = 'base'
+    # 模型和默认语言（用于区分识别结果的缓存）
+    model = ''
+    language = ''
+
+    @abc.abstractmethod
+    def transcribe(self, audio: bytes, filename: str = 'audio.wav', content_type: Optional[str] = None,
+                   language: Optional[str] = None) -> str:
+        """
+        识别一段录音
+
+        Args:
+            audio: 音频数据
+            filename: 文件名（部分后端据此判断格式）
+            content_type: MIME类型
+            language: 语言代码，默认使用后端配置
+
+        Returns:
+            识别出的文本
+        """
+
+    def close(self):
+        """释放后端资源"""
+
+    def stats(self) -> Dict:
+        """运行状态"""
+        return {'backend': self.name}
+
+
+class WhisperAPIBackend(STTBackend):
+    """OpenAI Whisper 接口"""
+
+    name = 'openai'
+
+    def __init__(self, api_url: str, api_key: str, model: str = 'whisper-1', language: str = 'zh',
+                 timeout: float = 30, admission=None, pool: Optional[EndpointPool] = None):
+        """
+        Args:
+            api_url: API地址（如 https://api.openai.com/v1）
+            api_key: API Key
+            model: 模型名称
+            language: 默认语言
+            timeout: 请求超时时间（秒）
+            admission: 上游接入控制（admission.AdmissionController），在 stt 通道中排队
+            pool: 上游端点池（与对话、合成共用），默认只使用 api_url/api_key 一个端点
+        """
+        self.model = model
+        self.language = language
+        self.timeout = timeout
+        self.admission = admission
+        self._owns_pool = pool is None
+        self.pool = pool or EndpointPool([Endpoint(api_url, api_key)])
+
+    def transcribe(self, audio: bytes, filename: str = 'audio.wav', content_type: Optional[str] = None,
+                   language: Optional[str] = None) -> str:
+        logger.info("调用OpenAI Whisper API: /audio/transcriptions")
+        with (self.admission.slot('stt') if self.admission else nullcontext()) as slot:
+            try:
+                response = self.pool.request(
+                    'POST', '/audio/transcriptions',
+                    files={'file': (filename, audio, content_type)},
+                    data={'model': self.model, 'language': language or self.language},
+                    timeout=self.timeout
+                )
+            except requests.exceptions.Timeout:
+                raise TranscriptionError('Whisper API请求超时', 504)
+            except requests.exceptions.RequestException as e:
+                raise TranscriptionError(f'Whisper API网络请求失败: {str(e)}', 502)
+            if slot is not None:
+                slot.observe(response.status_code, response.headers.get('Retry-After'))
+
+        if response.status_code != 200:
+            raise TranscriptionError(f'Whisper API调用失败: {response.status_code} - {response.text}', 502)
+        return response.json().get('text', '')
+
+    def close(self):
+        if self._owns_pool:
+            self.pool.close()
+
+
+class _LocalJob:
+    __slots__ = ('samples', 'language', 'future')
+
+    def __init__(self, samples, language: str):
+        self.samples = samples
+        self.language = language
+        self.future = Future()
+
+
+class LocalWhisperBackend(STTBackend):
+    """进程内 CPU 推理（faster-whisper）"""
+
+    name = 'local'
+
+    def __init__(self, model_size: str = 'small', language: str = 'zh', workers: int = 1,
+                 cpu_threads: int = 0, compute_type: str = 'int8', batch_size: int = 8,
+                 batch_wait_ms: int = 20, max_pending: int = 32, beam_size: int = 1,
+                 timeout: float = 60, download_root: Optional[str] = None):
+        """
+        Args:
+            model_size: 模型名称或本地模型目录（如 small、medium、large-v3）
+            language: 默认语言
+            workers: 模型实例数（每个实例一个工作线程）
+            cpu_threads: 每个模型实例的推理线程数，0 表示由 CTranslate2 决定
+            compute_type: 计算精度（CPU 上 int8 最快）
+            batch_size: 一批最多合并的短录音数
+            batch_wait_ms: 凑批时最多等待的毫秒数
+            max_pending: 等待中的请求上限，超过时返回繁忙
+            beam_size: 解码束宽（1 为贪心解码）
+            timeout: 单个请求最长等待时间（秒）
+            download_root: 模型下载目录
+        """
+        if WhisperModel is None:
+            raise RuntimeError('本地语音识别需要安装 faster-whisper：pip install faster-whisper')
+
+        self.model = model_size
+        self.language = language
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait_ms / 1000
+        self.beam_size = beam_size
+        self.timeout = timeout
+
+        self._jobs: "queue.Queue[Optional[_LocalJob]]" = queue.Queue(maxsize=max_pending)
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "batches": 0, "batched_requests": 0, "rejected": 0,
+                       "audio_seconds": 0.0, "busy_seconds": 0.0}
+        self._ready = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+        model_options = {'device': 'cpu', 'compute_type': compute_type, 'cpu_threads': cpu_threads}
+        if download_root:
+            model_options['download_root'] = download_root
+        for index in range(max(1, workers)):
+            thread = threading.Thread(target=self._worker, args=(model_size, model_options),
+                                      name=f'stt-local-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # ==================== 工作线程 ====================
+
+    def _worker(self, model_size: str, model_options: Dict):
+        try:
+            model = WhisperModel(model_size, **model_options)
+            # 预热：首次推理会分配缓冲区，放在启动阶段完成
+            self._decode_batch(model, [np.zeros(SAMPLE_RATE, dtype=np.float32)], self.language)
+            logger.info(f"本地语音识别模型已就绪: {model_size}")
+        except Exception as e:
+            logger.error(f"本地语音识别模型加载失败: {str(e)}")
+            return
+        finally:
+            self._ready.set()
+
+        # 收集批次时取到的无法合并的任务，由本线程下一轮先处理（不放回有界队列，避免队列被占满时阻塞自己）
+        carry = _NO_JOB
+        while True:
+            job, carry = (self._jobs.get() if carry is _NO_JOB else carry), _NO_JOB
+            if job is None:
+                return
+            batch = [job]
+            if len(job.samples) <= WINDOW_SECONDS * SAMPLE_RATE:
+                more, carry = self._collect_batch(job.language)
+                batch.extend(more)
+            self._run(model, batch)
+
+    def _collect_batch(self, language: str) -> Tuple[List[_LocalJob], Any]:
+        """
+        在等待窗口内收集更多可以合并的短录音
+
+        Returns:
+            (可合并的任务, 取到的第一个无法合并的任务，没有时为 _NO_JOB)
+        """
+        batch = []
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size - 1:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None or job.language != language or len(job.samples) > WINDOW_SECONDS * SAMPLE_RATE:
+                return batch, job
+            batch.append(job)
+        return batch, _NO_JOB
+
+    def _run(self, model, batch: List[_LocalJob]):
+        started = time.monotonic()
+        try:
+            if len(batch) == 1 and len(batch[0].samples) > WINDOW_SECONDS * SAMPLE_RATE:
+                segments, _ = model.transcribe(batch[0].samples, language=batch[0].language,
+                                               beam_size=self.beam_size)
+                texts = [''.join(segment.text for segment in segments).strip()]
+            else:
+                texts = self._decode_batch(model, [job.samples for job in batch], batch[0].language)
+            for job, text in zip(batch, texts):
+                job.future.set_result(text)
+        except Exception as e:
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_exception(TranscriptionError(f'本地语音识别失败: {str(e)}'))
+        finally:
+            with self._stats_lock:
+                self._stats["batches"] += 1
+                self._stats["batched_requests"] += len(batch)
+                self._stats["busy_seconds"] += time.monotonic() - started
+
+    def _decode_batch(self, model, clips: List, language: str) -> List[str]:
+        """把多段不超过30秒的录音作为一批送入解码器"""
+        import ctranslate2
+        from faster_whisper.tokenizer import Tokenizer
+
+        frames = model.feature_extractor.nb_max_frames
+        features = []
+        for clip in clips:
+            feature = model.feature_extractor(clip)[:, :frames]
+            if feature.shape[-1] < frames:
+                feature = np.pad(feature, ((0, 0), (0, frames - feature.shape[-1])))
+            features.append(feature)
+
+        tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task='transcribe', language=language)
+        prompt = list(tokenizer.sot_sequence) + [tokenizer.no_timestamps]
+        results = model.model.generate(
+            ctranslate2.StorageView.from_array(np.ascontiguousarray(np.stack(features), dtype=np.float32)),
+            [prompt] * len(clips),
+            beam_size=self.beam_size,
+            max_length=448,
+            suppress_blank=True,
+            suppress_tokens=[-1],
+        )
+        return [tokenizer.decode([token for token in result.sequences_ids[0] if token < tokenizer.eot]).strip()
+                for result in results]
+
+    # ==================== 接口实现 ====================
+
+    def transcribe(self, audio: bytes, filename: str = 'audio.wav', content_type: Optional[str] = None,
+                   language: Optional[str] = None) -> str:
+        if not self._ready.wait(self.timeout):
+            raise TranscriptionError('本地语音识别模型尚未就绪', 503)
+        if not any(thread.is_alive() for thread in self._threads):
+            raise TranscriptionError('本地语音识别模型不可用', 503)
+
+        # 解码在请求线程中完成，工作线程只做推理
+        try:
+            samples = decode_audio(io.BytesIO(audio), sampling_rate=SAMPLE_RATE)
+        except Exception as e:
+            raise TranscriptionError(f'无法解码音频: {str(e)}', 400)
+
+        job = _LocalJob(samples, language or self.language)
+        try:
+            self._jobs.put_nowait(job)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["rejected"] += 1
+            raise TranscriptionError('本地语音识别繁忙，请稍后重试', 503)
+
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["audio_seconds"] += len(samples) / SAMPLE_RATE
+        try:
+            return job.future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise TranscriptionError('本地语音识别超时', 504)
+
+    def close(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['backend'] = self.name
+        stats['pending'] = self._jobs.qsize()
+        stats['ready'] = self._ready.is_set()
+        return stats
+
+
+def create_stt_backend(name: str, **options) -> STTBackend:
+    """
+    根据名称创建语音识别后端
+
+    Args:
+        name: openai 或 local
+        options: 传给后端构造函数的参数
+
+    Returns:
+        语音识别后端
+    """
+    backends = {'openai': WhisperAPIBackend, 'local': LocalWhisperBackend}
+    if name not in backends:
+        raise ValueError(f"未知的语音识别后端: {name}（可选 {', '.join(backends)}）")
+    return backends[name](**options)
+
+
+def stt_backend_options(name: str) -> Dict:
+    """
+    从环境变量读取后端参数（与 app.py 使用相同的配置项）
+
+    Args:
+        name: 后端名称
+    """
+    language = os.getenv('STT_LANGUAGE', 'zh')
+    if name == 'local':
+        return {
+            'model_size': os.getenv('LOCAL_STT_MODEL', 'small'),
+            'language': language,
+            'workers': int(os.getenv('LOCAL_STT_WORKERS', '1')),
+            'cpu_threads': int(os.getenv('LOCAL_STT_CPU_THREADS', '0')),
+            'compute_type': os.getenv('LOCAL_STT_COMPUTE_TYPE', 'int8'),
+            'batch_size': int(os.getenv('LOCAL_STT_BATCH_SIZE', '8')),
+            'batch_wait_ms': int(os.getenv('LOCAL_STT_BATCH_WAIT_MS', '20')),
+            'max_pending': int(os.getenv('LOCAL_STT_MAX_PENDING', '32')),
+        }
+    return {
+        'api_url': os.getenv('OPENAI_API_URL', 'https://api.openai.com/v1'),
+        'api_key': os.getenv('OPENAI_API_KEY', 'your-openai-api-key'),
+        'model': os.getenv('STT_MODEL', 'whisper-1'),
+        'language': language,
+        'timeout': float(os.getenv('STT_TIMEOUT', '30')),
+    }
+
+
+# ==================== 基准测试 ====================
+
+def _clip_seconds(data: bytes) -> Optional[float]:
+    try:
+        with wave.open(io.BytesIO(data), 'rb') as reader:
+            return reader.getnframes() / reader.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+
+def benchmark(backend: STTBackend, clips: Dict[str, bytes], concurrency: int = 1, rounds: int = 1) -> Dict:
+    """
+    用同一批录音测量后端的吞吐和延迟
+
+    Args:
+        backend: 语音识别后端
+        clips: 文件名到音频数据的映射
+        concurrency: 并发请求数
+        rounds: 每段录音重复的次数
+
+    Returns:
+        统计结果（延迟单位为毫秒）
+    """
+    tasks = [(name, data) for _ in range(rounds) for name, data in clips.items()]
+    latencies, errors = [], 0
+
+    def run(task):
+        name, data = task
+        started = time.perf_counter()
+        backend.transcribe(data, os.path.basename(name))
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(run, task) for task in tasks]:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                errors += 1
+                logger.warning(f"基准测试请求失败: {str(e)}")
+    elapsed = time.perf_counter() - started
+
+    audio_seconds = sum(_clip_seconds(data) or 0 for _, data in tasks)
+    latencies.sort()
+    result = {
+        'backend': backend.name,
+        'requests': len(tasks),
+        'errors': errors,
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        # 每秒处理的音频秒数（只统计WAV录音）
+        'audio_seconds_per_s': round(audio_seconds / elapsed, 2) if elapsed and audio_seconds else None,
+    }
+    if latencies:
+        result.update({
+            'p50_ms': round(statistics.median(latencies), 1),
+            'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+            'max_ms': round(latencies[-1], 1),
+        })
+    return result
+
+
+def main(argv=None):
+    """命令行入口"""
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description='语音识别后端基准测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help='比较各后端在同一批录音上的吞吐和延迟')
+    bench_parser.add_argument('clips', nargs='+', help='录音文件')
+    bench_parser.add_argument('--backends', default='openai,local', help='逗号分隔的后端名称')
+    bench_parser.add_argument('--concurrency', type=int, default=4, help='并发请求数')
+    bench_parser.add_argument('--rounds', type=int, default=3, help='每段录音重复的次数')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    load_dotenv('config.env')
+    clips = {}
+    for path in args.clips:
+        with open(path, 'rb') as f:
+            clips[path] = f.read()
+
+    for name in args.backends.split(','):
+        name = name.strip()
+        try:
+            backend = create_stt_backend(name, **stt_backend_options(name))
+        except Exception as e:
+            print(f"{name}: 无法创建后端（{e}）")
+            continue
+        try:
+            # 预热（建立连接 / 等待模型加载），不计入结果
+            backend.transcribe(next(iter(clips.values())), os.path.basename(args.clips[0]))
+            print(benchmark(backend, clips, args.concurrency, args.rounds))
+        except Exception as e:
+            print(f"{name}: 基准测试失败（{e}）")
+        finally:
+            backend.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+语音合成输出格式、码率和模型的协商
+- 格式：请求参数优先，其次按 Accept 头选择（客户端未明确列出音频类型时使用 mp3，兼容旧客户端；
+  列出的音频类型都不支持时返回 406）
+- 码率：请求参数优先，客户端发送 Save-Data: on 时使用省流量码率；需要 ffmpeg 转码，未安装时使用上游默认码率
+- 模型：未指定时根据延迟预算选择，tts-1-hd 的预计耗时在预算内才使用，预计耗时按实际耗时持续修正
+"""
+
+import threading
+from typing import Dict, Optional
+
+# 上游支持的输出格式（pcm 为 24kHz 16位小端单声道，没有文件头，适合边收边播）
+TTS_FORMATS: Dict[str, Dict[str, str]] = {
+    'mp3': {'mimetype': 'audio/mpeg', 'extension': 'mp3'},
+    'opus': {'mimetype': 'audio/ogg', 'extension': 'ogg'},
+    'aac': {'mimetype': 'audio/aac', 'extension': 'aac'},
+    'flac': {'mimetype': 'audio/flac', 'extension': 'flac'},
+    'wav': {'mimetype': 'audio/wav', 'extension': 'wav'},
+    'pcm': {'mimetype': 'audio/L16;rate=24000;channels=1', 'extension': 'pcm'},
+}
+DEFAULT_FORMAT = 'mp3'
+
+
+class FormatNotAcceptable(ValueError):
+    """客户端 Accept 中列出的音频类型都无法提供"""
+
+    status_code = 406
+
+# Accept 中的 MIME 类型对应的格式，按服务端偏好排列（同等质量时体积小的优先）
+# 只列出与实际返回的容器一致的类型（opus 以 Ogg 容器返回，不对应 audio/webm）
+ACCEPT_MIMETYPES = (
+    ('audio/ogg', 'opus'),
+    ('audio/opus', 'opus'),
+    ('audio/aac', 'aac'),
+    ('audio/mp4', 'aac'),
+    ('audio/mpeg', 'mp3'),
+    ('audio/mp3', 'mp3'),
+    ('audio/L16', 'pcm'),
+    ('audio/pcm', 'pcm'),
+    ('audio/wav', 'wav'),
+    ('audio/wave', 'wav'),
+    ('audio/x-wav', 'wav'),
+    ('audio/flac', 'flac'),
+)
+
+# 可以转码降低码率的格式及允许的码率
+BITRATE_FORMATS = ('mp3', 'opus', 'aac')
+BITRATES = ('16k', '24k', '32k', '48k', '64k', '96k', '128k')
+SAVE_DATA_BITRATE = '32k'
+
+TTS_MODELS = ('tts-1', 'tts-1-hd')
+# 各模型耗时的初始估计：固定开销 + 每字符耗时（毫秒）
+MODEL_LATENCY_PRIORS = {
+    'tts-1': (400.0, 8.0),
+    'tts-1-hd': (900.0, 20.0),
+}
+
+
+def negotiate_format(requested: Optional[str], accept_mimetypes=None, save_data: bool = False) -> str:
+    """
+    选择输出格式
+
+    Args:
+        requested: 请求参数指定的格式
+        accept_mimetypes: request.accept_mimetypes
+        save_data: 客户端是否开启省流量模式
+
+    Returns:
+        格式名称
+
+    Raises:
+        ValueError: 请求参数指定的格式不支持
+        FormatNotAcceptable: Accept 中明确列出的音频类型都不支持
+    """
+    if requested:
+        requested = requested.lower()
+        if requested not in TTS_FORMATS:
+            raise ValueError(f"不支持的音频格式: {requested}（可选 {', '.join(TTS_FORMATS)}）")
+        return requested
+
+    if accept_mimetypes is not None:
+        # 只有客户端明确列出音频类型时才协商，*/* 或 audio/* 不改变默认格式
+        explicit = [value for value, quality in accept_mimetypes
+                    if quality > 0 and value.lower().startswith('audio/') and value != 'audio/*']
+        if explicit:
+            best = accept_mimetypes.best_match([mimetype for mimetype, _ in ACCEPT_MIMETYPES])
+            if not best:
+                raise FormatNotAcceptable(f"无法提供 Accept 中的音频类型（可提供 {', '.join(TTS_FORMATS)}）")
+            return dict(ACCEPT_MIMETYPES)[best]
+        elif save_data and accept_mimetypes.quality('audio/ogg') > 0:
+            return 'opus'
+    return DEFAULT_FORMAT
+
+
+def negotiate_bitrate(requested: Optional[str], audio_format: str, save_data: bool = False) -> Optional[str]:
+    """
+    选择码率
+
+    Args:
+        requested: 请求参数指定的码率（如 32k）
+        audio_format: 输出格式
+        save_data: 客户端是否开启省流量模式
+
+    Returns:
+        码率，None 表示使用上游默认码率
+    """
+    if requested:
+        requested = str(requested).lower()
+        if not requested.endswith('k'):
+            requested += 'k'
+        if requested not in BITRATES:
+            raise ValueError(f"不支持的码率: {requested}（可选 {', '.join(BITRATES)}）")
+        if audio_format not in BITRATE_FORMATS:
+            raise ValueError(f"{audio_format} 格式不支持指定码率")
+        return requested
+    if save_data and audio_format in BITRATE_FORMATS:
+        return SAVE_DATA_BITRATE
+    return None
+
+
+class TTSModelSelector:
+    """根据延迟预算选择合成模型"""
+
+    def __init__(self, default_budget_ms: float = 0, smoothing: float = 0.2):
+        """
+        Args:
+            default_budget_ms: 未指定预算时的延迟预算（毫秒），0 表示始终使用 tts-1
+            smoothing: 耗时修正系数的平滑因子
+        """
+        self.default_budget_ms = default_budget_ms
+        self.smoothing = smoothing
+        # 实际耗时 / 初始估计 的指数加权平均
+        self._ratios = {model: 1.0 for model in TTS_MODELS}
+        self._lock = threading.Lock()
+
+    def estimate(self, model: str, characters: int) -> float:
+        """预计耗时（毫秒）"""
+        overhead, per_char = MODEL_LATENCY_PRIORS[model]
+        return (overhead + per_char * characters) * self._ratios[model]
+
+    def choose(self, characters: int, budget_ms: Optional[float] = None) -> str:
+        """
+        选择模型
+
+        Args:
+            characters: 文本长度
+            budget_ms: 延迟预算（毫秒），默认使用配置
+
+        Returns:
+            模型名称
+        """
+        budget_ms = self.default_budget_ms if budget_ms is None else budget_ms
+        if budget_ms and self.estimate('tts-1-hd', characters) <= budget_ms:
+            return 'tts-1-hd'
+        return 'tts-1'
+
+    def observe(self, model: str, characters: int, elapsed_ms: float):
+        """记录一次实际耗时"""
+        if model not in MODEL_LATENCY_PRIORS:
+            return
+        overhead, per_char = MODEL_LATENCY_PRIORS[model]
+        ratio = elapsed_ms / (overhead + per_char * characters)
+        with self._lock:
+            self._ratios[model] += self.smoothing * (ratio - self._ratios[model])
+
+    def stats(self) -> Dict[str, float]:
+        """各模型 100 字文本的预计耗时"""
+        return {model: round(self.estimate(model, 100)) for model in TTS_MODELS}
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+上游调用（OpenAI 等付费接口）的结果复用
+- TTLCache: 带过期时间和容量上限的 LRU 缓存
+- SingleFlight: 相同键的并发调用合并为一次，其余调用等待并共享结果（或异常）
+- StreamFlight: 流式调用的合并，后到的请求从头重放已收到的数据块，再与首个请求一起接收后续数据块
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+
+def request_key(path: str, payload: Dict[str, Any]) -> str:
+    """
+    上游请求的规范化键：接口路径 + 按键排序、去掉多余空白的请求体JSON 的哈希
+    """
+    body = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(f"{path}\n{body}".encode('utf-8')).hexdigest()
+
+
+class TTLCache:
+    """带过期时间和容量上限的 LRU 缓存（线程安全）"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 600,
+                 max_bytes: int = 0, size_of: Optional[Callable[[Any], int]] = None):
+        """
+        Args:
+            max_entries: 最大条目数
+            ttl: 过期时间（秒），0 表示不过期
+            max_bytes: 缓存值的总大小上限，0 表示不限制（需要提供 size_of）
+            size_of: 计算缓存值大小的回调
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, default=None, record: bool = True):
+        """
+        获取未过期的缓存值，不存在时返回 default
+
+        Args:
+            key: 缓存键
+            default: 未命中时的返回值
+            record: 是否计入命中率统计
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] and entry[0] <= time.monotonic():
+                self._remove(key)
+                self.stats["expired"] += 1
+                entry = None
+            if entry is None:
+                if record:
+                    self.stats["misses"] += 1
+                return default
+            self._entries.move_to_end(key)
+            if record:
+                self.stats["hits"] += 1
+            return entry[2]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """
+        写入缓存
+
+        Args:
+            key: 缓存键
+            value: 缓存值
+            ttl: 本条目的过期时间（秒），默认使用缓存的设置
+        """
+        ttl = self.ttl if ttl is None else ttl
+        size = self.size_of(value) if self.size_of else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl if ttl else 0, size, value)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     (self.max_bytes and self._bytes > self.max_bytes)):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+
+    def delete(self, key: Hashable):
+        """删除缓存"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key: Hashable):
+        self._bytes -= self._entries.pop(key)[1]
+
+    def info(self) -> Dict[str, Any]:
+        """缓存状态"""
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "bytes": self._bytes}
+
+
+class _Call:
+    __slots__ = ('done', 'value', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """相同键的并发调用只执行一次"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "shared": 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        执行调用，相同键已有调用在进行时等待其结果
+
+        Args:
+            key: 调用键
+            fn: 实际执行的调用
+            timeout: 等待其他调用的最长时间（秒），超时后抛出 TimeoutError
+
+        Returns:
+            (结果, 是否共享了其他请求的结果)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.stats["shared"] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.stats["calls"] += 1
+                leader = True
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError('等待相同请求的结果超时')
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value = fn()
+            return call.value, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def in_flight(self) -> int:
+        """正在进行的调用数"""
+        with self._lock:
+            return len(self._calls)
+
+
+class StreamCancelled(Exception):
+    """所有接收方都已断开，上游数据流被关闭"""
+
+
+class _SharedStream:
+    """
+    多个接收方共享的数据流
+    不使用后台线程：已读到末尾的接收方负责从上游读取下一块，其他接收方等待
+    """
+
+    def __init__(self, source: Iterable[bytes], on_finished: Callable[[], None]):
+        self._source = iter(source)
+        self._on_finished = on_finished
+        self._chunks: List[bytes] = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._pulling = False
+        self._readers = 0
+        self._cond = threading.Condition()
+
+    def _finish(self, error: Optional[BaseException] = None):
+        # 调用时持有 self._cond；调用方释放锁后再调用 self._on_finished（它会获取 StreamFlight 的锁）
+        self._done = True
+        self._error = error
+        self._cond.notify_all()
+
+    def _pull(self) -> bool:
+        """从上游读取下一块，返回是否读到了数据"""
+        try:
+            chunk = next(self._source)
+        except StopIteration:
+            with self._cond:
+                self._pulling = False
+                self._finish()
+            self._on_finished()
+            return False
+        except BaseException as e:
+            with self._cond:
+                self._pulling = False
+                self._finish(e)
+            self._on_finished()
+            return False
+        with self._cond:
+            self._chunks.append(chunk)
+            self._pulling = False
+            self._cond.notify_all()
+        return True
+
+    def reader(self) -> Optional['_StreamReader']:
+        """
+        新的接收方，从第一块开始读取；调用时立即登记，不等第一次读取
+
+        Returns:
+            接收方，数据流已因无人接收而关闭时返回 None
+        """
+        with self._cond:
+            if self._done and isinstance(self._error, StreamCancelled):
+                return None
+            self._readers += 1
+        return _StreamReader(self)
+
+    def _read(self) -> Iterator[bytes]:
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self._chunks) and not self._done and self._pulling:
+                    self._cond.wait()
+                if index < len(self._chunks):
+                    chunk = self._chunks[index]
+                elif self._done:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                else:
+                    self._pulling = True
+                    chunk = None
+            if chunk is None:
+                self._pull()
+                continue
+            index += 1
+            yield chunk
+
+    def _leave(self):
+        """接收方结束，最后一个接收方离开且数据流未结束时关闭上游"""
+        with self._cond:
+            self._readers -= 1
+            abandoned = self._readers == 0 and not self._done
+            if abandoned:
+                self._finish(StreamCancelled('上游数据流已关闭'))
+        if abandoned:
+            self._on_finished()
+            if hasattr(self._source, 'close'):
+                self._source.close()
+
+
+class _StreamReader:
+    """共享数据流的一个接收方（读完、出错、close() 或被回收时离开）"""
+
+    def __init__(self, stream: _SharedStream):
+        self._stream = stream
+        self._chunks = stream._read()
+        self._closed = False
+
+    def __iter__(self) -> '_StreamReader':
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._chunks.close()
+        self._stream._leave()
+
+    def __del__(self):
+        self.close()
+
+
+class StreamFlight:
+    """相同键的并发流式调用只向上游发起一次"""
+
+    def __init__(self):
+        self._streams: Dict[Hashable, _SharedStream] = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "shared": 0}
+
+    def open(self, key: Hashable, start: Callable[[], Iterable[bytes]]) -> Tuple[Iterator[bytes], bool]:
+        """
+        打开数据流，相同键已有数据流在进行时共享它
+
+        Args:
+            key: 调用键
+            start: 发起上游调用、返回数据块迭代器的回调（在第一次读取时才调用）
+
+        Returns:
+            (数据块迭代器, 是否共享了其他请求的数据流)
+        """
+        with self._lock:
+            # 在锁内登记接收方，发起方随即断开也不会把刚加入的接收方的数据流当作无人接收而关闭
+            stream = self._streams.get(key)
+            reader = stream.reader() if stream is not None else None
+            if reader is not None:
+                self.stats["shared"] += 1
+                return reader, True
+
+            def finished():
+                with self._lock:
+                    if self._streams.get(key) is stream:
+                        del self._streams[key]
+
+            stream = self._streams[key] = _SharedStream(_deferred(start), finished)
+            self.stats["calls"] += 1
+            return stream.reader(), False
+
+    def in_flight(self) -> int:
+        """正在进行的数据流数"""
+        with self._lock:
+            return len(self._streams)
+
+
+def _deferred(start: Callable[[], Iterable[bytes]]) -> Iterator[bytes]:
+    source = iter(start())
+    try:
+        yield from source
+    finally:
+        if hasattr(source, 'close'):
+            source.close()
+
+
+def cached_call(cache: TTLCache, flight: SingleFlight, key: Hashable, fn: Callable[[], Any],
+                should_cache: Callable[[Any], bool] = lambda value: True) -> Tuple[Any, str]:
+    """
+    先查缓存，未命中时通过 SingleFlight 调用并写入缓存
+
+    Args:
+        cache: 结果缓存
+        flight: 并发合并器
+        key: 缓存键
+        fn: 实际执行的调用
+        should_cache: 判断结果是否写入缓存
+
+    Returns:
+        (结果, 来源)，来源为 cache（缓存命中）、shared（共享并发请求的结果）或 upstream（本次调用）
+    """
+    missing = object()
+    value = cache.get(key, missing)
+    if value is not missing:
+        return value, 'cache'
+
+    def load():
+        # 排队期间其他请求可能已经写入缓存
+        cached = cache.get(key, missing, record=False)
+        if cached is not missing:
+            return cached
+        result = fn()
+        if should_cache(result):
+            cache.set(key, result)
+        return result
+
+    value, shared = flight.do(key, load)
+    return value, 'shared' if shared else 'upstream'
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+流式语音识别
+用户说话的同时接收音频块，在滚动窗口上增量识别，给出中间结果（partial）和最终结果（final）。
+
+支持两种输入：
+- pcm16: 16位小端单声道PCM（推荐，前端用 AudioWorklet 采集）。只识别尚未确认的窗口，
+  窗口超过 window_seconds 时在其中最安静的位置切开，前半段识别后确认，不再重复识别
+- webm/ogg/mp4 等容器格式（MediaRecorder 的分片）：分片不能单独解码，每次识别从开头累积的全部数据
+"""
+
+import threading
+import time
+from typing import Callable, List, Optional
+
+from audio_processing import SAMPLE_WIDTH, encode_wav, frame_rms
+from stt_backends import TranscriptionError
+
+PCM_FORMAT = 'pcm16'
+CONTAINER_MIMETYPES = {'webm': 'audio/webm', 'ogg': 'audio/ogg', 'mp4': 'audio/mp4', 'wav': 'audio/wav'}
+
+
+class StreamingTranscriber:
+    """一次流式识别会话"""
+
+    def __init__(self, transcribe: Callable[[bytes, str, str], str], audio_format: str = PCM_FORMAT,
+                 sample_rate: int = 16000, partial_interval: float = 1.0, window_seconds: float = 12.0,
+                 max_seconds: float = 120.0, max_bytes: int = 16 * 1024 * 1024, separator: str = ''):
+        """
+        Args:
+            transcribe: 识别回调，参数为 (音频数据, 文件名, MIME类型)，返回文本
+            audio_format: pcm16 或容器格式（webm/ogg/mp4/wav）
+            sample_rate: PCM 采样率
+            partial_interval: 产生中间结果的间隔（PCM 为新增音频秒数，容器格式为经过的秒数）
+            window_seconds: 未确认窗口的最大长度（仅PCM）
+            max_seconds: 单次录音最长时长（仅PCM）
+            max_bytes: 容器格式累积数据上限
+            separator: 拼接各段文本的分隔符（中文为空，英文为空格）
+        """
+        if audio_format != PCM_FORMAT and audio_format not in CONTAINER_MIMETYPES:
+            raise ValueError(f"不支持的音频格式: {audio_format}")
+        self.transcribe = transcribe
+        self.audio_format = audio_format
+        self.sample_rate = sample_rate
+        self.partial_interval = partial_interval
+        self.window_bytes = int(window_seconds * sample_rate) * SAMPLE_WIDTH
+        self.max_bytes = int(max_seconds * sample_rate) * SAMPLE_WIDTH if audio_format == PCM_FORMAT else max_bytes
+        self.separator = separator
+
+        self._lock = threading.Lock()
+        # PCM：尚未确认的窗口；容器格式：从开头累积的全部数据
+        self._buffer = bytearray()
+        self._received = 0
+        self._committed: List[str] = []
+        self._last_partial_at = 0
+        self._last_partial_time = time.monotonic()
+        self.partials = 0
+
+    @property
+    def duration(self) -> Optional[float]:
+        """已接收的音频时长（秒，容器格式未知）"""
+        if self.audio_format != PCM_FORMAT:
+            return None
+        return self._received / (self.sample_rate * SAMPLE_WIDTH)
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        接收一个音频块
+
+        Returns:
+            是否应该产生新的中间结果
+        """
+        with self._lock:
+            if self._received + len(chunk) > self.max_bytes:
+                raise TranscriptionError('录音过长', 413)
+            self._buffer.extend(chunk)
+            self._received += len(chunk)
+
+            if self.audio_format == PCM_FORMAT:
+                interval_bytes = int(self.partial_interval * self.sample_rate) * SAMPLE_WIDTH
+                return self._received - self._last_partial_at >= interval_bytes
+            return time.monotonic() - self._last_partial_time >= self.partial_interval
+
+    def _transcribe(self, audio: bytes) -> str:
+        if self.audio_format == PCM_FORMAT:
+            # 奇数长度的块可能把一个采样拆开，只识别完整的采样
+            audio = audio[:len(audio) - len(audio) % SAMPLE_WIDTH]
+            if not audio:
+                return ''
+            return self.transcribe(encode_wav(audio, self.sample_rate), 'stream.wav', 'audio/wav').strip()
+        return self.transcribe(bytes(audio), f'stream.{self.audio_format}',
+                               CONTAINER_MIMETYPES[self.audio_format]).strip()
+
+    def _find_cut(self, window: bytes) -> int:
+        """在窗口后半段中找最安静的帧作为切点"""
+        frame_bytes = self.sample_rate * 30 // 1000 * SAMPLE_WIDTH
+        best, best_energy = len(window) - len(window) % frame_bytes, None
+        for offset in range(len(window) // 2 // frame_bytes * frame_bytes, len(window) - frame_bytes + 1, frame_bytes):
+            energy = frame_rms(window[offset:offset + frame_bytes])
+            if best_energy is None or energy < best_energy:
+                best, best_energy = offset + frame_bytes // 2 // SAMPLE_WIDTH * SAMPLE_WIDTH, energy
+        return best
+
+    def _commit_if_needed(self):
+        """窗口过长时确认前半段（只在识别线程中调用）"""
+        if self.audio_format != PCM_FORMAT:
+            return
+        with self._lock:
+            if len(self._buffer) <= self.window_bytes:
+                return
+            window = bytes(self._buffer)
+        cut = self._find_cut(window)
+        text = self._transcribe(window[:cut])
+        with self._lock:
+            # 识别期间只会在末尾追加数据，可以直接丢弃前 cut 字节
+            del self._buffer[:cut]
+            if text:
+                self._committed.append(text)
+
+    def _join(self, tail: str) -> str:
+        return self.separator.join([text for text in self._committed + [tail] if text])
+
+    def partial(self) -> str:
+        """
+        识别当前已接收的音频，返回中间结果（同一会话中不要并发调用）
+        """
+        with self._lock:
+            self._last_partial_at = self._received
+            self._last_partial_time = time.monotonic()
+        self._commit_if_needed()
+        with self._lock:
+            audio = bytes(self._buffer)
+        text = self._join(self._transcribe(audio))
+        self.partials += 1
+        return text
+
+    def finish(self) -> str:
+        """
+        录音结束，识别剩余音频并返回最终结果
+        """
+        self._commit_if_needed()
+        with self._lock:
+            audio = bytes(self._buffer)
+        return self._join(self._transcribe(audio) if audio else '')